@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class SingleFlight:
+    """Collapse concurrent calls for the same key into a single in-flight task"""
+
+    def __init__(self):
+        self._tasks = {}
+
+    def in_flight(self, key) -> bool:
+        return key in self._tasks
+
+    def start(self, key, fn) -> asyncio.Future:
+        """Return the in-flight task for key, starting fn() if there is none"""
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._tasks[key] = task
+
+            def _forget(done_task, key=key):
+                if self._tasks.get(key) is done_task:
+                    del self._tasks[key]
+
+            task.add_done_callback(_forget)
+        return task
+
+    async def do(self, key, fn):
+        # Shield so a cancelled caller does not cancel the work shared with other callers
+        return await asyncio.shield(self.start(key, fn))
+
+class StaleWhileRevalidateCache:
+    """Per-key result cache with a fresh window and a longer stale window"""
+
+    def __init__(self, fresh_ttl: float, stale_ttl: float, max_entries: int = 10000):
+        self.fresh_ttl = fresh_ttl
+        self.stale_ttl = max(stale_ttl, fresh_ttl)
+        self.max_entries = max_entries
+        self._entries = {}  # key -> (value, stored_at)
+        self._invalidated_at = {}  # key -> monotonic time, only while a load is in flight
+        self._flight = SingleFlight()
+        self._background = set()
+
+    async def get(self, key, loader):
+        """Return (value, age_in_seconds) for key, loading it with loader() when needed"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, stored_at = entry
+            age = time.monotonic() - stored_at
+            if age < self.fresh_ttl:
+                return value, age
+            if age < self.stale_ttl:
+                self._refresh_in_background(key, loader)
+                return value, age
+        started = time.monotonic()
+        value = await self._flight.do(key, lambda: self._load(key, loader, started))
+        return value, 0.0
+
+    async def get_many(self, keys, loader) -> dict:
+        """Return {key: value or exception} for keys, loading the ones not fresh in one call"""
+        results = {}
+        missing = []
+        for key in keys:
+            value = self.peek(key)
+            if value is not None:
+                results[key] = value
+            else:
+                missing.append(key)
+        if not missing:
+            return results
+
+        started = time.monotonic()
+        to_load = [key for key in missing if not self._flight.in_flight(key)]
+        batch = asyncio.ensure_future(loader(to_load)) if to_load else None
+
+        def pick(key):
+            async def load():
+                value = (await batch).get(key, LookupError(key))
+                if isinstance(value, Exception):
+                    raise value
+                return value
+            return load
+
+        tasks = [self._flight.start(key, lambda key=key: self._load(key, pick(key), started)) for key in missing]
+        values = await asyncio.gather(*(asyncio.shield(task) for task in tasks), return_exceptions=True)
+        results.update(zip(missing, values))
+        return results
+
+    def peek(self, key):
+        """Return the cached value for key if it is still fresh, without loading"""
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[1] < self.fresh_ttl:
+            return entry[0]
+        return None
+
+    def put(self, key, value):
+        """Store a value computed outside get(), e.g. a result that can no longer change"""
+        self._store(key, value)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+        if self._flight.in_flight(key):
+            # A load that started before this write must not repopulate the entry
+            self._invalidated_at[key] = time.monotonic()
+
+    async def _load(self, key, loader, started: float):
+        # started is taken when the load is registered, before its task first runs
+        try:
+            value = await loader()
+        finally:
+            invalidated_at = self._invalidated_at.pop(key, None)
+        if invalidated_at is None or invalidated_at < started:
+            self._store(key, value)
+        return value
+
+    def _store(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = (value, time.monotonic())
+        while len(self._entries) > self.max_entries:
+            self._entries.pop(next(iter(self._entries)))
+
+    def _refresh_in_background(self, key, loader):
+        if self._flight.in_flight(key):
+            return
+        started = time.monotonic()
+        task = self._flight.start(key, lambda: self._load(key, loader, started))
+        self._background.add(task)
+        task.add_done_callback(self._on_background_done)
+
+    def _on_background_done(self, task):
+        self._background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Background cache refresh failed: {task.exception()}")
@@ -0,0 +1,36 @@
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import List, Optional
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+# MongoDB connection with TLS enforcement
+mongo_url = os.environ['MONGO_URL']
+client = AsyncIOMotorClient(
+    mongo_url,
+    tls=True,
+    tlsAllowInvalidCertificates=False,
+    tlsCAFile='/etc/ssl/certs/ca-certificates.crt',
+    serverSelectionTimeoutMS=10000
+)
+db = client[os.environ['DB_NAME']]
+
+def parse_mongo_datetime(value) -> Optional[datetime]:
+    """Datetimes are stored as ISO strings by prepare_for_mongo, or as BSON dates"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+async def aggregate_by_id(collection, pipeline: List[dict]) -> dict:
+    """Run a $group pipeline and index its output documents by _id"""
+    results = await collection.aggregate(pipeline).to_list(None)
+    return {result["_id"]: result for result in results}
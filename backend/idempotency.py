@@ -0,0 +1,151 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from fastapi import HTTPException, Response
+from fastapi.encoders import jsonable_encoder
+from pymongo.errors import DuplicateKeyError
+
+from database import db, parse_mongo_datetime
+from jobs import WORKER_ID
+from monitoring import metrics
+
+class IdempotencyStore:
+    """Replays the stored response of POSTs retried with the same Idempotency-Key"""
+
+    def __init__(self, ttl_hours: float = 24.0, lru_size: int = 10000, wait_seconds: float = 30.0,
+                 stale_claim_seconds: float = 120.0):
+        self.ttl = timedelta(hours=ttl_hours)
+        self.lru_size = lru_size
+        self.wait_seconds = wait_seconds
+        self.stale_claim_seconds = stale_claim_seconds
+        self._lru = OrderedDict()  # record key -> completed record
+        self._in_flight = {}  # record key -> Future resolving to the completed record
+
+    @staticmethod
+    def fingerprint(payload) -> str:
+        return hashlib.sha256(json.dumps(jsonable_encoder(payload), sort_keys=True).encode()).hexdigest()
+
+    def _remember(self, record_key: str, record: dict):
+        self._lru[record_key] = record
+        self._lru.move_to_end(record_key)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def _cached(self, record_key: str) -> Optional[dict]:
+        record = self._lru.get(record_key)
+        if record is None:
+            return None
+        if record["expires_at"] <= datetime.now(timezone.utc):
+            del self._lru[record_key]
+            return None
+        self._lru.move_to_end(record_key)
+        return record
+
+    @staticmethod
+    def _replay(response: Response, record: dict, fingerprint: str, replayed: bool):
+        if record["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+        if replayed:
+            response.headers["Idempotent-Replayed"] = "true"
+        return record["body"]
+
+    async def run(self, response: Response, scope: str, key: Optional[str], payload, fn):
+        if not key:
+            return await fn()
+        if len(key) > 255:
+            raise HTTPException(status_code=400, detail="Idempotency-Key must be at most 255 characters")
+        
+        record_key = f"{scope}:{key}"
+        fingerprint = self.fingerprint(payload)
+        record = self._cached(record_key)
+        if record is not None:
+            metrics.increment("idempotency.replays")
+            return self._replay(response, record, fingerprint, replayed=True)
+        
+        in_flight = self._in_flight.get(record_key)
+        if in_flight is not None:
+            metrics.increment("idempotency.waits")
+            record, _ = await asyncio.shield(in_flight)
+            return self._replay(response, record, fingerprint, replayed=True)
+        
+        in_flight = asyncio.get_running_loop().create_future()
+        # Nobody may be waiting; retrieve the exception so it isn't reported as unhandled
+        in_flight.add_done_callback(lambda future: future.cancelled() or future.exception())
+        self._in_flight[record_key] = in_flight
+        try:
+            record, replayed = await self._execute(record_key, fingerprint, fn)
+            in_flight.set_result((record, replayed))
+        except asyncio.CancelledError:
+            in_flight.cancel()
+            raise
+        except Exception as e:
+            in_flight.set_exception(e)
+            raise
+        finally:
+            self._in_flight.pop(record_key, None)
+        if replayed:
+            metrics.increment("idempotency.replays")
+        return self._replay(response, record, fingerprint, replayed=replayed)
+
+    async def _claim(self, record_key: str, fingerprint: str) -> Optional[dict]:
+        """Claim the key; returns the existing record instead if another request owns it"""
+        now = datetime.now(timezone.utc)
+        claim = {
+            "_id": record_key,
+            "fingerprint": fingerprint,
+            "status": "in_progress",
+            "claimed_by": WORKER_ID,
+            "created_at": now,
+            "expires_at": now + self.ttl
+        }
+        try:
+            await db.idempotency_keys.insert_one(claim)
+            return None
+        except DuplicateKeyError:
+            pass
+        # Take over claims abandoned by a crashed worker
+        taken_over = await db.idempotency_keys.find_one_and_update(
+            {"_id": record_key, "status": "in_progress",
+             "created_at": {"$lt": now - timedelta(seconds=self.stale_claim_seconds)}},
+            {"$set": {k: v for k, v in claim.items() if k != "_id"}}
+        )
+        if taken_over is not None:
+            return None
+        return await db.idempotency_keys.find_one({"_id": record_key})
+
+    async def _execute(self, record_key: str, fingerprint: str, fn):
+        existing = await self._claim(record_key, fingerprint)
+        if existing is not None:
+            deadline = time.monotonic() + self.wait_seconds
+            while existing is not None and existing["status"] == "in_progress" and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+                existing = await db.idempotency_keys.find_one({"_id": record_key})
+            if existing is None:
+                # The first request failed and released the key; run it here instead
+                return await self._execute(record_key, fingerprint, fn)
+            if existing["status"] == "in_progress":
+                raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress",
+                                    headers={"Retry-After": "1"})
+            existing["expires_at"] = parse_mongo_datetime(existing["expires_at"])
+            self._remember(record_key, existing)
+            return existing, True
+        
+        try:
+            body = jsonable_encoder(await fn())
+        except BaseException:
+            await db.idempotency_keys.delete_one({"_id": record_key, "status": "in_progress"})
+            raise
+        
+        now = datetime.now(timezone.utc)
+        record = {"fingerprint": fingerprint, "status": "completed", "body": body, "expires_at": now + self.ttl}
+        await db.idempotency_keys.update_one(
+            {"_id": record_key},
+            {"$set": {**record, "completed_at": now}}
+        )
+        self._remember(record_key, record)
+        return record, False
@@ -0,0 +1,48 @@
+import asyncio
+import logging
+import os
+import socket
+
+logger = logging.getLogger(__name__)
+
+WORKER_ID = os.environ.get('WORKER_ID') or f"{socket.gethostname()}-{os.getpid()}"
+
+class PeriodicJob:
+    """Run a coroutine function every interval seconds until stopped"""
+
+    def __init__(self, name: str, interval: float, fn, run_on_stop: bool = False):
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self.run_on_stop = run_on_stop
+        self._task = None
+        self._stopped = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._stopped = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stopped.set()
+        await self._task
+        self._task = None
+        if self.run_on_stop:
+            await self.run_once()
+
+    async def run_once(self):
+        try:
+            await self.fn()
+        except Exception as e:
+            logger.error(f"Periodic job {self.name} failed: {e}")
+
+    async def _run(self):
+        while not self._stopped.is_set():
+            try:
+                await asyncio.wait_for(self._stopped.wait(), timeout=self.interval)
+                break
+            except asyncio.TimeoutError:
+                pass
+            await self.run_once()
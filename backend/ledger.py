@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from pymongo import InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from database import aggregate_by_id, db, parse_mongo_datetime
+
+logger = logging.getLogger(__name__)
+
+# Transaction types that earn the promoter money (boost payments are paid to the platform)
+REVENUE_TRANSACTION_TYPES = ("ticket_sale", "stream_view", "tip", "merchandise", "subscription")
+
+PAYOUT_PENDING_STATUSES = ("pending", "processing")
+
+PLATFORM_FEE_RATE = float(os.environ.get('PLATFORM_FEE_RATE', '0.10'))
+
+# A reservation not confirmed by its payout record within this long is treated as abandoned by rebuilds
+PAYOUT_RESERVATION_TIMEOUT_SECONDS = float(os.environ.get('PAYOUT_RESERVATION_TIMEOUT_SECONDS', '60'))
+
+LEDGER_REBUILD_ATTEMPTS = 5
+
+def ledger_credit(amount: float) -> dict:
+    """Ledger change for one transaction; the fee is rounded per transaction, here and in rebuilds"""
+    fee = round(amount * PLATFORM_FEE_RATE, 2)
+    return {"earned": amount, "fees": fee, "available_balance": round(amount - fee, 2)}
+
+def ledger_update(inc: dict) -> dict:
+    """Every ledger change bumps version so a concurrent rebuild can tell it raced"""
+    return {"$inc": {**inc, "version": 1}, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
+
+async def credit_promoter_ledger(transaction: dict):
+    """Credit a newly completed revenue transaction to the promoter's ledger"""
+    if transaction.get("type") not in REVENUE_TRANSACTION_TYPES:
+        return
+    await db.crm_ledgers.update_one(
+        {"promoter_id": transaction["promoter_id"]},
+        ledger_update(ledger_credit(transaction.get("amount", 0)))
+    )
+
+async def reserve_payout_balance(promoter_id: str, amount: float) -> Optional[dict]:
+    """Move amount from available to pending if the balance covers it; None if it doesn't"""
+    for _ in range(2):
+        update = ledger_update({"available_balance": -amount, "pending_payouts": amount, "reservations_in_flight": 1})
+        update["$set"]["reserved_at"] = datetime.now(timezone.utc).isoformat()
+        before = await db.crm_ledgers.find_one_and_update(
+            {"promoter_id": promoter_id, "available_balance": {"$gte": amount}},
+            update,
+            projection={"_id": 0},
+            return_document=ReturnDocument.BEFORE
+        )
+        if before is not None:
+            return {
+                **before,
+                "available_balance": round(before["available_balance"] - amount, 2),
+                "pending_payouts": round((before.get("pending_payouts") or 0) + amount, 2)
+            }
+        if await db.crm_ledgers.count_documents({"promoter_id": promoter_id}, limit=1):
+            return None
+        await rebuild_promoter_ledger(promoter_id)
+    return None
+
+async def confirm_payout_reservation(promoter_id: str):
+    """The reserved payout is now in crm_payouts, where rebuilds will see it"""
+    await db.crm_ledgers.update_one({"promoter_id": promoter_id}, ledger_update({"reservations_in_flight": -1}))
+
+async def release_payout_balance(promoter_id: str, amount: float, unconfirmed: bool = False):
+    """Return a reserved amount to the available balance (payout failed or was never recorded)"""
+    inc = {"available_balance": amount, "pending_payouts": -amount}
+    if unconfirmed:
+        inc["reservations_in_flight"] = -1
+    await db.crm_ledgers.update_one({"promoter_id": promoter_id}, ledger_update(inc))
+
+async def settle_payout_balance(promoter_id: str, amount: float):
+    """Move a reserved amount from pending to paid out"""
+    await db.crm_ledgers.update_one(
+        {"promoter_id": promoter_id}, ledger_update({"pending_payouts": -amount, "paid_out": amount})
+    )
+
+async def refund_crm_transaction(transaction_id: str) -> Optional[dict]:
+    """Mark a completed transaction refunded and debit what it credited; None if it wasn't completed"""
+    before = await db.crm_transactions.find_one_and_update(
+        {"id": transaction_id, "status": "completed"},
+        {"$set": {"status": "refunded", "refunded_at": datetime.now(timezone.utc).isoformat()}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.BEFORE
+    )
+    if before is None:
+        return None
+    if before.get("type") in REVENUE_TRANSACTION_TYPES:
+        credit = ledger_credit(before.get("amount", 0))
+        await db.crm_ledgers.update_one(
+            {"promoter_id": before["promoter_id"]},
+            ledger_update({field: -value for field, value in credit.items()})
+        )
+    return {**before, "status": "refunded"}
+
+async def load_promoter_ledgers(promoter_ids: List[str]) -> dict:
+    ledgers = await db.crm_ledgers.find(
+        {"promoter_id": {"$in": promoter_ids}}, projection={"_id": 0}
+    ).to_list(None)
+    return {ledger["promoter_id"]: ledger for ledger in ledgers}
+
+def reservation_in_flight(ledger: Optional[dict]) -> bool:
+    if not ledger or not ledger.get("reservations_in_flight"):
+        return False
+    reserved_at = parse_mongo_datetime(ledger.get("reserved_at"))
+    timeout = timedelta(seconds=PAYOUT_RESERVATION_TIMEOUT_SECONDS)
+    return reserved_at is not None and reserved_at > datetime.now(timezone.utc) - timeout
+
+async def rebuild_promoter_ledgers(promoter_ids: Optional[List[str]] = None) -> int:
+    """Recompute ledgers from crm_transactions and crm_payouts; all promoters when ids are omitted"""
+    if promoter_ids is None:
+        promoter_ids = sorted(
+            set(await db.crm_transactions.distinct("promoter_id")) | set(await db.crm_payouts.distinct("promoter_id"))
+        )
+    rebuilt = 0
+    for start in range(0, len(promoter_ids), 500):
+        remaining = promoter_ids[start:start + 500]
+        for _ in range(LEDGER_REBUILD_ATTEMPTS):
+            written = await rebuild_ledger_chunk(remaining)
+            rebuilt += len(written)
+            remaining = [promoter_id for promoter_id in remaining if promoter_id not in written]
+            if not remaining:
+                break
+        if remaining:
+            logger.warning(f"Skipped rebuilding {len(remaining)} ledgers with concurrent changes, sales or reservations in flight")
+    return rebuilt
+
+async def rebuild_ledger_chunk(promoter_ids: List[str]) -> set:
+    """One rebuild attempt; returns the promoter ids whose ledger was written"""
+    ledgers = await load_promoter_ledgers(promoter_ids)
+    # Read after the ledgers: a sale whose credit is already in them is either completed or still recording
+    recording = set(await db.crm_transactions.distinct(
+        "promoter_id", {"promoter_id": {"$in": promoter_ids}, "status": "recording"}
+    ))
+    promoter_ids = [promoter_id for promoter_id in promoter_ids
+                    if promoter_id not in recording and not reservation_in_flight(ledgers.get(promoter_id))]
+    if not promoter_ids:
+        return set()
+    amounts, payouts_by_promoter = await asyncio.gather(
+        # Grouped by amount so fees can be rounded per transaction, as ledger_credit does
+        db.crm_transactions.aggregate([
+            {"$match": {"promoter_id": {"$in": promoter_ids}, "type": {"$in": list(REVENUE_TRANSACTION_TYPES)},
+                        "status": "completed"}},
+            {"$group": {"_id": {"promoter_id": "$promoter_id", "amount": "$amount"}, "count": {"$sum": 1}}}
+        ]).to_list(None),
+        aggregate_by_id(db.crm_payouts, [
+            {"$match": {"promoter_id": {"$in": promoter_ids}}},
+            {"$group": {
+                "_id": "$promoter_id",
+                "pending_payouts": {"$sum": {"$cond": [
+                    {"$in": ["$status", list(PAYOUT_PENDING_STATUSES)]}, "$amount", 0
+                ]}},
+                "paid_out": {"$sum": {"$cond": [{"$eq": ["$status", "paid"]}, "$amount", 0]}}
+            }}
+        ])
+    )
+    credits = {}
+    for group in amounts:
+        credit = credits.setdefault(group["_id"]["promoter_id"], {"earned": 0.0, "fees": 0.0, "available_balance": 0.0})
+        for field, value in ledger_credit(group["_id"]["amount"]).items():
+            credit[field] += value * group["count"]
+
+    now = datetime.now(timezone.utc).isoformat()
+    rebuild_id = str(uuid.uuid4())
+    operations = []
+    for promoter_id in promoter_ids:
+        credit = credits.get(promoter_id, {"earned": 0.0, "fees": 0.0, "available_balance": 0.0})
+        payouts = payouts_by_promoter.get(promoter_id, {})
+        pending_payouts = round(payouts.get("pending_payouts", 0), 2)
+        paid_out = round(payouts.get("paid_out", 0), 2)
+        ledger = {
+            "promoter_id": promoter_id,
+            "earned": round(credit["earned"], 2),
+            "fees": round(credit["fees"], 2),
+            "pending_payouts": pending_payouts,
+            "paid_out": paid_out,
+            "available_balance": round(credit["available_balance"] - pending_payouts - paid_out, 2),
+            "reservations_in_flight": 0,
+            "fee_rate": PLATFORM_FEE_RATE,
+            "rebuild_id": rebuild_id,
+            "rebuilt_at": now,
+            "updated_at": now
+        }
+        if promoter_id in ledgers:
+            operations.append(UpdateOne(
+                {"promoter_id": promoter_id, "version": ledgers[promoter_id].get("version")},
+                {"$set": ledger, "$inc": {"version": 1}}
+            ))
+        else:
+            # A concurrent insert fails the unique promoter_id index and is retried
+            operations.append(InsertOne({**ledger, "version": 1}))
+    try:
+        await db.crm_ledgers.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+            raise
+    written = await db.crm_ledgers.find(
+        {"promoter_id": {"$in": promoter_ids}, "rebuild_id": rebuild_id}, projection={"_id": 0, "promoter_id": 1}
+    ).to_list(None)
+    return {ledger["promoter_id"] for ledger in written}
+
+async def rebuild_promoter_ledger(promoter_id: str) -> dict:
+    await rebuild_promoter_ledgers([promoter_id])
+    return await db.crm_ledgers.find_one({"promoter_id": promoter_id}, projection={"_id": 0})
@@ -0,0 +1,79 @@
+import asyncio
+import json
+from collections import deque
+from typing import List, Optional
+
+from fastapi.encoders import jsonable_encoder
+
+class HubSubscription:
+    """A subscriber's bounded queue of pre-serialized messages for one topic"""
+
+    def __init__(self, topic: str, queue_size: int):
+        self.topic = topic
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.closed = False
+
+    async def get(self) -> Optional[str]:
+        """Next message, or None once the subscription has been closed"""
+        if self.closed and self.queue.empty():
+            return None
+        return await self.queue.get()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # Discard the backlog so the close marker always fits
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+class TopicHub:
+    """In-process fan-out from one publisher to every subscriber of a topic"""
+
+    def __init__(self, queue_size: int = 100, history_size: int = 0):
+        self.queue_size = queue_size
+        self.history_size = history_size
+        self._subscribers = {}  # topic -> set of HubSubscription
+        self._history = {}  # topic -> deque of recent messages
+        self.dropped_subscribers = 0
+
+    def subscribe(self, topic: str) -> HubSubscription:
+        subscription = HubSubscription(topic, self.queue_size)
+        self._subscribers.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: HubSubscription):
+        subscribers = self._subscribers.get(subscription.topic)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[subscription.topic]
+        subscription.close()
+
+    def subscriber_count(self, topic: str) -> int:
+        return len(self._subscribers.get(topic, ()))
+
+    def history(self, topic: str) -> List[str]:
+        return list(self._history.get(topic, ()))
+
+    def clear_history(self, topic: str):
+        self._history.pop(topic, None)
+
+    def publish(self, topic: str, message) -> int:
+        """Deliver message to every subscriber of topic; returns the number reached"""
+        subscribers = self._subscribers.get(topic)
+        if not subscribers and not self.history_size:
+            return 0
+        data = message if isinstance(message, str) else json.dumps(jsonable_encoder(message))
+        if self.history_size:
+            self._history.setdefault(topic, deque(maxlen=self.history_size)).append(data)
+        delivered = 0
+        for subscription in list(subscribers or ()):
+            try:
+                subscription.queue.put_nowait(data)
+                delivered += 1
+            except asyncio.QueueFull:
+                self.dropped_subscribers += 1
+                self.unsubscribe(subscription)
+        return delivered
@@ -0,0 +1,80 @@
+import bisect
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+class LatencyHistogram:
+    """Cumulative latency histogram over fixed millisecond buckets"""
+
+    BOUNDS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS_MS) + 1)
+        self.count = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, seconds: float):
+        ms = seconds * 1000
+        self.buckets[bisect.bisect_left(self.BOUNDS_MS, ms)] += 1
+        self.count += 1
+        self.sum_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q-th observation"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS_MS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return float(bound)
+        return self.max_ms
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.sum_ms / self.count, 2) if self.count else None,
+            "p50_ms": self.quantile(0.5),
+            "p95_ms": self.quantile(0.95),
+            "p99_ms": self.quantile(0.99),
+            "max_ms": round(self.max_ms, 2)
+        }
+
+class MetricsRegistry:
+    """Named counters, latency histograms and gauge callbacks for GET /api/metrics"""
+
+    def __init__(self):
+        self.counters = {}
+        self.latencies = {}
+        self.gauges = {}
+
+    def increment(self, name: str, value: float = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float):
+        histogram = self.latencies.get(name)
+        if histogram is None:
+            histogram = self.latencies[name] = LatencyHistogram()
+        histogram.observe(seconds)
+
+    def gauge(self, name: str, fn):
+        self.gauges[name] = fn
+
+    def snapshot(self) -> dict:
+        gauges = {}
+        for name, fn in self.gauges.items():
+            try:
+                gauges[name] = fn()
+            except Exception as e:
+                logger.error(f"Error reading gauge {name}: {e}")
+        return {
+            "counters": dict(self.counters),
+            "latency": {name: histogram.snapshot() for name, histogram in self.latencies.items()},
+            "gauges": gauges
+        }
+
+metrics = MetricsRegistry()
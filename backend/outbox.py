@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from pymongo import UpdateOne
+from pymongo.errors import ConfigurationError, OperationFailure
+
+from database import client, db
+
+logger = logging.getLogger(__name__)
+
+def outbox_message(aggregate_type: str, aggregate_id: str, topic: str, payload: dict) -> dict:
+    """An outbox entry; a purchase's messages share its checkout session as aggregate so they apply in order"""
+    now = datetime.now(timezone.utc)
+    payload = {key: value for key, value in payload.items() if key != "_id"}
+    for value in payload.values():
+        if isinstance(value, dict):
+            value.pop("_id", None)
+    return {
+        "id": str(uuid.uuid4()),
+        "aggregate_type": aggregate_type,
+        "aggregate_id": aggregate_id,
+        "topic": topic,
+        "payload": payload,
+        "status": "pending",
+        "attempts": 0,
+        "effects_done": [],
+        "next_attempt_at": now,
+        "created_at": now
+    }
+
+# IllegalOperation: "Transaction numbers are only allowed on a replica set member or mongos"
+TRANSACTIONS_UNSUPPORTED_CODES = {20}
+
+class Outbox:
+    """Writes a primary record and its outbox messages as one unit"""
+
+    def __init__(self, worker: "OutboxWorker"):
+        self.worker = worker
+        self.transactions_supported = None  # unknown until the first write
+
+    async def write(self, collection_name: str, document: dict, messages: List[dict]):
+        if self.transactions_supported is not False:
+            try:
+                async with await client.start_session() as session:
+                    async with session.start_transaction():
+                        await db[collection_name].insert_one(document, session=session)
+                        await db.outbox_events.insert_many(messages, session=session)
+                self.transactions_supported = True
+                self._notify()
+                return
+            except Exception as e:
+                if self.transactions_supported or not self._transactions_unavailable(e):
+                    raise
+                logger.warning(f"MongoDB transactions unavailable, outbox writes fall back to sequential: {e}")
+                self.transactions_supported = False
+                for written in [document, *messages]:
+                    written.pop("_id", None)
+        
+        await db[collection_name].insert_one(document)
+        await db.outbox_events.insert_many(messages)
+        self._notify()
+
+    @staticmethod
+    def _transactions_unavailable(error: Exception) -> bool:
+        # Client without session support (e.g. an in-memory test double), or a server without sessions
+        if isinstance(error, (NotImplementedError, ConfigurationError)):
+            return True
+        return isinstance(error, OperationFailure) and error.code in TRANSACTIONS_UNSUPPORTED_CODES
+
+    def _notify(self):
+        self.worker.wake()
+
+class OutboxWorker:
+    """Delivers outbox messages in batches with per-aggregate ordering"""
+
+    def __init__(self, handlers: dict, workers: int = 2, batch_size: int = 100, lease_seconds: float = 60.0,
+                 max_attempts: int = 10, backoff_base: float = 1.0, backoff_max: float = 300.0,
+                 poll_interval: float = 1.0):
+        self.handlers = handlers  # topic -> async function returning (effect name, effect) pairs
+        self.workers = workers
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.poll_interval = poll_interval
+        self._tasks = []
+        self._wakeup = None
+        self._stopped = False
+        self.stats = {"delivered": 0, "retried": 0, "failed": 0}
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def claim(self) -> List[dict]:
+        now = datetime.now(timezone.utc)
+        due = {"$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            {"status": "processing", "lease_until": {"$lt": now}}
+        ]}
+        candidates = await db.outbox_events.find(
+            due, projection={"_id": 0, "id": 1, "aggregate_id": 1}
+        ).sort("created_at", 1).limit(self.batch_size).to_list(None)
+        if not candidates:
+            return []
+        
+        # Keep only each aggregate's unbroken prefix of unfinished messages
+        candidate_ids = {candidate["id"] for candidate in candidates}
+        unfinished = await db.outbox_events.find(
+            {"aggregate_id": {"$in": list({c["aggregate_id"] for c in candidates})},
+             "status": {"$in": ["pending", "processing"]}},
+            projection={"_id": 0, "id": 1, "aggregate_id": 1}
+        ).sort("created_at", 1).to_list(None)
+        blocked, allowed = set(), []
+        for message in unfinished:
+            if message["aggregate_id"] in blocked:
+                continue
+            if message["id"] in candidate_ids:
+                allowed.append(message["id"])
+            else:
+                blocked.add(message["aggregate_id"])
+        if not allowed:
+            return []
+        
+        lease_id = str(uuid.uuid4())
+        await db.outbox_events.update_many(
+            {"$and": [{"id": {"$in": allowed}}, due]},
+            {"$set": {"status": "processing", "lease_id": lease_id,
+                      "lease_until": now + timedelta(seconds=self.lease_seconds)}}
+        )
+        return await db.outbox_events.find(
+            {"lease_id": lease_id, "status": "processing"}, projection={"_id": 0}
+        ).sort("created_at", 1).to_list(None)
+
+    async def _deliver(self, message: dict) -> Optional[str]:
+        """Run the message's pending effects; returns an error message on failure"""
+        handler = self.handlers.get(message["topic"])
+        if handler is None:
+            return None
+        done = message.setdefault("effects_done", [])
+        try:
+            for name, effect in await handler(message["payload"]):
+                if name in done:
+                    continue
+                await effect()
+                done.append(name)
+                await db.outbox_events.update_one({"id": message["id"]}, {"$addToSet": {"effects_done": name}})
+        except Exception as e:
+            logger.error(f"Outbox {message['topic']} {message['id']} failed: {e}")
+            return str(e)
+        return None
+
+    async def _deliver_aggregate(self, messages: List[dict], results: dict):
+        for position, message in enumerate(messages):
+            error = await self._deliver(message)
+            results[message["id"]] = error
+            if error is not None:
+                # Later messages of this aggregate wait behind the failed one
+                for later in messages[position + 1:]:
+                    results[later["id"]] = "deferred"
+                return
+
+    async def process_batch(self) -> int:
+        messages = await self.claim()
+        if not messages:
+            return 0
+        by_aggregate = {}
+        for message in messages:
+            by_aggregate.setdefault(message["aggregate_id"], []).append(message)
+        results = {}
+        await asyncio.gather(*[self._deliver_aggregate(group, results) for group in by_aggregate.values()])
+        
+        now = datetime.now(timezone.utc)
+        operations = []
+        for message in messages:
+            error = results.get(message["id"])
+            if error is None:
+                operations.append(UpdateOne(
+                    {"id": message["id"]},
+                    {"$set": {"status": "delivered", "processed_at": now},
+                     "$unset": {"lease_id": "", "lease_until": ""}}
+                ))
+                self.stats["delivered"] += 1
+            elif error == "deferred":
+                operations.append(UpdateOne(
+                    {"id": message["id"]},
+                    {"$set": {"status": "pending", "next_attempt_at": now},
+                     "$unset": {"lease_id": "", "lease_until": ""}}
+                ))
+            else:
+                attempts = message.get("attempts", 0) + 1
+                failed = attempts >= self.max_attempts
+                delay = min(self.backoff_base * (2 ** (attempts - 1)), self.backoff_max) * random.uniform(0.5, 1.0)
+                operations.append(UpdateOne(
+                    {"id": message["id"]},
+                    {"$set": {
+                        "status": "failed" if failed else "pending",
+                        "attempts": attempts,
+                        "last_error": error,
+                        "next_attempt_at": now + timedelta(seconds=delay)
+                    }, "$unset": {"lease_id": "", "lease_until": ""}}
+                ))
+                self.stats["failed" if failed else "retried"] += 1
+        await db.outbox_events.bulk_write(operations, ordered=False)
+        return len(messages)
+
+    async def _worker(self):
+        while not self._stopped:
+            try:
+                processed = await self.process_batch()
+            except Exception as e:
+                logger.error(f"Outbox worker failed: {e}")
+                processed = 0
+            if processed:
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._tasks:
+            return
+        self._stopped = False
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        if not self._tasks:
+            return
+        self._stopped = True
+        self._wakeup.set()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -0,0 +1,196 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from pydantic import BaseModel
+from pymongo import ReturnDocument
+
+from database import db, parse_mongo_datetime
+from jobs import WORKER_ID
+from ledger import PAYOUT_PENDING_STATUSES, release_payout_balance, settle_payout_balance
+from monitoring import metrics
+
+logger = logging.getLogger(__name__)
+
+class PayoutResult(BaseModel):
+    payout_id: str
+    success: Optional[bool] = None  # None: not processed, retry later
+    reference: Optional[str] = None
+    error: Optional[str] = None
+
+class LocalPayoutGateway:
+    """Stand-in payout provider for development and tests: pays every valid payout instantly"""
+
+    async def submit_batch(self, payout_method: str, payouts: List[dict]) -> List[PayoutResult]:
+        results = []
+        for payout in payouts:
+            if payout.get("amount", 0) <= 0:
+                results.append(PayoutResult(payout_id=payout["id"], success=False, error="Invalid amount"))
+            else:
+                reference = hashlib.blake2b(payout["idempotency_key"].encode(), digest_size=8).hexdigest()
+                results.append(PayoutResult(payout_id=payout["id"], success=True, reference=f"po_local_{reference}"))
+        return results
+
+# Payout providers by name; select with PAYOUT_GATEWAY. Unset means no payouts are sent.
+PAYOUT_GATEWAYS = {
+    "local": LocalPayoutGateway
+}
+
+def load_payout_gateway():
+    name = os.environ.get('PAYOUT_GATEWAY')
+    if not name:
+        return None
+    if name not in PAYOUT_GATEWAYS:
+        raise ValueError(f"Unknown PAYOUT_GATEWAY {name!r}; expected one of {sorted(PAYOUT_GATEWAYS)}")
+    return PAYOUT_GATEWAYS[name]()
+
+class PayoutEngine:
+    """Claims pending payouts, submits them to the payout gateway and settles the ledger"""
+
+    def __init__(self, gateway, batch_size: int = 100, max_batches: int = 20, lease_seconds: float = 300.0,
+                 max_attempts: int = 5, retry_seconds: float = 300.0, on_settled=None):
+        self.gateway = gateway
+        self.on_settled = on_settled  # called with each settled payout, e.g. to refresh dashboards
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.stats = {"paid": 0, "failed": 0, "retried": 0, "last_run_payouts": 0,
+                      "last_run_seconds": 0.0, "payouts_per_second": 0.0, "oldest_pending_seconds": 0.0}
+
+    async def claim(self, lease_id: str) -> List[dict]:
+        now = datetime.now(timezone.utc)
+        claimable = {"$or": [
+            {"status": "pending", "next_attempt_at": None},
+            {"status": "pending", "next_attempt_at": {"$lte": now.isoformat()}},
+            {"status": "processing", "lease_until": {"$lt": now.isoformat()}}
+        ]}
+        lease = {"$set": {
+            "status": "processing",
+            "lease_id": lease_id,
+            "lease_until": (now + timedelta(seconds=self.lease_seconds)).isoformat(),
+            "leased_by": WORKER_ID
+        }}
+        claimed = []
+        for _ in range(self.batch_size):
+            payout = await db.crm_payouts.find_one_and_update(
+                claimable, lease, sort=[("created_at", 1)], projection={"_id": 0},
+                return_document=ReturnDocument.BEFORE
+            )
+            if payout is None:
+                break
+            claimed.append(payout)
+        return claimed
+
+    async def _settle(self, payouts: List[dict], results: dict, lease_id: str):
+        now = datetime.now(timezone.utc)
+        settled = await asyncio.gather(*[self._settle_one(payout, results.get(payout["id"]), lease_id, now)
+                                         for payout in payouts])
+        lost = settled.count(False)
+        if lost:
+            logger.warning(f"{lost} payouts lost their lease before settling; the new holder settles them")
+
+    async def _settle_one(self, payout: dict, result: Optional[PayoutResult], lease_id: str, now: datetime) -> bool:
+        """Record one payout's outcome; the ledger only moves if this worker still held its lease"""
+        lease_filter = {"id": payout["id"], "lease_id": lease_id}
+        release = {"lease_id": "", "lease_until": "", "leased_by": ""}
+        if result is None or result.success is None:
+            # Gateway error: try the payout again later
+            attempts = payout.get("attempts", 0) + 1
+            error = result.error if result else "not submitted"
+            if attempts < self.max_attempts:
+                write = await db.crm_payouts.update_one(lease_filter, {
+                    "$set": {"status": "pending", "attempts": attempts, "last_error": error,
+                             "next_attempt_at": (now + timedelta(seconds=self.retry_seconds * attempts)).isoformat()},
+                    "$unset": release
+                })
+                if write.matched_count:
+                    self.stats["retried"] += 1
+                return bool(write.matched_count)
+            result = PayoutResult(payout_id=payout["id"], success=False,
+                                  error=f"Gave up after {attempts} attempts: {error}")
+        
+        write = await db.crm_payouts.update_one(lease_filter, {
+            "$set": {
+                "status": "paid" if result.success else "failed",
+                "stripe_payout_id": result.reference,
+                "processed_at": now.isoformat(),
+                "last_error": result.error
+            },
+            "$unset": release
+        })
+        if not write.matched_count:
+            return False
+        
+        if result.success:
+            await settle_payout_balance(payout["promoter_id"], payout["amount"])
+            self.stats["paid"] += 1
+            created_at = parse_mongo_datetime(payout.get("created_at"))
+            if created_at is not None:
+                metrics.observe("payouts.lag", (now - created_at).total_seconds())
+        else:
+            await release_payout_balance(payout["promoter_id"], payout["amount"])
+            self.stats["failed"] += 1
+        if self.on_settled is not None:
+            self.on_settled({**payout, "status": "paid" if result.success else "failed"})
+        return True
+
+    async def process_batch(self) -> int:
+        lease_id = str(uuid.uuid4())
+        payouts = await self.claim(lease_id)
+        if not payouts:
+            return 0
+        
+        by_method = {}
+        for payout in payouts:
+            by_method.setdefault(payout.get("payout_method") or "stripe", []).append(payout)
+        
+        results = {}
+        for payout_method, group in by_method.items():
+            started = time.perf_counter()
+            try:
+                submissions = [{**payout, "idempotency_key": f"payout:{payout['id']}"} for payout in group]
+                for result in await self.gateway.submit_batch(payout_method, submissions):
+                    results[result.payout_id] = result
+                metrics.increment(f"payouts.submitted.{payout_method}", len(group))
+            except Exception as e:
+                logger.error(f"Payout gateway failed for {len(group)} {payout_method} payouts: {e}")
+                for payout in group:
+                    results[payout["id"]] = PayoutResult(payout_id=payout["id"], error=str(e))
+            finally:
+                metrics.observe(f"payouts.gateway.{payout_method}", time.perf_counter() - started)
+        
+        await self._settle(payouts, results, lease_id)
+        return len(payouts)
+
+    async def run(self):
+        started = time.perf_counter()
+        processed = 0
+        for _ in range(self.max_batches):
+            count = await self.process_batch()
+            processed += count
+            if count < self.batch_size:
+                break
+        elapsed = time.perf_counter() - started
+        
+        oldest = await db.crm_payouts.find_one(
+            {"status": {"$in": list(PAYOUT_PENDING_STATUSES)}},
+            projection={"_id": 0, "created_at": 1},
+            sort=[("created_at", 1)]
+        )
+        oldest_created = parse_mongo_datetime(oldest.get("created_at")) if oldest else None
+        self.stats.update({
+            "last_run_payouts": processed,
+            "last_run_seconds": round(elapsed, 3),
+            "payouts_per_second": round(processed / elapsed, 1) if processed and elapsed else 0.0,
+            "oldest_pending_seconds": round((datetime.now(timezone.utc) - oldest_created).total_seconds(), 1)
+            if oldest_created else 0.0
+        })
+        if processed:
+            logger.info(f"Payout engine processed {processed} payouts in {elapsed:.2f}s")
@@ -1,36 +1,49 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Request
-from dotenv import load_dotenv
+from fastapi import FastAPI, APIRouter, Header, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import DeleteOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
 import logging
-from pathlib import Path
+import concurrent.futures
+import hashlib
+import heapq
+import hmac
+import math
+import random
+import threading
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Iterable, List, Optional
 import uuid
+from collections import OrderedDict
 from datetime import datetime, timezone
 from emergentintegrations.llm.chat import LlmChat, UserMessage
 from emergentintegrations.payments.stripe.checkout import StripeCheckout, CheckoutSessionResponse, CheckoutStatusResponse, CheckoutSessionRequest
 import json
 import asyncio
+import time
 import jwt
 from datetime import timedelta
+import numpy as np
 import stripe
 
-
-ROOT_DIR = Path(__file__).parent
-load_dotenv(ROOT_DIR / '.env')
-
-# MongoDB connection with TLS enforcement
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(
-    mongo_url,
-    tls=True,
-    tlsAllowInvalidCertificates=False,
-    tlsCAFile='/etc/ssl/certs/ca-certificates.crt',
-    serverSelectionTimeoutMS=10000
+from caching import SingleFlight, StaleWhileRevalidateCache
+from database import aggregate_by_id, client, db, parse_mongo_datetime
+from jobs import WORKER_ID, PeriodicJob
+from ledger import (
+    PAYOUT_PENDING_STATUSES, REVENUE_TRANSACTION_TYPES, confirm_payout_reservation, credit_promoter_ledger,
+    ledger_credit, ledger_update, load_promoter_ledgers, rebuild_promoter_ledger, rebuild_promoter_ledgers,
+    refund_crm_transaction, release_payout_balance, reserve_payout_balance
 )
-db = client[os.environ['DB_NAME']]
+from idempotency import IdempotencyStore
+from live_hub import HubSubscription, TopicHub
+from monitoring import metrics
+from outbox import Outbox, OutboxWorker, outbox_message
+from payouts import PayoutEngine, load_payout_gateway
+from sketches import BloomFilter, HyperLogLog, TDigest
+from webhook_queue import StripeWebhookQueue
+
 
 # Create the main app without a prefix
 app = FastAPI()
@@ -169,6 +182,8 @@ class StreamTicket(BaseModel):
     purchased_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     access_expires: Optional[datetime] = None
     stripe_payment_intent_id: Optional[str] = None
+    stripe_session_id: Optional[str] = None
+    payment_status: str = "pending"  # pending, paid, expired
 
 class PlaybackToken(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -336,6 +351,7 @@ class Subscription(BaseModel):
 class PlaybackTokenRequest(BaseModel):
     stream_event_id: str
     user_id: str
+    session_id: Optional[str] = None  # checkout session the ticket was bought with; proves the caller is the buyer
 
 class StreamPurchaseRequest(BaseModel):
     stream_event_id: str
@@ -650,16 +666,55 @@ DONATION_PACKAGES = {
 # Initialize Stripe with LIVE keys
 stripe.api_key = os.environ.get('STRIPE_SECRET_KEY', 'sk_test_emergent')
 
+# StripeCheckout clients are reused per host URL; a deployment only sees a handful
+STRIPE_CHECKOUT_CACHE_SIZE = int(os.environ.get('STRIPE_CHECKOUT_CACHE_SIZE', '8'))
+stripe_checkout_clients = OrderedDict()  # host_url -> StripeCheckout
+
 def get_stripe_checkout(host_url: str):
+    stripe_checkout = stripe_checkout_clients.get(host_url)
+    if stripe_checkout is not None:
+        stripe_checkout_clients.move_to_end(host_url)
+        metrics.increment("stripe_checkout.cache_hits")
+        return stripe_checkout
+    
+    metrics.increment("stripe_checkout.cache_misses")
     api_key = os.environ.get('STRIPE_SECRET_KEY')
     webhook_url = f"{host_url}/api/webhook/stripe"
-    return StripeCheckout(api_key=api_key, webhook_url=webhook_url)
+    stripe_checkout = StripeCheckout(api_key=api_key, webhook_url=webhook_url)
+    stripe_checkout_clients[host_url] = stripe_checkout
+    while len(stripe_checkout_clients) > STRIPE_CHECKOUT_CACHE_SIZE:
+        _, evicted = stripe_checkout_clients.popitem(last=False)
+        metrics.increment("stripe_checkout.evictions")
+        asyncio.ensure_future(close_stripe_checkout(evicted))
+    return stripe_checkout
+
+async def close_stripe_checkout(stripe_checkout):
+    """Close a StripeCheckout's underlying client if it exposes one, on the pool its calls ran on"""
+    for name in ("aclose", "close"):
+        close = getattr(stripe_checkout, name, None)
+        if close is None:
+            continue
+        try:
+            await stripe_gateway.run_helper(close)
+        except Exception as e:
+            logger.error(f"Error closing StripeCheckout client: {e}")
+        return
+
+async def close_stripe_checkout_clients():
+    while stripe_checkout_clients:
+        _, stripe_checkout = stripe_checkout_clients.popitem(last=False)
+        await close_stripe_checkout(stripe_checkout)
 
 # Basic routes
 @api_router.get("/")
 async def root():
     return {"message": "TicketAI API - AI-Powered Event Discovery"}
 
+@api_router.get("/metrics")
+async def get_metrics():
+    """In-process latency and counter metrics for this worker"""
+    return {"worker_id": WORKER_ID, **metrics.snapshot()}
+
 @api_router.post("/status", response_model=StatusCheck)
 async def create_status_check(input: StatusCheckCreate):
     status_dict = input.dict()
@@ -907,7 +962,14 @@ async def ai_recommendations(request: AIRecommendationRequest):
 
 # Donation endpoints
 @api_router.post("/donations/checkout", response_model=CheckoutSessionResponse)
-async def create_donation_checkout(request: DonationRequest, http_request: Request):
+async def create_donation_checkout(request: DonationRequest, http_request: Request, response: Response,
+                                   idempotency_key: Optional[str] = Header(None)):
+    return await idempotency_store.run(
+        response, "donation_checkout", idempotency_key, request.dict(),
+        lambda: start_donation_checkout(request, http_request)
+    )
+
+async def start_donation_checkout(request: DonationRequest, http_request: Request):
     try:
         # Validate donation amount
         amount = None
@@ -945,7 +1007,7 @@ async def create_donation_checkout(request: DonationRequest, http_request: Reque
             }
         )
         
-        session = await stripe_checkout.create_checkout_session(checkout_request)
+        session = await stripe_gateway.checkout(stripe_checkout, "create_checkout_session", checkout_request)
         
         # Create payment transaction record
         transaction = PaymentTransaction(
@@ -958,14 +1020,20 @@ async def create_donation_checkout(request: DonationRequest, http_request: Reque
             metadata=checkout_request.metadata
         )
         
-        # Store transaction in database
+        # Store transaction in database together with its outbox entry
         transaction_dict = prepare_for_mongo(transaction.dict())
-        await db.payment_transactions.insert_one(transaction_dict)
+        await outbox.write("payment_transactions", transaction_dict, [outbox_message(
+            "checkout_session", session.session_id, "donation.created", {"transaction": dict(transaction_dict)}
+        )])
         
         logger.info(f"Created donation checkout session: {session.session_id} for amount: ${amount}")
         
         return session
         
+    except HTTPException:
+        raise
+    except PaymentGatewayTimeout:
+        raise HTTPException(status_code=504, detail="Payment provider timed out")
     except Exception as e:
         logger.error(f"Error creating donation checkout: {e}")
         raise HTTPException(status_code=500, detail="Failed to create checkout session")
@@ -973,41 +1041,93 @@ async def create_donation_checkout(request: DonationRequest, http_request: Reque
 @api_router.get("/donations/status/{session_id}", response_model=CheckoutStatusResponse)
 async def get_donation_status(session_id: str, http_request: Request):
     try:
+        # Terminal states never change; the success page polls, so serve them from memory
+        cached = donation_status_cache.peek(session_id)
+        if cached is not None:
+            return cached
+        
+        # The transaction record is the source of truth once webhooks have settled it
+        transaction = await db.payment_transactions.find_one({"session_id": session_id}, projection={"_id": 0})
+        
+        if transaction and is_terminal_checkout(transaction.get("checkout_status"), transaction.get("payment_status")):
+            checkout_status = checkout_status_from_transaction(transaction)
+            donation_status_cache.put(session_id, checkout_status)
+            return checkout_status
+        
+        # Pending and recently created or checked: the webhook will most likely settle it
+        if transaction and not donation_status_check_due(transaction):
+            return checkout_status_from_transaction(transaction)
+        
         # Get host URL from request
         host_url = str(http_request.base_url).rstrip('/')
         
-        # Initialize Stripe
-        stripe_checkout = get_stripe_checkout(host_url)
-        
-        # Get checkout status from Stripe
-        checkout_status = await stripe_checkout.get_checkout_status(session_id)
-        
-        # Find transaction in database
-        transaction = await db.payment_transactions.find_one({"session_id": session_id})
-        
-        if transaction:
-            # Update transaction status if payment is successful and not already processed
-            if (checkout_status.payment_status == "paid" and 
-                transaction.get("payment_status") != "paid"):
-                
-                await db.payment_transactions.update_one(
-                    {"session_id": session_id},
-                    {
-                        "$set": {
-                            "payment_status": checkout_status.payment_status,
-                            "status": checkout_status.status,
-                            "updated_at": datetime.now(timezone.utc).isoformat()
-                        }
-                    }
-                )
-                logger.info(f"Updated donation transaction {session_id} to paid status")
-        
-        return checkout_status
+        # Ask Stripe once per session no matter how many pollers are waiting
+        return await donation_status_flight.do(
+            session_id, lambda: refresh_donation_status(session_id, host_url, transaction is not None)
+        )
         
+    except PaymentGatewayTimeout:
+        raise HTTPException(status_code=504, detail="Payment provider timed out")
     except Exception as e:
         logger.error(f"Error getting donation status: {e}")
         raise HTTPException(status_code=500, detail="Failed to get payment status")
 
+# Stripe payment_status values meaning the buyer owes nothing more
+SETTLED_PAYMENT_STATUSES = ("paid", "no_payment_required")
+
+def is_terminal_checkout(checkout_status: Optional[str], payment_status: Optional[str]) -> bool:
+    return payment_status in SETTLED_PAYMENT_STATUSES or checkout_status in ("complete", "expired")
+
+def checkout_status_from_transaction(transaction: dict) -> CheckoutStatusResponse:
+    """Rebuild the Stripe status response from the stored transaction"""
+    payment_status = transaction.get("payment_status", "unpaid")
+    if payment_status == "pending":
+        payment_status = "unpaid"
+    checkout_status = transaction.get("checkout_status") or ("complete" if payment_status == "paid" else "open")
+    return CheckoutStatusResponse(
+        status=checkout_status,
+        payment_status=payment_status,
+        amount_total=int(round(transaction.get("amount", 0) * 100)),
+        currency=transaction.get("currency", "usd"),
+        metadata=transaction.get("metadata") or {}
+    )
+
+def donation_status_check_due(transaction: dict) -> bool:
+    last_seen = parse_mongo_datetime(transaction.get("stripe_checked_at") or transaction.get("created_at"))
+    if last_seen is None:
+        return True
+    age = (datetime.now(timezone.utc) - last_seen).total_seconds()
+    return age >= DONATION_STATUS_STRIPE_AFTER_SECONDS
+
+async def refresh_donation_status(session_id: str, host_url: str, has_transaction: bool) -> CheckoutStatusResponse:
+    stripe_checkout = get_stripe_checkout(host_url)
+    
+    # Get checkout status from Stripe
+    checkout_status = await stripe_gateway.checkout(stripe_checkout, "get_checkout_status", session_id)
+    metrics.increment("donation_status.stripe_queries")
+    
+    if has_transaction:
+        update = {
+            "checkout_status": checkout_status.status,
+            "stripe_checked_at": datetime.now(timezone.utc).isoformat()
+        }
+        if checkout_status.payment_status == "paid":
+            update.update({
+                "payment_status": checkout_status.payment_status,
+                "status": "completed",
+                "updated_at": datetime.now(timezone.utc).isoformat()
+            })
+        result = await db.payment_transactions.update_one(
+            {"session_id": session_id, "payment_status": {"$ne": "paid"}},
+            {"$set": update}
+        )
+        if result.modified_count and checkout_status.payment_status == "paid":
+            logger.info(f"Updated donation transaction {session_id} to paid status")
+    
+    if is_terminal_checkout(checkout_status.status, checkout_status.payment_status):
+        donation_status_cache.put(session_id, checkout_status)
+    return checkout_status
+
 @api_router.post("/webhook/stripe")
 async def stripe_webhook(request: Request):
     try:
@@ -1020,23 +1140,9 @@ async def stripe_webhook(request: Request):
         # Initialize Stripe
         stripe_checkout = get_stripe_checkout(host_url)
         
-        # Handle webhook
-        webhook_response = await stripe_checkout.handle_webhook(body, signature)
-        
-        # Process webhook event
-        if webhook_response.event_type == "checkout.session.completed":
-            # Update transaction in database
-            await db.payment_transactions.update_one(
-                {"session_id": webhook_response.session_id},
-                {
-                    "$set": {
-                        "payment_status": webhook_response.payment_status,
-                        "status": "completed",
-                        "updated_at": datetime.now(timezone.utc).isoformat()
-                    }
-                }
-            )
-            logger.info(f"Webhook updated donation transaction {webhook_response.session_id}")
+        # Verify the signature, then queue the event; workers apply it after we acknowledge
+        webhook_response = await stripe_gateway.checkout(stripe_checkout, "handle_webhook", body, signature)
+        await stripe_webhook_queue.enqueue(webhook_response, body)
         
         return {"status": "success"}
         
@@ -1049,39 +1155,9 @@ async def stripe_webhook(request: Request):
 async def get_streams():
     """Get all streaming events (live and upcoming)"""
     try:
-        # For now, return mock data. In production, fetch from database
-        mock_streams = [
-            {
-                "id": str(uuid.uuid4()),
-                "title": "Arctic Monkeys - Live from Studio",
-                "description": "Exclusive live performance from the legendary indie rock band",
-                "organizer_id": str(uuid.uuid4()),
-                "start_time": datetime.now(timezone.utc) - timedelta(hours=1),
-                "status": "live",
-                "price": 19.99,
-                "ticket_type": "pay_per_view",
-                "thumbnail_url": "https://images.unsplash.com/photo-1493225457124-a3eb161ffa5f?w=400&h=250&fit=crop",
-                "quality": "HD",
-                "features": ["Multi-camera", "Live Chat", "Backstage Access"],
-                "created_at": datetime.now(timezone.utc)
-            },
-            {
-                "id": str(uuid.uuid4()),
-                "title": "Foo Fighters - World Tour Finale",
-                "description": "The epic finale of the world tour with special guests",
-                "organizer_id": str(uuid.uuid4()),
-                "start_time": datetime.now(timezone.utc) + timedelta(days=5),
-                "status": "scheduled",
-                "price": 24.99,
-                "ticket_type": "vip_access",
-                "thumbnail_url": "https://images.unsplash.com/photo-1501386761578-eac5c94b800a?w=400&h=250&fit=crop",
-                "quality": "4K",
-                "features": ["4K Stream", "Backstage Pass", "Meet & Greet", "Exclusive Merch"],
-                "created_at": datetime.now(timezone.utc)
-            }
-        ]
-        
-        return [StreamEvent(**stream) for stream in mock_streams]
+        # Served from the feed the stream scheduler keeps serialized in memory
+        return Response(content=stream_feed.body, media_type="application/json",
+                        headers={"X-Feed-Age": str(int(stream_feed.age()))})
         
     except Exception as e:
         logger.error(f"Error getting streams: {e}")
@@ -1102,6 +1178,7 @@ async def create_stream_event(stream: StreamEventCreate, organizer_id: str):
         
         prepared_dict = prepare_for_mongo(stream_obj.dict())
         result = await db.stream_events.insert_one(prepared_dict)
+        stream_scheduler.add(prepared_dict)
         
         logger.info(f"Created stream event: {stream_obj.id}")
         return stream_obj
@@ -1111,8 +1188,15 @@ async def create_stream_event(stream: StreamEventCreate, organizer_id: str):
         raise HTTPException(status_code=500, detail="Failed to create stream event")
 
 @api_router.post("/streams/{stream_id}/purchase")
-async def purchase_stream_access(stream_id: str, request: StreamPurchaseRequest):
+async def purchase_stream_access(stream_id: str, request: StreamPurchaseRequest, response: Response,
+                                 idempotency_key: Optional[str] = Header(None)):
     """Create Stripe checkout session for stream access"""
+    return await idempotency_store.run(
+        response, "stream_purchase", idempotency_key, {"stream_id": stream_id, **request.dict()},
+        lambda: start_stream_purchase(stream_id, request)
+    )
+
+async def start_stream_purchase(stream_id: str, request: StreamPurchaseRequest):
     try:
         # Find stream event
         stream = await db.stream_events.find_one({"id": stream_id})
@@ -1124,10 +1208,10 @@ async def purchase_stream_access(stream_id: str, request: StreamPurchaseRequest)
         success_url = f"{origin_url}/stream/success?session_id={{CHECKOUT_SESSION_ID}}"
         cancel_url = f"{origin_url}/live-streaming"
         
-        # Create Stripe checkout session
-        stripe_session = await stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=[{
+        # Create Stripe checkout session (async client; doesn't block the event loop)
+        stripe_session = await stripe_gateway.create_checkout_session({
+            'payment_method_types': ['card'],
+            'line_items': [{
                 'price_data': {
                     'currency': 'usd',
                     'product_data': {
@@ -1138,15 +1222,15 @@ async def purchase_stream_access(stream_id: str, request: StreamPurchaseRequest)
                 },
                 'quantity': 1,
             }],
-            mode='payment',
-            success_url=success_url,
-            cancel_url=cancel_url,
-            metadata={
+            'mode': 'payment',
+            'success_url': success_url,
+            'cancel_url': cancel_url,
+            'metadata': {
                 'type': 'stream_access',
                 'stream_id': stream_id,
                 'user_id': request.user_id
             }
-        )
+        })
         
         # Create pending stream ticket
         ticket = StreamTicket(
@@ -1154,16 +1238,29 @@ async def purchase_stream_access(stream_id: str, request: StreamPurchaseRequest)
             user_id=request.user_id,
             ticket_type=stream['ticket_type'],
             price=stream['price'],
-            stripe_payment_intent_id=stripe_session.payment_intent
+            stripe_payment_intent_id=stripe_session.payment_intent,
+            stripe_session_id=stripe_session.id
         )
         
         ticket_dict = prepare_for_mongo(ticket.dict())
-        await db.stream_tickets.insert_one(ticket_dict)
+        
+        # Ticket and its CRM side effects are written together; the outbox worker delivers them
+        await outbox.write("stream_tickets", ticket_dict, [outbox_message(
+            "checkout_session", stripe_session.id, "stream_purchase.created",
+            {
+                "ticket": dict(ticket_dict),
+                "stream": {"id": stream_id, "title": stream['title'], "organizer_id": stream.get('organizer_id')}
+            }
+        )])
         
         logger.info(f"Created stream purchase session: {stripe_session.id}")
         
         return {"url": stripe_session.url, "session_id": stripe_session.id}
         
+    except HTTPException:
+        raise
+    except PaymentGatewayTimeout:
+        raise HTTPException(status_code=504, detail="Payment provider timed out")
     except Exception as e:
         logger.error(f"Error creating stream purchase: {e}")
         raise HTTPException(status_code=500, detail="Failed to create stream purchase")
@@ -1171,365 +1268,3340 @@ async def purchase_stream_access(stream_id: str, request: StreamPurchaseRequest)
 @api_router.post("/streams/{stream_id}/playback-token")
 async def create_playback_token(stream_id: str, request: PlaybackTokenRequest):
     """Generate playback token for authenticated stream access"""
+    if not request.session_id:
+        raise HTTPException(status_code=401, detail="Checkout session id required")
+    
     try:
-        # Check if user has valid ticket for this stream
-        ticket = await db.stream_tickets.find_one({
-            "stream_event_id": stream_id,
-            "user_id": request.user_id,
-            "$or": [
-                {"access_expires": {"$gte": datetime.now(timezone.utc)}},
-                {"access_expires": None}
-            ]
-        })
+        preissued = await preissued_tokens.get(stream_id, request.user_id, request.session_id)
+        if preissued is not None:
+            return playback_token_response(stream_id, preissued["token"], preissued["expires_at"])
         
-        if not ticket:
-            raise HTTPException(status_code=403, detail="No valid access ticket found")
+        # Smooth go-live spikes before touching the entitlement path
+        await playback_admission.acquire()
         
-        # Generate JWT playback token
-        payload = {
-            "sub": request.user_id,
-            "stream_id": stream_id,
-            "ticket_id": ticket["id"]
-        }
+        # Check if user has valid ticket for this stream (served from memory when warm)
+        ticket = await entitlement_cache.get(stream_id, request.user_id, request.session_id)
         
-        token = jwt.encode(payload, os.environ.get('PLAYBACK_JWT_SECRET', 'change-me'), 
-                          algorithm='HS256')
+        if not ticket or revoked_tickets.might_contain(ticket["ticket_id"]):
+            raise HTTPException(status_code=403, detail="No valid access ticket found")
+        
+        # Generate short-lived JWT playback token scoped to this stream
+        token, expires_at = playback_token_signer.issue(request.user_id, stream_id, ticket["ticket_id"])
         
-        # Store playback token
+        # Store playback token (batched off the request path)
         playback_token = PlaybackToken(
-            stream_ticket_id=ticket["id"],
+            stream_ticket_id=ticket["ticket_id"],
             token=token,
-            expires_at=datetime.now(timezone.utc) + timedelta(minutes=10)
+            expires_at=expires_at
         )
         
         token_dict = prepare_for_mongo(playback_token.dict())
-        await db.playback_tokens.insert_one(token_dict)
+        await playback_token_buffer.put(token_dict)
         
-        # In production, this would return signed CloudFront URLs or Mux playback URLs
-        playback_url = f"https://stream.example.com/hls/{stream_id}/index.m3u8?token={token}"
-        
-        return {
-            "token": token,
-            "playback_url": playback_url,
-            "expires_at": playback_token.expires_at,
-            "expires_in": 600
-        }
+        return playback_token_response(stream_id, token, expires_at)
         
+    except HTTPException:
+        raise
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=503, detail="Too many token requests, retry shortly",
+                            headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         logger.error(f"Error creating playback token: {e}")
         raise HTTPException(status_code=500, detail="Failed to create playback token")
 
-@api_router.post("/streams/{stream_id}/analytics")
-async def log_stream_analytics(stream_id: str, event_type: str, payload: dict = {}):
-    """Log streaming analytics events"""
+@api_router.get("/streams/{stream_id}/playback-token")
+async def get_preissued_playback_token(stream_id: str, user_id: str, session_id: Optional[str] = None):
+    """Fetch a token pre-issued before the stream starts (memory lookup only)"""
+    if not session_id:
+        raise HTTPException(status_code=401, detail="Checkout session id required")
+    preissued = await preissued_tokens.get(stream_id, user_id, session_id)
+    if preissued is not None:
+        return playback_token_response(stream_id, preissued["token"], preissued["expires_at"])
+    
+    # Tell early clients when to come back, spread out so they don't return together
+    retry_after = preissued_tokens.retry_after(stream_id)
+    raise HTTPException(status_code=404, detail="No pre-issued token for this user",
+                        headers={"Retry-After": str(retry_after)} if retry_after else None)
+
+def playback_token_response(stream_id: str, token: str, expires_at: datetime) -> dict:
+    # In production, this would return signed CloudFront URLs or Mux playback URLs
+    playback_url = f"https://stream.example.com/hls/{stream_id}/index.m3u8?token={token}"
+    
+    return {
+        "token": token,
+        "playback_url": playback_url,
+        "expires_at": expires_at,
+        "expires_in": max(int((expires_at - datetime.now(timezone.utc)).total_seconds()), 0)
+    }
+
+def bearer_token(request: Request) -> Optional[str]:
+    authorization = request.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        return authorization[7:].strip() or None
+    return None
+
+def is_admin_request(request: Request) -> bool:
+    """True when the request carries ADMIN_API_KEY in X-Admin-Key (never when the key is unset)"""
+    admin_key = os.environ.get('ADMIN_API_KEY')
+    presented = request.headers.get("x-admin-key")
+    return bool(admin_key and presented and hmac.compare_digest(presented.encode(), admin_key.encode()))
+
+@api_router.get("/streams/verify-token")
+async def verify_stream_token(request: Request, stream_id: Optional[str] = None, token: Optional[str] = None):
+    """Verify a playback token locally for edge and CDN authorizers (no database access)"""
+    if token is None:
+        token = bearer_token(request)
+    if not token:
+        raise HTTPException(status_code=401, detail="Missing playback token")
+    
     try:
-        analytics = StreamAnalytics(
-            stream_event_id=stream_id,
-            user_id=payload.get('user_id'),
-            event_type=event_type,
-            payload=payload
+        claims = verify_playback_token(token, stream_id)
+    except PlaybackTokenError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.reason)
+    
+    return {
+        "valid": True,
+        "sub": claims["sub"],
+        "stream_id": claims["stream_id"],
+        "ticket_id": claims["ticket_id"],
+        "exp": claims["exp"]
+    }
+
+@api_router.post("/streams/tickets/{ticket_id}/revoke")
+async def revoke_stream_ticket(ticket_id: str, request: Request):
+    """Revoke a stream ticket so its playback tokens stop verifying"""
+    if not is_admin_request(request):
+        token = bearer_token(request)
+        if not token:
+            raise HTTPException(status_code=401, detail="Admin key or playback token required")
+        try:
+            claims = verify_playback_token(token)
+        except PlaybackTokenError as e:
+            raise HTTPException(status_code=e.status_code, detail=e.reason)
+        if claims.get("ticket_id") != ticket_id:
+            raise HTTPException(status_code=403, detail="Not allowed to revoke this ticket")
+    
+    try:
+        ticket = await db.stream_tickets.find_one({"id": ticket_id}, projection={"_id": 0, "id": 1, "stream_event_id": 1})
+        if not ticket:
+            raise HTTPException(status_code=404, detail="Ticket not found")
+        
+        await db.revoked_stream_tickets.update_one(
+            {"ticket_id": ticket_id},
+            {"$setOnInsert": {
+                "ticket_id": ticket_id,
+                "stream_event_id": ticket["stream_event_id"],
+                "revoked_at": datetime.now(timezone.utc).isoformat()
+            }},
+            upsert=True
         )
+        # Other workers pick this up on their next refresh
+        revoked_tickets.add(ticket_id)
+        entitlement_cache.revoke(ticket_id)
         
-        analytics_dict = prepare_for_mongo(analytics.dict())
-        await db.stream_analytics.insert_one(analytics_dict)
-        
-        # Update real-time metrics if needed
-        if event_type == "viewer_joined":
-            await db.stream_events.update_one(
-                {"id": stream_id},
-                {"$inc": {"current_viewers": 1, "total_viewers": 1}}
-            )
-        elif event_type == "viewer_left":
-            await db.stream_events.update_one(
-                {"id": stream_id},
-                {"$inc": {"current_viewers": -1}}
-            )
+        return {"ticket_id": ticket_id, "revoked": True}
         
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error revoking stream ticket: {e}")
+        raise HTTPException(status_code=500, detail="Failed to revoke ticket")
+
+@api_router.post("/streams/{stream_id}/analytics")
+async def log_stream_analytics(stream_id: str, event_type: str, request: Request, payload: dict = {}):
+    """Log streaming analytics events"""
+    try:
+        await ingest_stream_event(stream_id, event_type, payload, anonymous_viewer_key(request))
         return {"status": "logged"}
         
+    except BufferFullError:
+        raise HTTPException(status_code=503, detail="Analytics ingestion is busy, retry shortly",
+                            headers={"Retry-After": "1"})
     except Exception as e:
         logger.error(f"Error logging analytics: {e}")
         raise HTTPException(status_code=500, detail="Failed to log analytics")
 
-@api_router.get("/streams/{stream_id}/metrics")
-async def get_stream_metrics(stream_id: str):
-    """Get real-time stream metrics"""
-    try:
-        # Get current stream info
-        stream = await db.stream_events.find_one({"id": stream_id})
-        if not stream:
-            raise HTTPException(status_code=404, detail="Stream not found")
-        
-        # Get analytics summary
-        total_viewers = await db.stream_analytics.count_documents({
-            "stream_event_id": stream_id,
-            "event_type": "viewer_joined"
-        })
-        
-        current_viewers = stream.get("current_viewers", 0)
-        
-        # Get engagement metrics
-        chat_messages = await db.stream_analytics.count_documents({
-            "stream_event_id": stream_id,
-            "event_type": "chat_message"
-        })
-        
-        tips_sent = await db.stream_analytics.count_documents({
-            "stream_event_id": stream_id,
-            "event_type": "tip_sent"
-        })
-        
-        return {
-            "stream_id": stream_id,
-            "current_viewers": current_viewers,
-            "total_viewers": total_viewers,
-            "chat_messages": chat_messages,
-            "tips_sent": tips_sent,
-            "status": stream.get("status", "scheduled")
-        }
-        
-    except Exception as e:
-        logger.error(f"Error getting stream metrics: {e}")
-        raise HTTPException(status_code=500, detail="Failed to get metrics")
+class StreamAnalyticsEventIn(BaseModel):
+    event_type: str
+    payload: dict = {}
 
-# ======================= CRM API ENDPOINTS =======================
+class StreamAnalyticsBatch(BaseModel):
+    events: List[StreamAnalyticsEventIn]
 
-# CRM Dashboard Analytics
-@api_router.get("/crm/dashboard/{promoter_id}", response_model=CRMDashboardData)
-async def get_crm_dashboard(promoter_id: str):
-    """Get comprehensive dashboard data for promoter CRM"""
-    try:
-        # Date range for current month
-        now = datetime.now(timezone.utc)
-        month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        
-        # Get promoter's events
-        events = await db.crm_events.find({"promoter_id": promoter_id}).to_list(None)
-        
-        # Get promoter's transactions for MTD
-        transactions = await db.crm_transactions.find({
-            "promoter_id": promoter_id,
-            "created_at": {"$gte": month_start},
-            "status": "completed"
-        }).to_list(None)
-        
-        # Calculate metrics
-        total_revenue_mtd = sum(t.get("amount", 0) for t in transactions)
-        tickets_sold = sum(e.get("tickets_sold", 0) for e in events)
-        active_events = len([e for e in events if e.get("status") == "active"])
-        
-        # Stream revenue (last 24h)
-        day_ago = now - timedelta(days=1)
-        stream_transactions = await db.crm_transactions.find({
-            "promoter_id": promoter_id,
-            "type": {"$in": ["stream_view", "tip"]},
-            "created_at": {"$gte": day_ago},
-            "status": "completed"
-        }).to_list(None)
-        stream_revenue = sum(t.get("amount", 0) for t in stream_transactions)
-        
-        # Pending payouts
-        pending_payouts = await db.crm_payouts.find({
-            "promoter_id": promoter_id,
-            "status": "pending"
-        }).to_list(None)
-        pending_amount = sum(p.get("amount", 0) for p in pending_payouts)
-        
-        # Growth calculations (mock for now - would compare to previous period)
-        revenue_growth = 12.5
-        audience_growth = 8.3
-        conversion_rate = 3.2
-        avg_ticket_price = total_revenue_mtd / max(tickets_sold, 1)
-        
-        # Top events by revenue
-        top_events = sorted(events, key=lambda x: x.get("revenue", 0), reverse=True)[:3]
-        top_events_data = [
-            {
-                "id": e.get("id"),
-                "name": e.get("name"),
-                "revenue": e.get("revenue", 0),
-                "tickets_sold": e.get("tickets_sold", 0),
-                "status": e.get("status")
-            } for e in top_events
-        ]
-        
-        # Revenue breakdown
-        ticket_revenue = sum(t.get("amount", 0) for t in transactions if t.get("type") == "ticket_sale")
-        merchandise_revenue = sum(t.get("amount", 0) for t in transactions if t.get("type") == "merchandise")
-        
-        return CRMDashboardData(
-            total_revenue=total_revenue_mtd,
-            total_revenue_mtd=total_revenue_mtd,
-            tickets_sold=tickets_sold,
-            active_events=active_events,
-            stream_revenue=stream_revenue,
-            pending_payouts=pending_amount,
-            revenue_growth=revenue_growth,
-            audience_growth=audience_growth,
-            conversion_rate=conversion_rate,
-            avg_ticket_price=avg_ticket_price,
-            top_events=top_events_data,
-            revenue_breakdown={
-                "ticket_sales": ticket_revenue,
-                "live_streams": stream_revenue,
-                "merchandise": merchandise_revenue
-            },
-            period_start=month_start,
-            period_end=now
-        )
-        
-    except Exception as e:
-        logger.error(f"Error getting CRM dashboard: {e}")
-        raise HTTPException(status_code=500, detail="Failed to get dashboard data")
+STREAM_ANALYTICS_BATCH_MAX = 1000
 
-# CRM Events Management
-@api_router.get("/crm/events/{promoter_id}")
-async def get_crm_events(promoter_id: str, status: Optional[str] = None, limit: int = 50):
-    """Get events for promoter CRM"""
+@api_router.post("/streams/{stream_id}/analytics/batch")
+async def log_stream_analytics_batch(stream_id: str, batch: StreamAnalyticsBatch, request: Request,
+                                     response: Response):
+    """Log many streaming analytics events in one request"""
+    if len(batch.events) > STREAM_ANALYTICS_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {STREAM_ANALYTICS_BATCH_MAX} events per batch")
+    
+    accepted = 0
+    fallback_viewer_key = anonymous_viewer_key(request)
     try:
-        query = {"promoter_id": promoter_id}
-        if status:
-            query["status"] = status
-            
-        events = await db.crm_events.find(query).limit(limit).to_list(None)
-        return [CRMEvent(**event) for event in events]
-        
+        for event in batch.events:
+            await ingest_stream_event(stream_id, event.event_type, event.payload, fallback_viewer_key)
+            accepted += 1
+        return {"status": "logged", "accepted": accepted}
+        
+    except BufferFullError:
+        if not accepted:
+            raise HTTPException(status_code=503, detail="Analytics ingestion is busy",
+                                headers={"Retry-After": "1"})
+        response.headers["Retry-After"] = "1"
+        return {"status": "partial", "accepted": accepted, "rejected": len(batch.events) - accepted}
     except Exception as e:
-        logger.error(f"Error getting CRM events: {e}")
-        raise HTTPException(status_code=500, detail="Failed to get events")
+        logger.error(f"Error logging analytics batch: {e}")
+        raise HTTPException(status_code=500, detail="Failed to log analytics")
 
-@api_router.post("/crm/events")
-async def create_crm_event(event: CRMEvent):
-    """Create new event in CRM"""
+# Live stream chat
+CHAT_MAX_MESSAGE_LENGTH = 500
+CHAT_MESSAGES_PER_SECOND = 2.0
+CHAT_SLOW_CONSUMER_CLOSE_CODE = 4008
+CHAT_UNAUTHORIZED_CLOSE_CODE = 4401
+CHAT_AUTH_TIMEOUT_SECONDS = 10
+
+async def authenticate_chat(websocket: WebSocket, stream_id: str, token: Optional[str]) -> Optional[dict]:
+    """Verify the playback token from the query string or the first frame; None if it is missing or invalid"""
+    if not token:
+        try:
+            frame = (await asyncio.wait_for(websocket.receive_text(), timeout=CHAT_AUTH_TIMEOUT_SECONDS)).strip()
+        except asyncio.TimeoutError:
+            return None
+        try:
+            token = json.loads(frame).get("token") if frame.startswith("{") else frame
+        except (ValueError, AttributeError):
+            return None
+    if not token:
+        return None
     try:
-        event_dict = prepare_for_mongo(event.dict())
-        await db.crm_events.insert_one(event_dict)
-        return {"status": "created", "id": event.id}
-        
-    except Exception as e:
-        logger.error(f"Error creating CRM event: {e}")
-        raise HTTPException(status_code=500, detail="Failed to create event")
+        return verify_playback_token(token, stream_id)
+    except PlaybackTokenError:
+        return None
 
-@api_router.put("/crm/events/{event_id}")
-async def update_crm_event(event_id: str, updates: dict):
-    """Update event in CRM"""
+@api_router.websocket("/streams/{stream_id}/chat/ws")
+async def stream_chat(websocket: WebSocket, stream_id: str, token: Optional[str] = None,
+                      display_name: Optional[str] = None):
+    """Live chat for a stream: recent history on connect, then every new message"""
+    await websocket.accept()
     try:
-        updates["updated_at"] = datetime.now(timezone.utc)
-        updates = prepare_for_mongo(updates)
-        
-        result = await db.crm_events.update_one(
-            {"id": event_id},
-            {"$set": updates}
-        )
-        
-        if result.matched_count == 0:
-            raise HTTPException(status_code=404, detail="Event not found")
+        claims = await authenticate_chat(websocket, stream_id, token)
+    except WebSocketDisconnect:
+        return
+    if claims is None:
+        await websocket.close(code=CHAT_UNAUTHORIZED_CLOSE_CODE)
+        return
+    user_id = claims["sub"]
+    topic = chat_topic(stream_id)
+    # No await between the history snapshot and subscribing, so nothing is missed or repeated
+    history = chat_hub.history(topic)
+    subscription = chat_hub.subscribe(topic)
+    
+    async def send_messages():
+        for message in history:
+            await websocket.send_text(message)
+        while True:
+            message = await subscription.get()
+            if message is None:
+                # Dropped by the hub for falling behind
+                await websocket.close(code=CHAT_SLOW_CONSUMER_CLOSE_CODE)
+                return
+            await websocket.send_text(message)
+    
+    sender = asyncio.create_task(send_messages())
+    allowance = CHAT_MESSAGES_PER_SECOND
+    last_check = time.monotonic()
+    try:
+        while True:
+            receive = asyncio.ensure_future(websocket.receive_text())
+            done, _ = await asyncio.wait({receive, sender}, return_when=asyncio.FIRST_COMPLETED)
+            if receive not in done:
+                receive.cancel()
+                break
+            text = receive.result().strip()
+            if not text:
+                continue
             
-        return {"status": "updated"}
-        
+            # Token bucket per connection
+            now = time.monotonic()
+            allowance = min(CHAT_MESSAGES_PER_SECOND, allowance + (now - last_check) * CHAT_MESSAGES_PER_SECOND)
+            last_check = now
+            if allowance < 1:
+                continue
+            allowance -= 1
+            
+            message = {
+                "id": str(uuid.uuid4()),
+                "stream_id": stream_id,
+                "user_id": user_id,
+                "display_name": display_name,
+                "text": text[:CHAT_MAX_MESSAGE_LENGTH],
+                "sent_at": datetime.now(timezone.utc)
+            }
+            chat_hub.publish(topic, message)
+            try:
+                await ingest_stream_event(stream_id, "chat_message", {
+                    "user_id": user_id,
+                    "message_id": message["id"],
+                    "text": message["text"]
+                })
+            except BufferFullError:
+                logger.warning(f"Chat message {message['id']} not persisted: analytics buffer full")
+    except WebSocketDisconnect:
+        pass
     except Exception as e:
-        logger.error(f"Error updating CRM event: {e}")
-        raise HTTPException(status_code=500, detail="Failed to update event")
+        logger.error(f"Error in stream chat: {e}")
+    finally:
+        sender.cancel()
+        if sender.done() and not sender.cancelled() and sender.exception() is not None:
+            logger.info(f"Stream chat sender stopped: {sender.exception()}")
+        chat_hub.unsubscribe(subscription)
 
-# CRM Audience Management
-@api_router.get("/crm/contacts/{promoter_id}")
-async def get_crm_contacts(promoter_id: str, segment: Optional[str] = None, limit: int = 100):
-    """Get contacts for promoter CRM"""
+@api_router.get("/streams/{stream_id}/metrics")
+async def get_stream_metrics(stream_id: str):
+    """Get real-time stream metrics"""
     try:
-        query = {"promoter_id": promoter_id}
-        if segment:
-            query["segments"] = {"$in": [segment]}
-            
-        contacts = await db.crm_contacts.find(query).limit(limit).to_list(None)
-        return [CRMContact(**contact) for contact in contacts]
+        metrics = await build_stream_metrics(stream_id)
+        if metrics is None:
+            raise HTTPException(status_code=404, detail="Stream not found")
+        
+        return metrics
         
     except Exception as e:
-        logger.error(f"Error getting CRM contacts: {e}")
-        raise HTTPException(status_code=500, detail="Failed to get contacts")
+        logger.error(f"Error getting stream metrics: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get metrics")
 
-@api_router.post("/crm/contacts")
-async def create_crm_contact(contact: CRMContact):
-    """Create new contact in CRM"""
+@api_router.get("/streams/{stream_id}/metrics/live")
+async def stream_metrics_live(stream_id: str, request: Request):
+    """Push stream metric deltas over Server-Sent Events instead of polling"""
+    # Subscribe before reading the snapshot so no delta falls between the two
+    subscription = live_hub.subscribe(stream_topic(stream_id))
     try:
-        contact_dict = prepare_for_mongo(contact.dict())
-        await db.crm_contacts.insert_one(contact_dict)
-        return {"status": "created", "id": contact.id}
-        
-    except Exception as e:
-        logger.error(f"Error creating CRM contact: {e}")
-        raise HTTPException(status_code=500, detail="Failed to create contact")
+        metrics = await build_stream_metrics(stream_id)
+    except Exception:
+        live_hub.unsubscribe(subscription)
+        raise
+    if metrics is None:
+        live_hub.unsubscribe(subscription)
+        raise HTTPException(status_code=404, detail="Stream not found")
+    
+    return sse_response(request, subscription, metrics)
 
-@api_router.get("/crm/audience-analytics/{promoter_id}")
-async def get_audience_analytics(promoter_id: str):
-    """Get audience analytics for promoter"""
+@api_router.get("/streams/{stream_id}/metrics/unique-viewers")
+async def get_stream_unique_viewers(
+    stream_id: str,
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to")
+):
+    """Estimated unique viewers of a stream, overall or within a time window"""
     try:
-        # Get contact counts by segment
-        contacts = await db.crm_contacts.find({"promoter_id": promoter_id}).to_list(None)
-        
-        total_contacts = len(contacts)
-        avg_engagement = sum(c.get("engagement_score", 0) for c in contacts) / max(total_contacts, 1)
-        avg_customer_value = sum(c.get("total_spent", 0) for c in contacts) / max(total_contacts, 1)
-        
-        # Segment breakdown
-        segments = {}
-        for contact in contacts:
-            for segment in contact.get("segments", []):
-                segments[segment] = segments.get(segment, 0) + 1
+        if start is None and end is None:
+            unique_viewers = await viewer_sketches.load_total(stream_id)
+        else:
+            now = datetime.now(timezone.utc)
+            start = (start or now - timedelta(hours=24)).astimezone(timezone.utc)
+            end = (end or now).astimezone(timezone.utc) + timedelta(minutes=1)
+            unique_viewers = await viewer_sketches.unique_viewers_between(stream_id, start, end)
         
         return {
-            "total_contacts": total_contacts,
-            "avg_engagement": round(avg_engagement, 1),
-            "avg_customer_value": round(avg_customer_value, 2),
-            "segment_breakdown": segments,
-            "growth_rate": 15.2  # Mock growth rate
+            "stream_id": stream_id,
+            "unique_viewers": unique_viewers,
+            "from": start,
+            "to": end,
+            "standard_error": round(1.04 / math.sqrt(1 << HLL_PRECISION), 4)
         }
         
     except Exception as e:
-        logger.error(f"Error getting audience analytics: {e}")
-        raise HTTPException(status_code=500, detail="Failed to get audience analytics")
+        logger.error(f"Error getting unique viewers: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get unique viewers")
 
-# CRM Marketing Campaigns
-@api_router.get("/crm/campaigns/{promoter_id}")
-async def get_crm_campaigns(promoter_id: str, status: Optional[str] = None):
-    """Get marketing campaigns for promoter"""
-    try:
-        query = {"promoter_id": promoter_id}
-        if status:
-            query["status"] = status
-            
-        campaigns = await db.crm_campaigns.find(query).to_list(None)
-        return [CRMCampaign(**campaign) for campaign in campaigns]
-        
-    except Exception as e:
-        logger.error(f"Error getting CRM campaigns: {e}")
-        raise HTTPException(status_code=500, detail="Failed to get campaigns")
+STREAM_TIMESERIES_MAX_POINTS = 2000
+STREAM_TIMESERIES_FIELDS = ("joins", "leaves", "chat_messages", "tips_sent", "tip_amount")
 
-@api_router.post("/crm/campaigns")
-async def create_crm_campaign(campaign: CRMCampaign):
-    """Create new marketing campaign"""
+@api_router.get("/streams/{stream_id}/metrics/timeseries")
+async def get_stream_metrics_timeseries(
+    stream_id: str,
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    step: int = 1
+):
+    """Per-step viewer concurrency, chat rate and tips for charts (step in minutes)"""
+    now = datetime.now(timezone.utc)
+    end = minute_bucket(end or now) + timedelta(minutes=1)
+    start = minute_bucket(start or end - timedelta(hours=3))
+    step = max(step, 1)
+    points = math.ceil((end - start).total_seconds() / (60 * step))
+    if points <= 0:
+        raise HTTPException(status_code=400, detail="'from' must be before 'to'")
+    if points > STREAM_TIMESERIES_MAX_POINTS:
+        raise HTTPException(status_code=400, detail=f"Range too large; at most {STREAM_TIMESERIES_MAX_POINTS} points")
+    
     try:
-        campaign_dict = prepare_for_mongo(campaign.dict())
-        await db.crm_campaigns.insert_one(campaign_dict)
-        return {"status": "created", "id": campaign.id}
+        buckets = await db.stream_metrics_minutely.find(
+            {"stream_event_id": stream_id, "minute": {"$gte": start, "$lt": end}},
+            projection={"_id": 0, "stream_event_id": 0}
+        ).sort("minute", 1).to_list(None)
+        
+        series = [
+            {"time": start + timedelta(minutes=i * step), "peak_viewers": 0, **{field: 0 for field in STREAM_TIMESERIES_FIELDS}}
+            for i in range(points)
+        ]
+        for bucket in buckets:
+            minute = minute_bucket(bucket["minute"])
+            point = series[int((minute - start).total_seconds() // (60 * step))]
+            point["peak_viewers"] = max(point["peak_viewers"], bucket.get("peak_viewers", 0))
+            for field in STREAM_TIMESERIES_FIELDS:
+                point[field] += bucket.get(field, 0)
+        for point in series:
+            point["chat_rate_per_minute"] = round(point["chat_messages"] / step, 2)
+        
+        return {
+            "stream_id": stream_id,
+            "from": start,
+            "to": end,
+            "step_minutes": step,
+            "points": series
+        }
         
     except Exception as e:
-        logger.error(f"Error creating CRM campaign: {e}")
-        raise HTTPException(status_code=500, detail="Failed to create campaign")
+        logger.error(f"Error getting stream timeseries: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get stream timeseries")
 
-@api_router.post("/crm/campaigns/{campaign_id}/launch")
-async def launch_crm_campaign(campaign_id: str):
-    """Launch marketing campaign"""
-    try:
-        # Update campaign status
-        result = await db.crm_campaigns.update_one(
-            {"id": campaign_id},
-            {"$set": {"status": "active", "scheduled_at": datetime.now(timezone.utc)}}
-        )
-        
-        if result.matched_count == 0:
-            raise HTTPException(status_code=404, detail="Campaign not found")
-        
-        # In production, this would trigger email/SMS sending
+async def build_stream_metrics(stream_id: str) -> Optional[dict]:
+    """Read stream metrics from the database, or None if the stream does not exist"""
+    # Get current stream info
+    stream = await db.stream_events.find_one({"id": stream_id})
+    if not stream:
+        return None
+    
+    # Unique viewers from the HyperLogLog sketches (reconnects are not double counted)
+    total_viewers = viewer_sketches.unique_viewers(stream_id)
+    if total_viewers is None:
+        total_viewers = await viewer_sketches.load_total(stream_id)
+    
+    current_viewers = viewer_count_sync.current(stream_id)
+    
+    # Get engagement metrics from the per-minute buckets
+    engagement = await db.stream_metrics_minutely.aggregate([
+        {"$match": {"stream_event_id": stream_id}},
+        {"$group": {
+            "_id": None,
+            "chat_messages": {"$sum": "$chat_messages"},
+            "tips_sent": {"$sum": "$tips_sent"}
+        }}
+    ]).to_list(1)
+    chat_messages = engagement[0]["chat_messages"] if engagement else 0
+    tips_sent = engagement[0]["tips_sent"] if engagement else 0
+    
+    watch_time = watch_sessions.watch_time(stream_id)
+    if watch_time is None:
+        watch_time = await watch_sessions.load_watch_time(stream_id)
+    
+    return {
+        "stream_id": stream_id,
+        "current_viewers": current_viewers,
+        "total_viewers": total_viewers,
+        "chat_messages": chat_messages,
+        "tips_sent": tips_sent,
+        "watch_time": watch_time,
+        "status": stream.get("status", "scheduled")
+    }
+
+# ======================= RESPONSE CACHING =======================
+
+# Dashboards are polled every few seconds by open tabs; serve them from memory
+crm_cache = StaleWhileRevalidateCache(
+    fresh_ttl=float(os.environ.get('CRM_CACHE_FRESH_SECONDS', '5')),
+    stale_ttl=float(os.environ.get('CRM_CACHE_STALE_SECONDS', '60'))
+)
+
+# Donation status: terminal results are cached; Stripe is asked only about stale pending sessions
+donation_status_cache = StaleWhileRevalidateCache(
+    fresh_ttl=float(os.environ.get('DONATION_STATUS_CACHE_SECONDS', '60')),
+    stale_ttl=float(os.environ.get('DONATION_STATUS_CACHE_SECONDS', '60'))
+)
+donation_status_flight = SingleFlight()
+DONATION_STATUS_STRIPE_AFTER_SECONDS = float(os.environ.get('DONATION_STATUS_STRIPE_AFTER_SECONDS', '15'))
+
+CRM_CACHE_NAMESPACES = ("dashboard", "audience_analytics")
+
+def invalidate_promoter_cache(promoter_id: str):
+    """Drop cached CRM views after a write to the promoter's data"""
+    for namespace in CRM_CACHE_NAMESPACES:
+        crm_cache.invalidate((namespace, promoter_id))
+
+def set_cache_age_header(response: Response, age: float):
+    response.headers["X-Cache-Age"] = str(int(age))
+
+# ======================= LIVE PUSH =======================
+
+# One hub per worker; every open dashboard shares the deltas published by writes
+live_hub = TopicHub(queue_size=int(os.environ.get('LIVE_PUSH_QUEUE_SIZE', '100')))
+
+# Chat has its own hub for a history ring buffer and deeper per-connection queues
+chat_hub = TopicHub(
+    queue_size=int(os.environ.get('CHAT_SEND_QUEUE_SIZE', '256')),
+    history_size=int(os.environ.get('CHAT_HISTORY_SIZE', '200'))
+)
+
+SSE_KEEPALIVE_SECONDS = 15
+
+def promoter_topic(promoter_id: str) -> str:
+    return f"promoter:{promoter_id}"
+
+def stream_topic(stream_id: str) -> str:
+    return f"stream:{stream_id}"
+
+def chat_topic(stream_id: str) -> str:
+    return f"chat:{stream_id}"
+
+def sse_response(request: Request, subscription: HubSubscription, snapshot) -> StreamingResponse:
+    """Stream a snapshot followed by hub deltas to the client as Server-Sent Events"""
+    async def event_stream():
+        try:
+            yield f"event: snapshot\ndata: {json.dumps(jsonable_encoder(snapshot))}\n\n"
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscription.get(), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                if message is None:
+                    break
+                yield f"event: delta\ndata: {message}\n\n"
+        finally:
+            live_hub.unsubscribe(subscription)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+STREAM_EVENT_DELTAS = {
+    "viewer_joined": {"current_viewers": 1, "total_viewers": 1},
+    "viewer_left": {"current_viewers": -1},
+    "chat_message": {"chat_messages": 1},
+    "tip_sent": {"tips_sent": 1},
+}
+
+def publish_stream_delta(stream_id: str, event_type: str, user_id: Optional[str] = None,
+                         changes: Optional[dict] = None):
+    """Push the metric change caused by an analytics event to stream subscribers"""
+    live_hub.publish(stream_topic(stream_id), {
+        "type": "delta",
+        "event_type": event_type,
+        "user_id": user_id,
+        "changes": STREAM_EVENT_DELTAS.get(event_type, {}) if changes is None else changes
+    })
+
+def publish_transaction_delta(transaction: dict):
+    """Push the dashboard change caused by a CRM transaction to promoter subscribers"""
+    changes = {}
+    if transaction.get("status") == "completed":
+        amount = transaction.get("amount", 0)
+        changes = {"total_revenue": amount, "total_revenue_mtd": amount}
+        if transaction.get("type") in ("stream_view", "tip"):
+            changes["stream_revenue"] = amount
+    live_hub.publish(promoter_topic(transaction["promoter_id"]), {
+        "type": "delta",
+        "source": "transaction",
+        "transaction": {
+            "id": transaction.get("id"),
+            "type": transaction.get("type"),
+            "amount": transaction.get("amount", 0),
+            "status": transaction.get("status"),
+            "event_id": transaction.get("event_id")
+        },
+        "changes": changes
+    })
+
+def publish_payout_delta(payout: dict, pending_change: float):
+    """Push a payout state change to promoter subscribers"""
+    live_hub.publish(promoter_topic(payout["promoter_id"]), {
+        "type": "delta",
+        "source": "payout",
+        "payout": {
+            "id": payout.get("id"),
+            "amount": payout.get("amount", 0),
+            "status": payout.get("status")
+        },
+        "changes": {"pending_payouts": pending_change}
+    })
+
+# ======================= WRITE-BEHIND INGESTION =======================
+
+class BufferFullError(Exception):
+    """Raised when a write-behind buffer stays full past its enqueue timeout"""
+
+class WriteBehindBuffer:
+    """Accept documents in memory and write them with insert_many in batches"""
+
+    def __init__(self, collection_name: str, max_batch: int = 500, flush_interval: float = 0.1,
+                 max_pending: int = 10000, put_timeout: float = 1.0, on_flush=None):
+        self.collection_name = collection_name
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.on_flush = on_flush
+        self._queue = asyncio.Queue(maxsize=max_pending)
+        self._task = None
+        self._stopping = False
+        self.stats = {"accepted": 0, "flushed": 0, "batches": 0, "failed": 0, "rejected": 0}
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def start(self):
+        if not self.running:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10.0):
+        """Stop accepting new work and drain what is already buffered"""
+        self._stopping = True
+        if self._task is not None:
+            try:
+                await asyncio.wait_for(self._task, timeout=timeout)
+            except asyncio.TimeoutError:
+                logger.error(f"Timed out draining {self.collection_name} buffer with {self.pending()} pending")
+                self._task.cancel()
+        # Anything left (e.g. buffer never started) is written inline
+        while not self._queue.empty():
+            await self._flush(self._take_nowait(self.max_batch))
+
+    async def put(self, document: dict):
+        if self._stopping or not self.running:
+            self.stats["accepted"] += 1
+            await self._flush([document])
+            return
+        try:
+            self._queue.put_nowait(document)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(self._queue.put(document), timeout=self.put_timeout)
+            except asyncio.TimeoutError:
+                self.stats["rejected"] += 1
+                raise BufferFullError(self.collection_name)
+        self.stats["accepted"] += 1
+
+    def _take_nowait(self, limit: int) -> List[dict]:
+        batch = []
+        while len(batch) < limit and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _collect(self) -> List[dict]:
+        try:
+            first = await asyncio.wait_for(self._queue.get(), timeout=self.flush_interval)
+        except asyncio.TimeoutError:
+            return []
+        batch = [first]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.max_batch:
+            batch.extend(self._take_nowait(self.max_batch - len(batch)))
+            remaining = deadline - loop.time()
+            if len(batch) >= self.max_batch or remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while not (self._stopping and self._queue.empty()):
+            batch = await self._collect()
+            if batch:
+                await self._flush(batch)
+
+    async def _flush(self, batch: List[dict], attempts: int = 3):
+        if not batch:
+            return
+        # insert_many sets each document's _id, so a retry of a document that was
+        # stored by an earlier attempt fails with a duplicate key and counts as stored
+        stored = []
+        pending = batch
+        for attempt in range(1, attempts + 1):
+            try:
+                await db[self.collection_name].insert_many(pending, ordered=False)
+                stored.extend(pending)
+                pending = []
+            except BulkWriteError as e:
+                failed = {
+                    error["index"] for error in e.details.get("writeErrors", [])
+                    if error.get("code") != 11000
+                }
+                stored.extend(document for index, document in enumerate(pending) if index not in failed)
+                pending = [pending[index] for index in sorted(failed)]
+                last_error = e
+            except Exception as e:
+                last_error = e
+            if not pending:
+                break
+            if attempt < attempts:
+                await asyncio.sleep(0.1 * 2 ** attempt)
+        if pending:
+            self.stats["failed"] += len(pending)
+            logger.error(f"Dropping {len(pending)} {self.collection_name} documents after {attempts} attempts: {last_error}")
+        if not stored:
+            return
+        self.stats["flushed"] += len(stored)
+        self.stats["batches"] += 1
+        if self.on_flush is not None:
+            try:
+                await self.on_flush(stored)
+            except Exception as e:
+                logger.error(f"Error applying {self.collection_name} flush hook: {e}")
+
+# Per-minute counters in stream_metrics_minutely, one document per stream per minute
+STREAM_BUCKET_COUNTERS = {
+    "viewer_joined": "joins",
+    "viewer_left": "leaves",
+    "chat_message": "chat_messages",
+    "tip_sent": "tips_sent",
+}
+
+def minute_bucket(created_at) -> datetime:
+    if isinstance(created_at, str):
+        created_at = datetime.fromisoformat(created_at)
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    return created_at.astimezone(timezone.utc).replace(second=0, microsecond=0)
+
+async def apply_stream_metric_buckets(batch: List[dict]):
+    """Coalesce a flushed batch into one $inc upsert per stream per minute"""
+    increments = {}
+    for analytics in batch:
+        field = STREAM_BUCKET_COUNTERS.get(analytics.get("event_type"))
+        if field is None:
+            continue
+        key = (analytics["stream_event_id"], minute_bucket(analytics["created_at"]))
+        bucket_inc = increments.setdefault(key, {})
+        bucket_inc[field] = bucket_inc.get(field, 0) + 1
+        if field == "tips_sent":
+            amount = (analytics.get("payload") or {}).get("amount") or 0
+            try:
+                bucket_inc["tip_amount"] = bucket_inc.get("tip_amount", 0) + float(amount)
+            except (TypeError, ValueError):
+                pass
+    
+    operations = [
+        UpdateOne(
+            {"stream_event_id": stream_id, "minute": minute},
+            {"$inc": inc},
+            upsert=True
+        )
+        for (stream_id, minute), inc in increments.items()
+    ]
+    if operations:
+        await db.stream_metrics_minutely.bulk_write(operations, ordered=False)
+
+stream_analytics_buffer = WriteBehindBuffer(
+    "stream_analytics",
+    max_batch=int(os.environ.get('STREAM_ANALYTICS_FLUSH_EVENTS', '1000')),
+    flush_interval=float(os.environ.get('STREAM_ANALYTICS_FLUSH_MS', '200')) / 1000,
+    max_pending=int(os.environ.get('STREAM_ANALYTICS_MAX_PENDING', '50000')),
+    on_flush=apply_stream_metric_buckets
+)
+
+def anonymous_viewer_key(request: Request) -> str:
+    """Best-effort key for viewers that send neither user_id nor session_id"""
+    client = request.client.host if request.client else ""
+    agent = request.headers.get("user-agent", "")
+    return "anon:" + hashlib.blake2b(f"{client}|{agent}".encode(), digest_size=8).hexdigest()
+
+async def ingest_stream_event(stream_id: str, event_type: str, payload: dict,
+                              fallback_viewer_key: Optional[str] = None) -> StreamAnalytics:
+    """Accept one analytics event into the write-behind buffer and push its delta live"""
+    analytics = StreamAnalytics(
+        stream_event_id=stream_id,
+        user_id=payload.get('user_id'),
+        event_type=event_type,
+        payload=payload
+    )
+    await stream_analytics_buffer.put(prepare_for_mongo(analytics.dict()))
+    
+    changes = None
+    viewer_key = analytics.user_id or payload.get('session_id') or fallback_viewer_key
+    if event_type in VIEWER_PRESENCE_EVENTS and viewer_key:
+        changes = {**STREAM_EVENT_DELTAS.get(event_type, {})}
+        changes["current_viewers"] = viewer_counters.observe(stream_id, viewer_key, event_type)
+        if changes["current_viewers"] > 0:
+            watch_sessions.start(stream_id, viewer_key, analytics.created_at)
+        elif changes["current_viewers"] < 0:
+            watch_sessions.end(stream_id, viewer_key, analytics.created_at)
+        if event_type == "viewer_joined":
+            is_new = viewer_sketches.add(stream_id, viewer_key, analytics.created_at)
+            changes["total_viewers"] = 1 if is_new else 0
+    publish_stream_delta(stream_id, event_type, analytics.user_id, changes)
+    return analytics
+
+# ======================= LIVE VIEWER COUNTERS =======================
+
+VIEWER_PRESENCE_EVENTS = ("viewer_joined", "viewer_left", "viewer_heartbeat")
+
+class LiveViewerCounters:
+    """Striped in-process presence sets of the viewers watching each stream"""
+
+    def __init__(self, stripes: int = 16, presence_timeout: float = 90.0):
+        self.presence_timeout = presence_timeout
+        self._stripes = [{} for _ in range(stripes)]  # stream_id -> {viewer_key: last_seen}
+        self._changes = [{} for _ in range(stripes)]  # (stream_id, viewer_key) -> seen_at, or None once left
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    def _stripe(self, stream_id: str, viewer_key: str) -> int:
+        return hash((stream_id, viewer_key)) % len(self._stripes)
+
+    def observe(self, stream_id: str, viewer_key: str, event_type: str) -> int:
+        """Apply a presence event; returns the change in the stream's viewer count"""
+        index = self._stripe(stream_id, viewer_key)
+        with self._locks[index]:
+            viewers = self._stripes[index].setdefault(stream_id, {})
+            present = viewer_key in viewers
+            if event_type == "viewer_left":
+                viewers.pop(viewer_key, None)
+                if not viewers:
+                    del self._stripes[index][stream_id]
+                self._changes[index][(stream_id, viewer_key)] = None
+                return -1 if present else 0
+            viewers[viewer_key] = time.monotonic()
+            self._changes[index][(stream_id, viewer_key)] = datetime.now(timezone.utc)
+            return 0 if present else 1
+
+    def drain_changes(self) -> tuple:
+        """Return ({(stream_id, viewer_key): seen_at}, {(stream_id, viewer_key) that left}) since the last drain"""
+        seen, left = {}, set()
+        for index, lock in enumerate(self._locks):
+            with lock:
+                changes, self._changes[index] = self._changes[index], {}
+            for key, seen_at in changes.items():
+                if seen_at is None:
+                    left.add(key)
+                else:
+                    seen[key] = seen_at
+        return seen, left
+
+    def count(self, stream_id: str) -> int:
+        return sum(len(stripe.get(stream_id, ())) for stripe in self._stripes)
+
+    def counts(self) -> dict:
+        totals = {}
+        for stripe, lock in zip(self._stripes, self._locks):
+            with lock:
+                for stream_id, viewers in stripe.items():
+                    totals[stream_id] = totals.get(stream_id, 0) + len(viewers)
+        return totals
+
+    def expire(self) -> List[tuple]:
+        """Drop viewers whose last heartbeat is older than the presence timeout"""
+        cutoff = time.monotonic() - self.presence_timeout
+        expired = []
+        for stripe, lock in zip(self._stripes, self._locks):
+            with lock:
+                for stream_id in list(stripe):
+                    viewers = stripe[stream_id]
+                    for viewer_key, last_seen in list(viewers.items()):
+                        if last_seen < cutoff:
+                            del viewers[viewer_key]
+                            expired.append((stream_id, viewer_key, last_seen))
+                    if not viewers:
+                        del stripe[stream_id]
+        return expired
+
+class LocalViewerPresenceStore:
+    """Single-process stand-in for the shared viewer presence store"""
+
+    def __init__(self, presence_timeout: float = 90.0):
+        self.presence_timeout = presence_timeout
+        self._presence = {}  # stream_id -> {viewer_key: last_seen}
+
+    async def publish(self, seen: dict, left: set):
+        for (stream_id, viewer_key), seen_at in seen.items():
+            viewers = self._presence.setdefault(stream_id, {})
+            viewers[viewer_key] = max(viewers.get(viewer_key, seen_at), seen_at)
+        for stream_id, viewer_key in left:
+            self._presence.get(stream_id, {}).pop(viewer_key, None)
+
+    async def totals(self) -> dict:
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.presence_timeout)
+        totals = {}
+        for stream_id in list(self._presence):
+            viewers = {key: seen_at for key, seen_at in self._presence[stream_id].items() if seen_at >= cutoff}
+            if viewers:
+                self._presence[stream_id] = viewers
+                totals[stream_id] = len(viewers)
+            else:
+                del self._presence[stream_id]
+        return totals
+
+class MongoViewerPresenceStore:
+    """One document per (stream, viewer) in stream_viewer_presence, shared by every worker"""
+
+    def __init__(self, presence_timeout: float = 90.0):
+        self.presence_timeout = presence_timeout
+
+    async def publish(self, seen: dict, left: set):
+        operations = [
+            UpdateOne(
+                {"stream_event_id": stream_id, "viewer_key": viewer_key},
+                {"$max": {"last_seen": seen_at}},
+                upsert=True
+            )
+            for (stream_id, viewer_key), seen_at in seen.items()
+        ]
+        operations += [
+            DeleteOne({"stream_event_id": stream_id, "viewer_key": viewer_key})
+            for stream_id, viewer_key in left
+        ]
+        if operations:
+            await db.stream_viewer_presence.bulk_write(operations, ordered=False)
+
+    async def totals(self) -> dict:
+        # The TTL index removes old documents eventually; the cutoff keeps counts exact meanwhile
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.presence_timeout)
+        rows = await db.stream_viewer_presence.aggregate([
+            {"$match": {"last_seen": {"$gte": cutoff}}},
+            {"$group": {"_id": "$stream_event_id", "count": {"$sum": 1}}}
+        ]).to_list(None)
+        return {row["_id"]: row["count"] for row in rows}
+
+class ViewerCountSync:
+    """Publish this worker's presence changes, pull global counts and mirror them to stream_events"""
+
+    def __init__(self, counters: LiveViewerCounters, store):
+        self.counters = counters
+        self.store = store
+        self._merged = {}  # stream_id -> distinct viewers across workers at last sync
+        self._persisted = {}  # stream_id -> current_viewers last written to stream_events
+
+    def current(self, stream_id: str) -> int:
+        """Global count at the last sync, raised to this worker's live local count"""
+        return max(self._merged.get(stream_id, 0), self.counters.count(stream_id))
+
+    async def sync(self):
+        for stream_id, viewer_key, last_seen in self.counters.expire():
+            # The session ended at the last heartbeat, not when the sweep noticed
+            ended_at = datetime.now(timezone.utc) - timedelta(seconds=time.monotonic() - last_seen)
+            watch_sessions.end(stream_id, viewer_key, ended_at)
+            publish_stream_delta(stream_id, "viewer_expired", viewer_key, {"current_viewers": -1})
+        
+        await self.flush()
+        local = self.counters.counts()
+        self._merged = await self.store.totals()
+        
+        totals = {stream_id: self.current(stream_id) for stream_id in set(self._merged) | set(local) | set(self._persisted)}
+        operations = [
+            UpdateOne({"id": stream_id}, {"$set": {"current_viewers": total}})
+            for stream_id, total in totals.items()
+            if self._persisted.get(stream_id) != total
+        ]
+        if operations:
+            await db.stream_events.bulk_write(operations, ordered=False)
+        self._persisted = {stream_id: total for stream_id, total in totals.items() if total}
+        
+        # Sample concurrency into the per-minute buckets for charts
+        minute = minute_bucket(datetime.now(timezone.utc))
+        samples = [
+            UpdateOne(
+                {"stream_event_id": stream_id, "minute": minute},
+                {"$max": {"peak_viewers": total}, "$set": {"viewers": total}},
+                upsert=True
+            )
+            for stream_id, total in totals.items()
+            if total
+        ]
+        if samples:
+            await db.stream_metrics_minutely.bulk_write(samples, ordered=False)
+
+    async def flush(self):
+        """Write presence changes seen since the last flush to the shared store"""
+        seen, left = self.counters.drain_changes()
+        if seen or left:
+            await self.store.publish(seen, left)
+
+viewer_counters = LiveViewerCounters(
+    stripes=int(os.environ.get('VIEWER_COUNTER_STRIPES', '16')),
+    presence_timeout=float(os.environ.get('VIEWER_PRESENCE_TIMEOUT_SECONDS', '90'))
+)
+viewer_count_sync = ViewerCountSync(
+    viewer_counters,
+    LocalViewerPresenceStore(viewer_counters.presence_timeout)
+    if os.environ.get('VIEWER_COUNT_STORE', 'mongo') == 'local'
+    else MongoViewerPresenceStore(viewer_counters.presence_timeout)
+)
+viewer_count_job = PeriodicJob(
+    "viewer_count_sync",
+    float(os.environ.get('VIEWER_COUNT_SYNC_SECONDS', '2')),
+    viewer_count_sync.sync
+)
+
+# ======================= UNIQUE VIEWER SKETCHES =======================
+
+HLL_PRECISION = 13
+
+class StreamViewerSketches:
+    """Per-stream and per-minute unique viewer sketches, persisted per worker"""
+
+    def __init__(self, precision: int = HLL_PRECISION, minute_retention: float = 180.0,
+                 idle_timeout: float = 6 * 3600.0):
+        self.precision = precision
+        self.minute_retention = minute_retention
+        self.idle_timeout = idle_timeout
+        self._totals = {}  # stream_id -> HyperLogLog
+        self._minutes = {}  # (stream_id, minute) -> HyperLogLog
+        self._dirty = set()  # keys of _totals/_minutes changed since last persist
+        self._merged_totals = {}  # stream_id -> estimate across workers at last persist
+        self._touched = {}  # stream_id -> monotonic time of the last add or read
+        self._ended = set()
+
+    @staticmethod
+    def minute_of(moment: datetime) -> datetime:
+        return moment.astimezone(timezone.utc).replace(second=0, microsecond=0)
+
+    def add(self, stream_id: str, viewer_key: str, at: datetime) -> bool:
+        self._touched[stream_id] = time.monotonic()
+        total = self._totals.setdefault(stream_id, HyperLogLog(self.precision))
+        changed = total.add(viewer_key)
+        if changed:
+            self._dirty.add((stream_id, None))
+        minute_key = (stream_id, self.minute_of(at))
+        minute = self._minutes.setdefault(minute_key, HyperLogLog(self.precision))
+        if minute.add(viewer_key):
+            self._dirty.add(minute_key)
+        return changed
+
+    def unique_viewers(self, stream_id: str) -> Optional[int]:
+        """Unique viewers across workers as of the last persist, or None if unknown"""
+        local = self._totals.get(stream_id)
+        merged = self._merged_totals.get(stream_id)
+        if local is None:
+            return merged
+        return max(merged or 0, local.estimate())
+
+    def end_stream(self, stream_id: str):
+        """Drop the stream's state after its next persist"""
+        self._ended.add(stream_id)
+
+    async def _load_totals(self, stream_ids: List[str]) -> dict:
+        """Merge the persisted whole-stream sketches of every worker with the local ones"""
+        sketches = {}
+        for stream_id in stream_ids:
+            sketch = sketches[stream_id] = HyperLogLog(self.precision)
+            local = self._totals.get(stream_id)
+            if local is not None:
+                sketch.merge(local)
+        async for doc in db.stream_viewer_sketches.find(
+            {"stream_event_id": {"$in": list(stream_ids)}, "minute": None},
+            projection={"_id": 0, "stream_event_id": 1, "registers": 1}
+        ):
+            sketches[doc["stream_event_id"]].merge(HyperLogLog.from_bytes(doc["registers"], self.precision))
+        return {stream_id: sketch.estimate() for stream_id, sketch in sketches.items()}
+
+    async def load_total(self, stream_id: str) -> int:
+        """Unique viewers across workers; the stream is then kept fresh by persist()"""
+        total = (await self._load_totals([stream_id]))[stream_id]
+        if stream_id not in self._ended:
+            self._merged_totals[stream_id] = total
+            self._touched[stream_id] = time.monotonic()
+        return total
+
+    async def unique_viewers_between(self, stream_id: str, start: datetime, end: datetime) -> int:
+        """Unique viewers over [start, end) by merging the minute sketches in range"""
+        start_minute, end_minute = self.minute_of(start), self.minute_of(end)
+        sketch = HyperLogLog(self.precision)
+        for (minute_stream, minute), local in list(self._minutes.items()):
+            if minute_stream == stream_id and start_minute <= minute < end_minute:
+                sketch.merge(local)
+        async for doc in db.stream_viewer_sketches.find(
+            {"stream_event_id": stream_id, "minute": {"$gte": start_minute, "$lt": end_minute}},
+            projection={"_id": 0, "registers": 1}
+        ):
+            sketch.merge(HyperLogLog.from_bytes(doc["registers"], self.precision))
+        return sketch.estimate()
+
+    async def persist(self):
+        dirty, self._dirty = self._dirty, set()
+        now = datetime.now(timezone.utc)
+        operations = []
+        for stream_id, minute in dirty:
+            sketch = self._totals.get(stream_id) if minute is None else self._minutes.get((stream_id, minute))
+            if sketch is None:
+                continue
+            operations.append(UpdateOne(
+                {"stream_event_id": stream_id, "minute": minute, "worker_id": WORKER_ID},
+                {"$set": {"registers": sketch.to_bytes(), "precision": self.precision, "updated_at": now}},
+                upsert=True
+            ))
+        if operations:
+            try:
+                await db.stream_viewer_sketches.bulk_write(operations, ordered=False)
+            except Exception:
+                self._dirty |= dirty
+                raise
+        
+        # Refresh merged totals of every tracked stream and mirror changes to stream_events
+        tracked = set(self._totals) | set(self._merged_totals)
+        mirror = []
+        if tracked:
+            for stream_id, total in (await self._load_totals(list(tracked))).items():
+                if self._merged_totals.get(stream_id) != total:
+                    mirror.append(UpdateOne({"id": stream_id}, {"$set": {"total_viewers": total}}))
+                self._merged_totals[stream_id] = total
+        if mirror:
+            await db.stream_events.bulk_write(mirror, ordered=False)
+        
+        # Minute sketches are only kept in memory until they are persisted and closed
+        cutoff = self.minute_of(now - timedelta(seconds=self.minute_retention))
+        for key in [key for key in self._minutes if key[1] < cutoff and key not in self._dirty]:
+            del self._minutes[key]
+        
+        idle_before = time.monotonic() - self.idle_timeout
+        idle = {stream_id for stream_id, touched in self._touched.items() if touched < idle_before}
+        for stream_id in (self._ended | idle) - {stream_id for stream_id, _ in self._dirty}:
+            self._totals.pop(stream_id, None)
+            self._merged_totals.pop(stream_id, None)
+            self._touched.pop(stream_id, None)
+            for key in [key for key in self._minutes if key[0] == stream_id]:
+                del self._minutes[key]
+            self._ended.discard(stream_id)
+
+viewer_sketches = StreamViewerSketches()
+viewer_sketch_job = PeriodicJob(
+    "viewer_sketch_persist",
+    float(os.environ.get('VIEWER_SKETCH_PERSIST_SECONDS', '10')),
+    viewer_sketches.persist,
+    run_on_stop=True
+)
+
+# ======================= WATCH TIME DIGESTS =======================
+
+WATCH_TIME_QUANTILES = {"p50": 0.5, "p90": 0.9, "p95": 0.95}
+
+def summarize_watch_time(digest: TDigest) -> dict:
+    summary = {"sessions": int(digest.total_weight)}
+    for name, q in WATCH_TIME_QUANTILES.items():
+        value = digest.quantile(q)
+        summary[f"{name}_seconds"] = round(value, 1) if value is not None else None
+    return summary
+
+class WatchSessions:
+    """Open viewer sessions in memory; closed session lengths feed a per-stream t-digest"""
+
+    def __init__(self, compression: float = 100.0, idle_timeout: float = 6 * 3600.0):
+        self.compression = compression
+        self.idle_timeout = idle_timeout
+        self._open = {}  # (stream_id, viewer_key) -> started_at
+        self._digests = {}  # stream_id -> TDigest of this worker's closed sessions
+        self._dirty = set()
+        self._merged = {}  # stream_id -> summary across workers at last persist
+        self._touched = {}  # stream_id -> monotonic time of the last session change or read
+        self._ended = set()
+
+    def start(self, stream_id: str, viewer_key: str, at: datetime):
+        self._touched[stream_id] = time.monotonic()
+        self._open.setdefault((stream_id, viewer_key), at)
+
+    def end_stream(self, stream_id: str, at: datetime):
+        """Close the stream's open sessions at at and drop its state after the next persist"""
+        for key in [key for key in self._open if key[0] == stream_id]:
+            self.end(stream_id, key[1], at)
+        self._ended.add(stream_id)
+
+    def end(self, stream_id: str, viewer_key: str, at: datetime):
+        started_at = self._open.pop((stream_id, viewer_key), None)
+        if started_at is None:
+            return
+        duration = (at - started_at).total_seconds()
+        if duration < 0:
+            return
+        self._touched[stream_id] = time.monotonic()
+        self._digests.setdefault(stream_id, TDigest(self.compression)).add(duration)
+        self._dirty.add(stream_id)
+
+    def watch_time(self, stream_id: str) -> Optional[dict]:
+        """Merged watch-time quantiles as of the last persist, or None if unknown"""
+        if stream_id in self._merged:
+            return self._merged[stream_id]
+        local = self._digests.get(stream_id)
+        return summarize_watch_time(local) if local is not None else None
+
+    async def _load_digests(self, stream_ids: List[str]) -> dict:
+        digests = {stream_id: TDigest(self.compression) for stream_id in stream_ids}
+        async for doc in db.stream_watch_digests.find(
+            {"stream_event_id": {"$in": list(stream_ids)}, "worker_id": {"$ne": WORKER_ID}},
+            projection={"_id": 0, "stream_event_id": 1, "digest": 1}
+        ):
+            digests[doc["stream_event_id"]].merge(TDigest.from_dict(doc["digest"]))
+        for stream_id, digest in digests.items():
+            local = self._digests.get(stream_id)
+            if local is not None:
+                digest.merge(TDigest.from_dict(local.to_dict()))
+        return digests
+
+    async def load_digest(self, stream_id: str) -> TDigest:
+        return (await self._load_digests([stream_id]))[stream_id]
+
+    async def load_watch_time(self, stream_id: str) -> dict:
+        """Watch-time quantiles across workers; the stream is then kept fresh by persist()"""
+        summary = summarize_watch_time(await self.load_digest(stream_id))
+        if stream_id not in self._ended:
+            self._merged[stream_id] = summary
+            self._touched[stream_id] = time.monotonic()
+        return summary
+
+    async def persist(self):
+        dirty, self._dirty = self._dirty, set()
+        now = datetime.now(timezone.utc)
+        operations = [
+            UpdateOne(
+                {"stream_event_id": stream_id, "worker_id": WORKER_ID},
+                {"$set": {"digest": self._digests[stream_id].to_dict(), "updated_at": now}},
+                upsert=True
+            )
+            for stream_id in dirty
+        ]
+        if operations:
+            try:
+                await db.stream_watch_digests.bulk_write(operations, ordered=False)
+            except Exception:
+                self._dirty |= dirty
+                raise
+        
+        tracked = set(self._digests) | set(self._merged)
+        if tracked:
+            for stream_id, digest in (await self._load_digests(list(tracked))).items():
+                self._merged[stream_id] = summarize_watch_time(digest)
+        
+        idle_before = time.monotonic() - self.idle_timeout
+        idle = {stream_id for stream_id, touched in self._touched.items() if touched < idle_before}
+        open_streams = {stream_id for stream_id, _ in self._open}
+        for stream_id in (self._ended | idle) - self._dirty - open_streams:
+            self._digests.pop(stream_id, None)
+            self._merged.pop(stream_id, None)
+            self._touched.pop(stream_id, None)
+            self._ended.discard(stream_id)
+
+watch_sessions = WatchSessions()
+watch_time_job = PeriodicJob(
+    "watch_time_persist",
+    float(os.environ.get('WATCH_TIME_PERSIST_SECONDS', '30')),
+    watch_sessions.persist,
+    run_on_stop=True
+)
+
+# ======================= PLAYBACK ENTITLEMENTS =======================
+
+def checkout_session_matches(expected: Optional[str], presented: Optional[str]) -> bool:
+    """Constant-time check of the checkout session id only the buyer was given"""
+    return bool(expected and presented and hmac.compare_digest(expected.encode(), presented.encode()))
+
+class EntitlementCache:
+    """Stream access entitlements keyed by (stream_event_id, user_id)"""
+
+    def __init__(self, negative_ttl: float = 5.0):
+        self.negative_ttl = negative_ttl
+        self._entries = {}  # (stream_id, user_id) -> list of {"ticket_id", "session_id", "paid", "access_expires"}
+        self._negative = {}  # (stream_id, user_id) -> monotonic expiry
+        self._warmed_at = {}  # stream_id -> monotonic time of last warm
+        self.stats = {"hits": 0, "misses": 0, "negative_hits": 0}
+
+    @staticmethod
+    def _entitlement(ticket: dict) -> dict:
+        return {
+            "ticket_id": ticket["id"],
+            "session_id": ticket.get("stripe_session_id"),
+            "paid": ticket.get("payment_status") == "paid",
+            "access_expires": parse_mongo_datetime(ticket.get("access_expires"))
+        }
+
+    @staticmethod
+    def _valid(entitlements: List[dict], session_id: Optional[str] = None) -> Optional[dict]:
+        now = datetime.now(timezone.utc)
+        for entitlement in entitlements:
+            if not entitlement["paid"]:
+                continue
+            if session_id is not None and not checkout_session_matches(entitlement["session_id"], session_id):
+                continue
+            if entitlement["access_expires"] is None or entitlement["access_expires"] >= now:
+                return entitlement
+        return None
+
+    def put(self, ticket: dict):
+        key = (ticket["stream_event_id"], ticket["user_id"])
+        entitlements = self._entries.setdefault(key, [])
+        entitlements[:] = [e for e in entitlements if e["ticket_id"] != ticket["id"]]
+        entitlements.append(self._entitlement(ticket))
+        self._negative.pop(key, None)
+
+    async def get(self, stream_id: str, user_id: str, session_id: Optional[str] = None) -> Optional[dict]:
+        """Valid entitlement for the user, restricted to the ticket bought in session_id if given"""
+        key = (stream_id, user_id)
+        entitlement = self._valid(self._entries.get(key, ()), session_id)
+        if entitlement is not None:
+            self.stats["hits"] += 1
+            return entitlement
+        negative_until = self._negative.get(key)
+        if negative_until is not None and negative_until > time.monotonic():
+            self.stats["negative_hits"] += 1
+            return None
+        
+        self.stats["misses"] += 1
+        tickets = await db.stream_tickets.find(
+            {"stream_event_id": stream_id, "user_id": user_id},
+            projection={"_id": 0, "id": 1, "stream_event_id": 1, "user_id": 1, "access_expires": 1, "stripe_session_id": 1,
+                        "payment_status": 1}
+        ).to_list(50)
+        for ticket in tickets:
+            self.put(ticket)
+        entitlement = self._valid(self._entries.get(key, ()), session_id)
+        if entitlement is None:
+            self._negative[key] = time.monotonic() + self.negative_ttl
+        return entitlement
+
+    async def warm(self, stream_id: str) -> int:
+        count = 0
+        async for ticket in db.stream_tickets.find(
+            {"stream_event_id": stream_id, "payment_status": "paid"},
+            projection={"_id": 0, "id": 1, "stream_event_id": 1, "user_id": 1, "access_expires": 1, "stripe_session_id": 1,
+                        "payment_status": 1}
+        ).batch_size(5000):
+            self.put(ticket)
+            count += 1
+        self._warmed_at[stream_id] = time.monotonic()
+        return count
+
+    def for_stream(self, stream_id: str):
+        """Yield (user_id, entitlement) for every currently valid entitlement of a stream"""
+        for (entry_stream_id, user_id), entitlements in list(self._entries.items()):
+            if entry_stream_id == stream_id:
+                entitlement = self._valid(entitlements)
+                if entitlement is not None:
+                    yield user_id, entitlement
+
+    def revoke(self, ticket_id: str):
+        for key, entitlements in list(self._entries.items()):
+            entitlements[:] = [e for e in entitlements if e["ticket_id"] != ticket_id]
+            if not entitlements:
+                del self._entries[key]
+
+    def forget_stream(self, stream_id: str):
+        for key in [key for key in self._entries if key[0] == stream_id]:
+            del self._entries[key]
+        self._warmed_at.pop(stream_id, None)
+
+    async def warm_upcoming(self, horizon_minutes: float, rewarm_seconds: float):
+        """Warm streams that are live or start within the horizon"""
+        now = datetime.now(timezone.utc)
+        horizon = (now + timedelta(minutes=horizon_minutes)).isoformat()
+        streams = await db.stream_events.find(
+            {"status": {"$in": ["scheduled", "live"]}, "start_time": {"$lte": horizon}},
+            projection={"_id": 0, "id": 1}
+        ).to_list(None)
+        cutoff = time.monotonic() - rewarm_seconds
+        for stream in streams:
+            if self._warmed_at.get(stream["id"], -math.inf) < cutoff:
+                count = await self.warm(stream["id"])
+                logger.info(f"Warmed {count} entitlements for stream {stream['id']}")
+        # Negative entries expire on their own; sweep them so the map stays small
+        now_monotonic = time.monotonic()
+        self._negative = {key: until for key, until in self._negative.items() if until > now_monotonic}
+
+entitlement_cache = EntitlementCache()
+ENTITLEMENT_WARM_MINUTES = float(os.environ.get('ENTITLEMENT_WARM_MINUTES', '15'))
+ENTITLEMENT_REWARM_SECONDS = float(os.environ.get('ENTITLEMENT_REWARM_SECONDS', '300'))
+entitlement_warm_job = PeriodicJob(
+    "entitlement_warm",
+    float(os.environ.get('ENTITLEMENT_WARM_INTERVAL_SECONDS', '60')),
+    lambda: entitlement_cache.warm_upcoming(ENTITLEMENT_WARM_MINUTES, ENTITLEMENT_REWARM_SECONDS)
+)
+
+# Issued playback tokens are an audit trail only; write them off the hot path
+playback_token_buffer = WriteBehindBuffer(
+    "playback_tokens",
+    max_batch=1000,
+    flush_interval=0.5,
+    max_pending=50000
+)
+
+# ======================= PLAYBACK TOKEN VERIFICATION =======================
+
+class PlaybackTokenError(Exception):
+    """Raised when a playback token fails local verification"""
+
+    def __init__(self, reason: str, status_code: int = 401):
+        super().__init__(reason)
+        self.reason = reason
+        self.status_code = status_code
+
+def load_playback_signing_keys() -> dict:
+    """Parse PLAYBACK_SIGNING_KEYS ("kid:secret,kid:secret") into a kid -> secret map"""
+    keys = {}
+    for entry in os.environ.get('PLAYBACK_SIGNING_KEYS', '').split(','):
+        kid, _, secret = entry.strip().partition(':')
+        if kid and secret:
+            keys[kid] = secret
+    if not keys:
+        keys['default'] = os.environ.get('PLAYBACK_JWT_SECRET', 'change-me')
+    return keys
+
+class PlaybackTokenSigner:
+    """Issues and verifies stream-scoped HS256 playback tokens"""
+
+    def __init__(self, keys: dict, active_kid: Optional[str] = None, ttl_seconds: int = 600, leeway: int = 5):
+        self.keys = keys
+        self.active_kid = active_kid if active_kid in keys else next(iter(keys))
+        self.ttl_seconds = ttl_seconds
+        self.leeway = leeway
+
+    def issue(self, user_id: str, stream_id: str, ticket_id: str, ttl_seconds: Optional[int] = None):
+        issued_at = datetime.now(timezone.utc)
+        expires_at = issued_at + timedelta(seconds=ttl_seconds or self.ttl_seconds)
+        payload = {
+            "sub": user_id,
+            "stream_id": stream_id,
+            "ticket_id": ticket_id,
+            "scope": f"stream:{stream_id}",
+            "iat": int(issued_at.timestamp()),
+            "exp": int(expires_at.timestamp())
+        }
+        token = jwt.encode(payload, self.keys[self.active_kid], algorithm='HS256', headers={"kid": self.active_kid})
+        return token, expires_at
+
+    def verify(self, token: str, stream_id: Optional[str] = None) -> dict:
+        try:
+            kid = jwt.get_unverified_header(token).get("kid", "default")
+        except jwt.PyJWTError:
+            raise PlaybackTokenError("Malformed token")
+        secret = self.keys.get(kid)
+        if secret is None:
+            raise PlaybackTokenError("Unknown signing key")
+        try:
+            claims = jwt.decode(
+                token,
+                secret,
+                algorithms=['HS256'],
+                leeway=self.leeway,
+                options={"require": ["exp", "iat", "sub", "scope"]}
+            )
+        except jwt.ExpiredSignatureError:
+            raise PlaybackTokenError("Token expired")
+        except jwt.PyJWTError:
+            raise PlaybackTokenError("Invalid token")
+        
+        if stream_id is not None and claims["scope"] != f"stream:{stream_id}":
+            raise PlaybackTokenError("Token not valid for this stream", status_code=403)
+        if revoked_tickets.might_contain(claims.get("ticket_id", "")):
+            raise PlaybackTokenError("Ticket revoked", status_code=403)
+        return claims
+
+class RevokedTicketSet:
+    """Periodically rebuilt Bloom filter of revoked stream ticket ids"""
+
+    def __init__(self, error_rate: float = 0.0001, headroom: int = 10000):
+        self.error_rate = error_rate
+        self.headroom = headroom
+        self._filter = BloomFilter(headroom, error_rate)
+        self.refreshed_at = None
+
+    def might_contain(self, ticket_id: str) -> bool:
+        return self._filter.count > 0 and ticket_id in self._filter
+
+    def add(self, ticket_id: str):
+        self._filter.add(ticket_id)
+
+    async def refresh(self):
+        ticket_ids = [
+            doc["ticket_id"]
+            async for doc in db.revoked_stream_tickets.find({}, projection={"_id": 0, "ticket_id": 1}).batch_size(10000)
+        ]
+        fresh = BloomFilter(len(ticket_ids) + self.headroom, self.error_rate)
+        for ticket_id in ticket_ids:
+            fresh.add(ticket_id)
+        self._filter = fresh
+        self.refreshed_at = datetime.now(timezone.utc)
+
+playback_token_signer = PlaybackTokenSigner(
+    load_playback_signing_keys(),
+    active_kid=os.environ.get('PLAYBACK_ACTIVE_KID'),
+    ttl_seconds=int(os.environ.get('PLAYBACK_TOKEN_TTL_SECONDS', '600'))
+)
+revoked_tickets = RevokedTicketSet(error_rate=float(os.environ.get('REVOCATION_FILTER_ERROR_RATE', '0.0001')))
+revocation_refresh_job = PeriodicJob(
+    "revocation_refresh",
+    float(os.environ.get('REVOCATION_REFRESH_SECONDS', '30')),
+    revoked_tickets.refresh
+)
+
+def verify_playback_token(token: str, stream_id: Optional[str] = None) -> dict:
+    """Check a playback token's signature, expiry, stream scope and revocation in memory"""
+    return playback_token_signer.verify(token, stream_id)
+
+# ======================= PRE-SALE TOKEN ISSUANCE =======================
+
+class AdmissionRejected(Exception):
+    """Raised when the admission queue is too long to wait in"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"retry after {retry_after}s")
+        self.retry_after = retry_after
+
+class AdmissionGate:
+    """Token-bucket admission (GCRA): requests beyond the burst wait for a slot"""
+
+    def __init__(self, rate: float, burst: int, max_wait: float):
+        self.interval = 1.0 / rate
+        self.tolerance = self.interval * burst
+        self.max_wait = max_wait
+        self._tat = 0.0  # theoretical arrival time of the next request
+        self.admitted = 0
+        self.delayed = 0
+        self.rejected = 0
+
+    async def acquire(self):
+        now = time.monotonic()
+        tat = max(self._tat, now)
+        wait = tat - self.tolerance - now
+        if wait > self.max_wait:
+            self.rejected += 1
+            raise AdmissionRejected(max(int(math.ceil(wait)), 1))
+        self._tat = tat + self.interval
+        self.admitted += 1
+        if wait > 0:
+            self.delayed += 1
+            await asyncio.sleep(wait)
+
+class PreissuedTokenStore:
+    """Playback tokens issued in bulk shortly before a stream starts, keyed by user"""
+
+    def __init__(self, lead_minutes: float, fetch_jitter_seconds: float):
+        self.lead_minutes = lead_minutes
+        self.fetch_jitter_seconds = fetch_jitter_seconds
+        self._tokens = {}  # stream_id -> {user_id: {"token", "expires_at", "ticket_id", "session_id"}}
+
+    async def get(self, stream_id: str, user_id: str, session_id: Optional[str]) -> Optional[dict]:
+        preissued = self._tokens.get(stream_id, {}).get(user_id)
+        if preissued is None or not checkout_session_matches(preissued["session_id"], session_id):
+            return None
+        if revoked_tickets.might_contain(preissued["ticket_id"]):
+            return None
+        remaining = (preissued["expires_at"] - datetime.now(timezone.utc)).total_seconds()
+        if remaining < playback_token_signer.ttl_seconds / 2:
+            await self._sign(stream_id, user_id, preissued)
+        return preissued
+
+    @staticmethod
+    async def _sign(stream_id: str, user_id: str, preissued: dict, ttl_seconds: Optional[int] = None):
+        token, expires_at = playback_token_signer.issue(user_id, stream_id, preissued["ticket_id"], ttl_seconds)
+        preissued.update(token=token, expires_at=expires_at)
+        await playback_token_buffer.put(prepare_for_mongo(PlaybackToken(
+            stream_ticket_id=preissued["ticket_id"],
+            token=token,
+            expires_at=expires_at
+        ).dict()))
+
+    def retry_after(self, stream_id: str) -> Optional[int]:
+        """Seconds until this stream's tokens are issued, plus jitter; None if that's not pending"""
+        stream = stream_scheduler.stream(stream_id)
+        if stream is None or stream.get("status") != "scheduled" or stream_id in self._tokens:
+            return None
+        issue_at = parse_mongo_datetime(stream["start_time"]) - timedelta(minutes=self.lead_minutes)
+        wait = (issue_at - datetime.now(timezone.utc)).total_seconds()
+        return max(int(wait + random.uniform(0, self.fetch_jitter_seconds)), 1)
+
+    def forget_stream(self, stream_id: str):
+        self._tokens.pop(stream_id, None)
+
+    async def issue_for_stream(self, stream_id: str) -> int:
+        await entitlement_cache.warm(stream_id)
+        tokens = self._tokens.setdefault(stream_id, {})
+        ttl_seconds = int(self.lead_minutes * 60) + playback_token_signer.ttl_seconds
+        issued = 0
+        for user_id, entitlement in entitlement_cache.for_stream(stream_id):
+            existing = tokens.get(user_id)
+            if existing is not None and existing["ticket_id"] == entitlement["ticket_id"]:
+                continue
+            if revoked_tickets.might_contain(entitlement["ticket_id"]) or not entitlement["session_id"]:
+                continue
+            tokens[user_id] = {"ticket_id": entitlement["ticket_id"], "session_id": entitlement["session_id"]}
+            await self._sign(stream_id, user_id, tokens[user_id], ttl_seconds)
+            issued += 1
+            # Signing is CPU-bound; yield so large audiences don't stall the loop
+            if issued % 500 == 0:
+                await asyncio.sleep(0)
+        return issued
+
+    async def issue_upcoming(self):
+        """Issue tokens for streams starting within the lead window (and top up late purchases)"""
+        now = datetime.now(timezone.utc)
+        horizon = now + timedelta(minutes=self.lead_minutes)
+        for stream in stream_scheduler.streams():
+            if stream.get("status") != "scheduled" or not stream.get("start_time"):
+                continue
+            start_time = parse_mongo_datetime(stream["start_time"])
+            if start_time > horizon:
+                continue
+            issued = await self.issue_for_stream(stream["id"])
+            if issued:
+                logger.info(f"Pre-issued {issued} playback tokens for stream {stream['id']}")
+
+preissued_tokens = PreissuedTokenStore(
+    lead_minutes=float(os.environ.get('PRESALE_TOKEN_LEAD_MINUTES', '10')),
+    fetch_jitter_seconds=float(os.environ.get('PRESALE_TOKEN_FETCH_JITTER_SECONDS', '120'))
+)
+preissue_job = PeriodicJob(
+    "playback_token_preissue",
+    float(os.environ.get('PRESALE_TOKEN_INTERVAL_SECONDS', '30')),
+    preissued_tokens.issue_upcoming
+)
+playback_admission = AdmissionGate(
+    rate=float(os.environ.get('PLAYBACK_ADMISSION_RATE', '500')),
+    burst=int(os.environ.get('PLAYBACK_ADMISSION_BURST', '200')),
+    max_wait=float(os.environ.get('PLAYBACK_ADMISSION_MAX_WAIT_SECONDS', '5'))
+)
+
+# ======================= STREAM SCHEDULE & FEED =======================
+
+def mock_streams() -> List[dict]:
+    """Shown while no real streams are scheduled; ids are fixed so clients can link to them"""
+    now = datetime.now(timezone.utc)
+    return [
+        {
+            "id": "7f0c6a1e-3d2b-4c8e-9a51-0b6f2e4d8c11",
+            "title": "Arctic Monkeys - Live from Studio",
+            "description": "Exclusive live performance from the legendary indie rock band",
+            "organizer_id": "2b8e5d94-6a1f-4e37-8c02-5d9a7f3b1e60",
+            "start_time": now - timedelta(hours=1),
+            "status": "live",
+            "price": 19.99,
+            "ticket_type": "pay_per_view",
+            "thumbnail_url": "https://images.unsplash.com/photo-1493225457124-a3eb161ffa5f?w=400&h=250&fit=crop",
+            "quality": "HD",
+            "features": ["Multi-camera", "Live Chat", "Backstage Access"],
+            "created_at": now
+        },
+        {
+            "id": "c4d91b37-8e62-4f0a-b5c3-9e1a6d2f7b84",
+            "title": "Foo Fighters - World Tour Finale",
+            "description": "The epic finale of the world tour with special guests",
+            "organizer_id": "9a3f7c25-1b4e-4d86-a0e9-6c2b8f5d3a17",
+            "start_time": now + timedelta(days=5),
+            "status": "scheduled",
+            "price": 24.99,
+            "ticket_type": "vip_access",
+            "thumbnail_url": "https://images.unsplash.com/photo-1501386761578-eac5c94b800a?w=400&h=250&fit=crop",
+            "quality": "4K",
+            "features": ["4K Stream", "Backstage Pass", "Meet & Greet", "Exclusive Merch"],
+            "created_at": now
+        }
+    ]
+
+class StreamFeed:
+    """Pre-serialized JSON body of the live-now and upcoming streams"""
+
+    def __init__(self, upcoming_limit: int = 50):
+        self.upcoming_limit = upcoming_limit
+        self.body = b"[]"
+        self.built_at = time.monotonic()
+        self.rebuild({})
+
+    def age(self) -> float:
+        return time.monotonic() - self.built_at
+
+    def rebuild(self, streams: dict):
+        dated = [stream for stream in streams.values() if stream.get("start_time")]
+        live = [stream for stream in dated if stream.get("status") == "live"]
+        upcoming = [stream for stream in dated if stream.get("status") == "scheduled"]
+        live.sort(key=lambda stream: parse_mongo_datetime(stream["start_time"]))
+        upcoming.sort(key=lambda stream: parse_mongo_datetime(stream["start_time"]))
+        feed = live + upcoming[:self.upcoming_limit]
+        if not feed:
+            feed = mock_streams()
+        
+        serialized = []
+        for stream in feed:
+            try:
+                serialized.append(jsonable_encoder(StreamEvent(**stream)))
+            except Exception as e:
+                logger.error(f"Skipping malformed stream {stream.get('id')} in feed: {e}")
+        self.body = json.dumps(serialized).encode()
+        self.built_at = time.monotonic()
+
+class StreamStatusScheduler:
+    """Flips stream status scheduled -> live -> ended at start_time / end_time"""
+
+    def __init__(self, feed: StreamFeed, max_sleep: float = 60.0):
+        self.feed = feed
+        self.max_sleep = max_sleep
+        self._streams = {}  # stream_id -> stream document (scheduled or live only)
+        self._heap = []  # (due timestamp, seq, stream_id, from_status, to_status)
+        self._seq = 0
+        self._wakeup = None
+        self._stopped = False
+        self._task = None
+        self.transitions = 0
+
+    @staticmethod
+    def _next_transition(stream: dict):
+        if stream.get("status") == "scheduled" and stream.get("start_time"):
+            return parse_mongo_datetime(stream["start_time"]).timestamp(), "scheduled", "live"
+        if stream.get("status") == "live" and stream.get("end_time"):
+            return parse_mongo_datetime(stream["end_time"]).timestamp(), "live", "ended"
+        return None
+
+    def _schedule(self, stream: dict):
+        transition = self._next_transition(stream)
+        if transition is None:
+            return
+        due, from_status, to_status = transition
+        self._seq += 1
+        heapq.heappush(self._heap, (due, self._seq, stream["id"], from_status, to_status))
+
+    def stream(self, stream_id: str) -> Optional[dict]:
+        return self._streams.get(stream_id)
+
+    def streams(self) -> List[dict]:
+        return list(self._streams.values())
+
+    def add(self, stream: dict):
+        """Track a newly created or updated stream and refresh the feed"""
+        if stream.get("status") in ("scheduled", "live"):
+            self._streams[stream["id"]] = stream
+            self._schedule(stream)
+        else:
+            self._streams.pop(stream["id"], None)
+        self.feed.rebuild(self._streams)
+        self._notify()
+
+    async def reload(self):
+        """Rebuild the schedule from the database (picks up streams created on other workers)"""
+        streams = await db.stream_events.find(
+            {"status": {"$in": ["scheduled", "live"]}},
+            projection={"_id": 0}
+        ).to_list(None)
+        self._streams = {stream["id"]: stream for stream in streams}
+        self._heap = []
+        for stream in streams:
+            self._schedule(stream)
+        self.feed.rebuild(self._streams)
+        self._notify()
+
+    async def _apply_due(self):
+        now = time.time()
+        changed = False
+        while self._heap and self._heap[0][0] <= now:
+            due, _, stream_id, from_status, to_status = heapq.heappop(self._heap)
+            stream = self._streams.get(stream_id)
+            # Skip entries superseded by a reload or a rescheduled time
+            if stream is None or self._next_transition(stream) != (due, from_status, to_status):
+                continue
+            
+            result = await db.stream_events.update_one(
+                {"id": stream_id, "status": from_status},
+                {"$set": {"status": to_status}}
+            )
+            stream["status"] = to_status
+            changed = True
+            # Only the worker whose update won announces it; the local cleanup below runs on every worker
+            if result.modified_count == 1:
+                self.transitions += 1
+                live_hub.publish(stream_topic(stream_id), {"type": "status", "status": to_status})
+                logger.info(f"Stream {stream_id} is now {to_status}")
+            
+            if to_status == "ended":
+                del self._streams[stream_id]
+                chat_hub.clear_history(chat_topic(stream_id))
+                entitlement_cache.forget_stream(stream_id)
+                preissued_tokens.forget_stream(stream_id)
+                viewer_sketches.end_stream(stream_id)
+                watch_sessions.end_stream(stream_id, datetime.now(timezone.utc))
+            else:
+                self._schedule(stream)
+        if changed:
+            self.feed.rebuild(self._streams)
+
+    def _notify(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _sleep_seconds(self) -> float:
+        if not self._heap:
+            return self.max_sleep
+        return min(max(self._heap[0][0] - time.time(), 0), self.max_sleep)
+
+    async def _run(self):
+        while not self._stopped:
+            self._wakeup.clear()
+            try:
+                await self._apply_due()
+            except Exception as e:
+                logger.error(f"Stream status scheduler failed: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self._sleep_seconds())
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._stopped = False
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stopped = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+stream_feed = StreamFeed(upcoming_limit=int(os.environ.get('STREAM_FEED_UPCOMING_LIMIT', '50')))
+stream_scheduler = StreamStatusScheduler(stream_feed)
+stream_schedule_reload_job = PeriodicJob(
+    "stream_schedule_reload",
+    float(os.environ.get('STREAM_SCHEDULE_RELOAD_SECONDS', '60')),
+    stream_scheduler.reload
+)
+
+# ======================= METRICS =======================
+
+metrics.gauge("stream_analytics_buffer", lambda: dict(stream_analytics_buffer.stats))
+metrics.gauge("playback_token_buffer", lambda: dict(playback_token_buffer.stats))
+metrics.gauge("entitlement_cache", lambda: dict(entitlement_cache.stats))
+metrics.gauge("playback_admission", lambda: {
+    "admitted": playback_admission.admitted,
+    "delayed": playback_admission.delayed,
+    "rejected": playback_admission.rejected
+})
+
+# ======================= PAYMENT GATEWAY =======================
+
+class PaymentGatewayTimeout(Exception):
+    """Raised when a payment provider call exceeds its deadline"""
+
+class StripeGateway:
+    """Async access to Stripe for every payment endpoint"""
+
+    def __init__(self, api_key: str, timeout: float = 10.0, max_concurrency: int = 32, max_network_retries: int = 1,
+                 api_base: Optional[str] = None):
+        self.timeout = timeout
+        self._http_client = stripe.HTTPXClient(timeout=timeout)
+        self.client = stripe.StripeClient(
+            api_key,
+            http_client=self._http_client,
+            max_network_retries=max_network_retries,
+            # Point at a local stand-in such as stripe-mock for development and tests
+            base_addresses={"api": api_base} if api_base else {}
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        # Sized like the semaphore so abandoned (timed out) helper calls still count against the limit
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency,
+                                                               thread_name_prefix="stripe-checkout")
+        self._thread_state = threading.local()
+        self._helper_loops = []
+        self.in_flight = 0
+
+    async def _limited(self, operation: str, call):
+        queued_at = time.perf_counter()
+        async with self._semaphore:
+            metrics.observe("stripe.queue_wait", time.perf_counter() - queued_at)
+            self.in_flight += 1
+            try:
+                return await call
+            finally:
+                self.in_flight -= 1
+
+    async def call(self, operation: str, fn, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await asyncio.wait_for(self._limited(operation, fn(*args, **kwargs)), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            metrics.increment(f"stripe.{operation}.timeouts")
+            logger.error(f"Stripe {operation} timed out after {self.timeout}s")
+            raise PaymentGatewayTimeout(operation)
+        except Exception:
+            metrics.increment(f"stripe.{operation}.errors")
+            raise
+        finally:
+            metrics.observe(f"stripe.{operation}", time.perf_counter() - started)
+
+    async def create_checkout_session(self, params: dict):
+        return await self.call("checkout.sessions.create", self.client.v1.checkout.sessions.create_async, params=params)
+
+    async def retrieve_checkout_session(self, session_id: str):
+        return await self.call("checkout.sessions.retrieve", self.client.v1.checkout.sessions.retrieve_async, session_id)
+
+    async def list_checkout_sessions(self, params: dict):
+        return await self.call("checkout.sessions.list", self.client.v1.checkout.sessions.list_async, params=params)
+
+    def _helper_loop(self) -> asyncio.AbstractEventLoop:
+        loop = getattr(self._thread_state, "loop", None)
+        if loop is None:
+            loop = self._thread_state.loop = asyncio.new_event_loop()
+            self._helper_loops.append(loop)
+        return loop
+
+    async def run_helper(self, fn, *args):
+        """Run fn on a pool thread, driving its result on that thread's event loop if it is a coroutine"""
+        def run():
+            result = fn(*args)
+            return self._helper_loop().run_until_complete(result) if asyncio.iscoroutine(result) else result
+
+        return await asyncio.get_running_loop().run_in_executor(self._executor, run)
+
+    async def checkout(self, stripe_checkout: StripeCheckout, method: str, *args):
+        """Run a StripeCheckout helper call on the thread pool under the same limit, deadline and metrics"""
+        return await self.call(method, self.run_helper, getattr(stripe_checkout, method), *args)
+
+    async def close(self):
+        await self._http_client.close_async()
+        await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown)
+        for loop in self._helper_loops:
+            loop.close()
+
+stripe_gateway = StripeGateway(
+    stripe.api_key,
+    timeout=float(os.environ.get('STRIPE_TIMEOUT_SECONDS', '10')),
+    max_concurrency=int(os.environ.get('STRIPE_MAX_CONCURRENCY', '32')),
+    max_network_retries=int(os.environ.get('STRIPE_MAX_NETWORK_RETRIES', '1')),
+    api_base=os.environ.get('STRIPE_API_BASE')
+)
+metrics.gauge("stripe_in_flight", lambda: stripe_gateway.in_flight)
+metrics.gauge("stripe_checkout_clients", lambda: len(stripe_checkout_clients))
+
+# ======================= STRIPE WEBHOOK QUEUE =======================
+
+def checkout_completed_operations(event: dict) -> List[tuple]:
+    """Writes for checkout.session.completed as (collection name, operation) pairs"""
+    operations = [("payment_transactions", UpdateOne(
+        {"session_id": event["session_id"]},
+        {"$set": {
+            "payment_status": event["payment_status"],
+            "status": "completed",
+            "checkout_status": "complete",
+            "updated_at": datetime.now(timezone.utc).isoformat()
+        }}
+    ))]
+    # Delayed payment methods complete the session unpaid; effects wait for the money
+    if event["payment_status"] in SETTLED_PAYMENT_STATUSES:
+        operations.insert(0, payment_completed_outbox_operation(event["session_id"], event.get("metadata") or {}))
+    return operations
+
+def payment_completed_outbox_operation(session_id: str, metadata: dict) -> tuple:
+    """Upsert of the payment.completed outbox entry; keyed by session so every path emits it once"""
+    message = outbox_message("checkout_session", session_id, "payment.completed",
+                             {"session_id": session_id, "metadata": metadata})
+    message["id"] = f"payment.completed:{session_id}"
+    return ("outbox_events", UpdateOne({"id": message["id"]}, {"$setOnInsert": message}, upsert=True))
+
+# Event types without a handler are acknowledged and marked processed
+STRIPE_WEBHOOK_HANDLERS = {
+    "checkout.session.completed": checkout_completed_operations
+}
+
+stripe_webhook_queue = StripeWebhookQueue(
+    STRIPE_WEBHOOK_HANDLERS,
+    workers=int(os.environ.get('STRIPE_WEBHOOK_WORKERS', '2')),
+    batch_size=int(os.environ.get('STRIPE_WEBHOOK_BATCH_SIZE', '100')),
+    max_attempts=int(os.environ.get('STRIPE_WEBHOOK_MAX_ATTEMPTS', '8'))
+)
+metrics.gauge("stripe_webhook_queue", lambda: dict(stripe_webhook_queue.stats))
+
+# ======================= PAYMENT RECONCILIATION =======================
+
+class StripeReconciler:
+    """Converges pending payments with Stripe when webhooks were missed"""
+
+    STATE_ID = "stripe_checkout_sessions"
+
+    def __init__(self, lookback_hours: float = 25.0, page_size: int = 100, lease_seconds: float = 600.0):
+        self.lookback_hours = lookback_hours
+        self.page_size = page_size
+        self.lease_seconds = lease_seconds
+
+    async def _acquire(self) -> Optional[dict]:
+        now = datetime.now(timezone.utc)
+        try:
+            return await db.reconciliation_state.find_one_and_update(
+                {"_id": self.STATE_ID, "$or": [{"lease_until": {"$lt": now}}, {"lease_until": None}]},
+                {"$set": {"lease_until": now + timedelta(seconds=self.lease_seconds), "leased_by": WORKER_ID}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Another worker holds the lease
+            return None
+
+    @staticmethod
+    def _transaction_update(session, transaction: dict):
+        if session.payment_status == "paid" and transaction.get("payment_status") != "paid":
+            return {"payment_status": "paid", "status": "completed", "checkout_status": "complete"}
+        if session.status == "expired" and transaction.get("checkout_status") != "expired" \
+                and transaction.get("payment_status") != "paid":
+            return {"checkout_status": "expired", "status": "expired"}
+        return None
+
+    @staticmethod
+    def _ticket_update(session, ticket: dict):
+        if session.payment_status == "paid" and ticket.get("payment_status") != "paid":
+            return {"payment_status": "paid", "stripe_payment_intent_id": session.payment_intent}
+        if session.status == "expired" and ticket.get("payment_status") == "pending":
+            return {"payment_status": "expired"}
+        return None
+
+    async def reconcile_page(self, sessions: list) -> dict:
+        session_ids = [session.id for session in sessions]
+        transactions = await db.payment_transactions.find(
+            {"session_id": {"$in": session_ids}},
+            projection={"_id": 0, "session_id": 1, "payment_status": 1, "checkout_status": 1, "metadata": 1}
+        ).to_list(None)
+        tickets = await db.stream_tickets.find(
+            {"stripe_session_id": {"$in": session_ids}},
+            projection={"_id": 0, "id": 1, "stripe_session_id": 1, "payment_status": 1}
+        ).to_list(None)
+        transactions_by_session = {transaction["session_id"]: transaction for transaction in transactions}
+        tickets_by_session = {}
+        for ticket in tickets:
+            tickets_by_session.setdefault(ticket["stripe_session_id"], []).append(ticket)
+        
+        now = datetime.now(timezone.utc).isoformat()
+        transaction_ops, ticket_ops, outbox_ops = [], [], []
+        expired_ticket_ids = []
+        for session in sessions:
+            transaction = transactions_by_session.get(session.id)
+            missed_payment = session.payment_status == "paid" and (
+                (transaction is not None and transaction.get("payment_status") != "paid")
+                or any(ticket.get("payment_status") != "paid" for ticket in tickets_by_session.get(session.id, ()))
+            )
+            if missed_payment:
+                metadata = dict(session.metadata or {}) or (transaction or {}).get("metadata") or {}
+                outbox_ops.append(payment_completed_outbox_operation(session.id, metadata)[1])
+            if transaction is not None:
+                update = self._transaction_update(session, transaction)
+                if update:
+                    transaction_ops.append(UpdateOne(
+                        {"session_id": session.id, "payment_status": {"$ne": "paid"}},
+                        {"$set": {**update, "updated_at": now, "reconciled_at": now}}
+                    ))
+            for ticket in tickets_by_session.get(session.id, ()):
+                update = self._ticket_update(session, ticket)
+                if update:
+                    ticket_ops.append(UpdateOne(
+                        {"id": ticket["id"], "payment_status": {"$ne": "paid"}},
+                        {"$set": {**update, "reconciled_at": now}}
+                    ))
+                    if update["payment_status"] == "expired":
+                        expired_ticket_ids.append(ticket["id"])
+        
+        fixed = {"transactions": 0, "tickets": 0}
+        if outbox_ops:
+            await db.outbox_events.bulk_write(outbox_ops, ordered=False)
+        if transaction_ops:
+            result = await db.payment_transactions.bulk_write(transaction_ops, ordered=False)
+            fixed["transactions"] = result.modified_count
+        if ticket_ops:
+            result = await db.stream_tickets.bulk_write(ticket_ops, ordered=False)
+            fixed["tickets"] = result.modified_count
+        # Expired tickets never grant access; drop them here, other workers re-read on their next lookup
+        for ticket_id in expired_ticket_ids:
+            entitlement_cache.revoke(ticket_id)
+        return fixed
+
+    async def run(self):
+        state = await self._acquire()
+        if state is None:
+            return
+        
+        floor = int((datetime.now(timezone.utc) - timedelta(hours=self.lookback_hours)).timestamp())
+        watermark = max(state.get("watermark") or floor, floor)
+        next_watermark = None  # oldest created time still open, else newest seen + 1
+        newest = watermark
+        scanned = 0
+        totals = {"transactions": 0, "tickets": 0}
+        completed = False
+        try:
+            params = {"created": {"gte": watermark}, "limit": self.page_size}
+            while True:
+                page = await stripe_gateway.list_checkout_sessions(params)
+                sessions = list(page.data)
+                if not sessions:
+                    break
+                scanned += len(sessions)
+                for session in sessions:
+                    newest = max(newest, session.created + 1)
+                    if session.status == "open":
+                        next_watermark = session.created if next_watermark is None else min(next_watermark, session.created)
+                fixed = await self.reconcile_page(sessions)
+                for key, count in fixed.items():
+                    totals[key] += count
+                if not page.has_more:
+                    break
+                params = {**params, "starting_after": sessions[-1].id}
+            completed = True
+        finally:
+            update = {"lease_until": None, "last_run_at": datetime.now(timezone.utc)}
+            # Sessions are listed newest first, so a partial run must not move the watermark
+            if completed and scanned:
+                update["watermark"] = next_watermark if next_watermark is not None else newest
+            await db.reconciliation_state.update_one({"_id": self.STATE_ID}, {"$set": update})
+        
+        metrics.increment("reconciliation.runs")
+        metrics.increment("reconciliation.sessions_scanned", scanned)
+        metrics.increment("reconciliation.transactions_fixed", totals["transactions"])
+        metrics.increment("reconciliation.tickets_fixed", totals["tickets"])
+        if totals["transactions"] or totals["tickets"]:
+            logger.info(f"Reconciled {totals['transactions']} transactions and {totals['tickets']} stream tickets "
+                        f"from {scanned} Stripe sessions")
+
+stripe_reconciler = StripeReconciler(
+    lookback_hours=float(os.environ.get('STRIPE_RECONCILE_LOOKBACK_HOURS', '25'))
+)
+stripe_reconcile_job = PeriodicJob(
+    "stripe_reconciliation",
+    float(os.environ.get('STRIPE_RECONCILE_INTERVAL_SECONDS', '300')),
+    stripe_reconciler.run
+)
+
+# ======================= IDEMPOTENCY KEYS =======================
+
+idempotency_store = IdempotencyStore(
+    ttl_hours=float(os.environ.get('IDEMPOTENCY_KEY_TTL_HOURS', '24')),
+    lru_size=int(os.environ.get('IDEMPOTENCY_LRU_SIZE', '10000'))
+)
+
+# ======================= TRANSACTIONAL OUTBOX =======================
+
+# --- Side effects ---
+
+async def record_crm_transaction(transaction: dict):
+    """Insert a CRM transaction once (keyed by id) and push it to dashboards"""
+    result = await db.crm_transactions.update_one(
+        {"id": transaction["id"]}, {"$setOnInsert": transaction}, upsert=True
+    )
+    if result.upserted_id is not None:
+        if transaction.get("status") == "completed":
+            await credit_promoter_ledger(transaction)
+        invalidate_promoter_cache(transaction["promoter_id"])
+        publish_transaction_delta(transaction)
+
+async def upsert_stream_contact(promoter_id: str, user_id: str, stream_title: str,
+                                purchases: int = 0, spent: float = 0.0):
+    """Create or touch the promoter's contact for a viewer, keeping the audience summary in step"""
+    now = datetime.now(timezone.utc).isoformat()
+    update = {
+        "$setOnInsert": {
+            "id": str(uuid.uuid4()),
+            "promoter_id": promoter_id,
+            "user_id": user_id,
+            "name": user_id,
+            "email": "",
+            "engagement_score": 0.0,
+            "segments": ["new_customer"],
+            "created_at": now
+        },
+        "$set": {"last_event": stream_title, "last_interaction": now}
+    }
+    increments = {field: value for field, value in (("purchase_history", purchases), ("total_spent", spent)) if value}
+    if increments:
+        update["$inc"] = increments
+    await begin_audience_summary_writes([promoter_id])
+    try:
+        before = await db.crm_contacts.find_one_and_update(
+            {"promoter_id": promoter_id, "user_id": user_id},
+            update,
+            upsert=True,
+            projection={"_id": 0},
+            return_document=ReturnDocument.BEFORE
+        )
+    except Exception:
+        await end_audience_summary_writes([promoter_id])
+        raise
+    if before is None:
+        after = {**update["$setOnInsert"], "purchase_history": purchases, "total_spent": spent}
+    else:
+        after = {
+            **before,
+            "purchase_history": (before.get("purchase_history") or 0) + purchases,
+            "total_spent": (before.get("total_spent") or 0) + spent
+        }
+    await apply_audience_summary_change(before, after, [promoter_id])
+    invalidate_promoter_cache(promoter_id)
+
+async def send_notification(source_id: str, recipient_id: str, kind: str, title: str, body: str):
+    """Queue an in-app notification; keyed by source so redelivery doesn't duplicate it"""
+    await db.notifications.update_one(
+        {"source_id": source_id},
+        {"$setOnInsert": {
+            "id": str(uuid.uuid4()),
+            "source_id": source_id,
+            "recipient_id": recipient_id,
+            "type": kind,
+            "title": title,
+            "body": body,
+            "read": False,
+            "created_at": datetime.now(timezone.utc).isoformat()
+        }},
+        upsert=True
+    )
+
+# --- Handlers: topic -> list of (effect name, effect) ---
+
+async def stream_purchase_created_effects(payload: dict) -> list:
+    ticket, stream = payload["ticket"], payload["stream"]
+    if not stream.get("organizer_id"):
+        return []
+    transaction = prepare_for_mongo(CRMTransaction(
+        promoter_id=stream["organizer_id"],
+        event_id=stream["id"],
+        type="stream_view",
+        amount=ticket["price"],
+        status="pending",
+        stripe_payment_intent_id=ticket.get("stripe_payment_intent_id"),
+        description=f"Stream access: {stream['title']}",
+        metadata={"ticket_id": ticket["id"], "user_id": ticket["user_id"]}
+    ).dict())
+    transaction["id"] = f"stream_ticket:{ticket['id']}"
+    return [
+        ("crm_transaction", lambda: record_crm_transaction(transaction)),
+        ("contact", lambda: upsert_stream_contact(stream["organizer_id"], ticket["user_id"], stream["title"]))
+    ]
+
+async def donation_created_effects(payload: dict) -> list:
+    transaction = payload["transaction"]
+    return [("notification", lambda: send_notification(
+        f"donation.created:{transaction['id']}", "platform", "donation_started",
+        "Donation checkout started", f"${transaction['amount']:.2f} donation checkout {transaction['session_id']}"
+    ))]
+
+async def mark_stream_ticket_paid(ticket: dict):
+    await db.stream_tickets.update_one({"id": ticket["id"]}, {"$set": {"payment_status": "paid"}})
+    # Grants access on this worker right away; others pick it up on their next lookup or warm
+    entitlement_cache.put({**ticket, "payment_status": "paid"})
+
+async def payment_completed_effects(payload: dict) -> list:
+    session_id, metadata = payload["session_id"], payload.get("metadata") or {}
+    if metadata.get("type") == "donation":
+        return [("notification", lambda: send_notification(
+            f"payment.completed:{session_id}", "platform", "donation_received",
+            "Donation received", f"${metadata.get('amount', '0')} donation completed"
+        ))]
+    
+    ticket = await db.stream_tickets.find_one({"stripe_session_id": session_id}, projection={"_id": 0})
+    if ticket is None:
+        return []
+    stream = await db.stream_events.find_one(
+        {"id": ticket["stream_event_id"]}, projection={"_id": 0, "id": 1, "title": 1, "organizer_id": 1}
+    ) or {"id": ticket["stream_event_id"], "title": "", "organizer_id": None}
+    effects = [
+        ("ticket_paid", lambda: mark_stream_ticket_paid(ticket))
+    ]
+    if stream.get("organizer_id"):
+        # Completes the pending transaction written at purchase time
+        sale = SaleRecord(
+            id=f"stream_ticket:{ticket['id']}",
+            promoter_id=stream["organizer_id"],
+            event_id=stream["id"],
+            type="stream_view",
+            amount=ticket["price"],
+            stripe_payment_intent_id=ticket.get("stripe_payment_intent_id"),
+            description=f"Stream access: {stream['title']}",
+            metadata={"ticket_id": ticket["id"]},
+            user_id=ticket["user_id"],
+            event_name=stream["title"]
+        )
+        effects += [
+            ("sale", lambda: record_sales([sale])),
+            ("notification", lambda: send_notification(
+                f"payment.completed:{session_id}", stream["organizer_id"], "ticket_sold",
+                "New stream ticket sold", f"{ticket['user_id']} bought access to {stream['title']}"
+            ))
+        ]
+    return effects
+
+OUTBOX_HANDLERS = {
+    "stream_purchase.created": stream_purchase_created_effects,
+    "donation.created": donation_created_effects,
+    "payment.completed": payment_completed_effects
+}
+
+outbox_worker = OutboxWorker(
+    OUTBOX_HANDLERS,
+    workers=int(os.environ.get('OUTBOX_WORKERS', '2')),
+    batch_size=int(os.environ.get('OUTBOX_BATCH_SIZE', '100')),
+    max_attempts=int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '10'))
+)
+outbox = Outbox(outbox_worker)
+metrics.gauge("outbox", lambda: dict(outbox_worker.stats))
+
+# ======================= SALES RECORDING =======================
+# A completed sale touches the transaction, its event's counters, the buyer's
+# contact, the audience summary, the ledger and the daily rollup. Sales are
+# recorded in batches with one bulk_write per collection; the transaction id
+# is the idempotency key, so only sales whose transaction this call claimed
+# move any counters, and the transaction is only marked completed once they
+# have moved.
+
+TICKET_TRANSACTION_TYPES = ("ticket_sale", "stream_view")
+SALES_IMPORT_CHUNK_SIZE = int(os.environ.get('SALES_IMPORT_CHUNK_SIZE', '1000'))
+SALES_IMPORT_MAX_ROWS = int(os.environ.get('SALES_IMPORT_MAX_ROWS', '10000'))
+# Batches larger than this are imports; they skip per-transaction live deltas
+SALES_PUBLISH_MAX = 50
+# A transaction left "recording" this long belongs to an interrupted call and may be resumed
+SALES_RECORDING_STALE_SECONDS = float(os.environ.get('SALES_RECORDING_STALE_SECONDS', '300'))
+# Follow-on writes of a sale, flagged on its transaction as each one lands
+SALE_RECORDING_STEPS = ("events", "contacts", "ledger", "rollups")
+
+class SaleRecord(CRMTransaction):
+    type: str = "ticket_sale"
+    description: str = ""
+    quantity: int = 1
+    # Buyer identity used to find or create the contact when contact_id is not given
+    user_id: Optional[str] = None
+    email: Optional[str] = None
+    name: Optional[str] = None
+    event_name: Optional[str] = None
+
+class SalesImportRequest(BaseModel):
+    sales: List[SaleRecord]
+
+SALE_BUYER_FIELDS = {"quantity", "user_id", "email", "name", "event_name"}
+
+def sale_transaction(sale: SaleRecord) -> dict:
+    transaction = prepare_for_mongo(sale.dict(exclude=SALE_BUYER_FIELDS))
+    transaction["status"] = "completed"
+    transaction["metadata"] = {
+        **transaction.get("metadata", {}),
+        **{field: value for field, value in sale.dict(include=SALE_BUYER_FIELDS).items() if value is not None}
+    }
+    return transaction
+
+def sale_contact_filter(sale: SaleRecord) -> Optional[dict]:
+    if sale.contact_id:
+        return {"id": sale.contact_id}
+    if sale.user_id:
+        return {"promoter_id": sale.promoter_id, "user_id": sale.user_id}
+    if sale.email:
+        return {"promoter_id": sale.promoter_id, "email": sale.email}
+    return None
+
+def sale_date(transaction: dict) -> str:
+    created_at = parse_mongo_datetime(transaction["created_at"]) or datetime.now(timezone.utc)
+    return created_at.date().isoformat()
+
+async def claim_sale_transactions(transactions: List[dict]) -> List[tuple]:
+    """Mark transactions as being recorded; return (transaction, applied steps) for those this call owns"""
+    now = datetime.now(timezone.utc)
+    operations = [
+        UpdateOne(
+            {"id": transaction["id"], "status": "pending"},
+            {"$set": {**transaction, "status": "recording", "applied_steps": [], "recording_at": now.isoformat()}},
+            upsert=True
+        )
+        for transaction in transactions
+    ]
+    try:
+        await db.crm_transactions.bulk_write(operations, ordered=False)
+        conflicts = set()
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(error.get("code") != 11000 for error in errors):
+            raise
+        conflicts = {error["index"] for error in errors}
+    claimed = [(transaction, []) for index, transaction in enumerate(transactions) if index not in conflicts]
+    if not conflicts:
+        return claimed
+
+    stale_before = (now - timedelta(seconds=SALES_RECORDING_STALE_SECONDS)).isoformat()
+    stalled = await db.crm_transactions.find(
+        {"id": {"$in": [transactions[index]["id"] for index in conflicts]},
+         "status": "recording", "recording_at": {"$lt": stale_before}},
+        projection={"_id": 0, "id": 1, "recording_at": 1}
+    ).to_list(None)
+    by_id = {transactions[index]["id"]: transactions[index] for index in conflicts}
+    for stalled_transaction in stalled:
+        # Only one caller wins the takeover: recording_at must still be the value we read
+        previous = await db.crm_transactions.find_one_and_update(
+            {"id": stalled_transaction["id"], "status": "recording",
+             "recording_at": stalled_transaction["recording_at"]},
+            {"$set": {"recording_at": now.isoformat()}},
+            projection={"_id": 0, "applied_steps": 1}
+        )
+        if previous is not None:
+            claimed.append((by_id[stalled_transaction["id"]], previous.get("applied_steps", [])))
+    return claimed
+
+async def mark_sale_steps_applied(step: str, transaction_ids: List[str]):
+    await db.crm_transactions.update_many(
+        {"id": {"$in": transaction_ids}, "status": "recording"},
+        {"$addToSet": {"applied_steps": step}}
+    )
+
+async def record_sales(sales: List[SaleRecord], publish: bool = True) -> dict:
+    """Record completed sales and roll them into events, contacts, ledgers and rollups"""
+    unique_sales = list({sale.id: sale for sale in sales}.values())
+    if not unique_sales:
+        return {"received": len(sales), "recorded": 0, "duplicates": 0}
+
+    sales_by_id = {sale.id: sale for sale in unique_sales}
+    claimed = await claim_sale_transactions([sale_transaction(sale) for sale in unique_sales])
+    transactions = [transaction for transaction, _ in claimed]
+    recorded = [sales_by_id[transaction["id"]] for transaction in transactions]
+    pending_steps = {
+        step: [(sale, transaction) for sale, (transaction, applied) in zip(recorded, claimed) if step not in applied]
+        for step in SALE_RECORDING_STEPS
+    }
+
+    now = datetime.now(timezone.utc).isoformat()
+    event_incs = {}
+    for sale, _ in pending_steps["events"]:
+        if sale.event_id and sale.type in REVENUE_TRANSACTION_TYPES:
+            collection = "stream_events" if sale.type == "stream_view" else "crm_events"
+            inc = event_incs.setdefault((collection, sale.event_id), {"tickets_sold": 0, "revenue": 0.0})
+            inc["tickets_sold"] += sale.quantity if sale.type in TICKET_TRANSACTION_TYPES else 0
+            inc["revenue"] += sale.amount
+
+    contact_updates = {}
+    for sale, _ in pending_steps["contacts"]:
+        contact_filter = sale_contact_filter(sale)
+        if contact_filter is None or sale.type not in REVENUE_TRANSACTION_TYPES:
+            continue
+        key = tuple(sorted(contact_filter.items()))
+        contact = contact_updates.setdefault(key, {
+            "filter": contact_filter,
+            "promoter_id": sale.promoter_id,
+            "identity": {
+                "id": sale.contact_id or str(uuid.uuid4()),
+                "promoter_id": sale.promoter_id,
+                "user_id": sale.user_id,
+                "email": sale.email or "",
+                "name": sale.name or sale.user_id or sale.email
+            },
+            "purchases": 0,
+            "spent": 0.0,
+            "last_event": None,
+            "transaction_ids": []
+        })
+        if not sale.contact_id:
+            contact["transaction_ids"].append(sale.id)
+        contact["purchases"] += 1
+        contact["spent"] += sale.amount
+        contact["last_event"] = sale.event_name or contact["last_event"]
+
+    ledger_credits = {}
+    for sale, _ in pending_steps["ledger"]:
+        if sale.type in REVENUE_TRANSACTION_TYPES:
+            credit = ledger_credits.setdefault(sale.promoter_id, {"earned": 0.0, "fees": 0.0, "available_balance": 0.0})
+            for field, value in ledger_credit(sale.amount).items():
+                credit[field] += value
+
+    rollup_incs = {}
+    for sale, transaction in pending_steps["rollups"]:
+        tickets = sale.quantity if sale.type in TICKET_TRANSACTION_TYPES else 0
+        rollup = rollup_incs.setdefault((sale.promoter_id, sale_date(transaction)), {
+            "transactions": 0, "tickets_sold": 0, "revenue": 0.0
+        })
+        rollup["transactions"] += 1
+        rollup["tickets_sold"] += tickets
+        if sale.type in REVENUE_TRANSACTION_TYPES:
+            rollup["revenue"] += sale.amount
+        type_field = f"revenue_by_type.{segment_key(sale.type)}"
+        rollup[type_field] = rollup.get(type_field, 0.0) + sale.amount
+
+    async def apply_step(step: str, *writes):
+        await asyncio.gather(*writes)
+        transaction_ids = [transaction["id"] for _, transaction in pending_steps[step]]
+        if transaction_ids:
+            await mark_sale_steps_applied(step, transaction_ids)
+
+    event_writes = []
+    for collection in ("stream_events", "crm_events"):
+        operations = [
+            UpdateOne({"id": event_id}, {"$inc": inc, "$set": {"updated_at": now}})
+            for (name, event_id), inc in event_incs.items() if name == collection
+        ]
+        if operations:
+            event_writes.append(db[collection].bulk_write(operations, ordered=False))
+
+    ledger_writes = []
+    if ledger_credits:
+        ledger_writes.append(db.crm_ledgers.bulk_write([
+            UpdateOne({"promoter_id": promoter_id}, ledger_update(credit))
+            for promoter_id, credit in ledger_credits.items()
+        ], ordered=False))
+
+    rollup_writes = []
+    if rollup_incs:
+        rollup_writes.append(db.crm_daily_rollups.bulk_write([
+            UpdateOne(
+                {"promoter_id": promoter_id, "date": date},
+                {"$inc": inc, "$set": {"updated_at": now}},
+                upsert=True
+            )
+            for (promoter_id, date), inc in rollup_incs.items()
+        ], ordered=False))
+
+    # Let every independent step land (and be flagged) before surfacing a failure
+    results = await asyncio.gather(
+        apply_step("events", *event_writes),
+        apply_step("ledger", *ledger_writes),
+        apply_step("rollups", *rollup_writes),
+        apply_step("contacts", write_sale_contacts(list(contact_updates.values()), now)),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+    # Completed last, so an interrupted batch is picked up again instead of counted as a duplicate
+    if transactions:
+        await db.crm_transactions.update_many(
+            {"id": {"$in": [transaction["id"] for transaction in transactions]}, "status": "recording"},
+            {"$set": {"status": "completed", "completed_at": now}, "$unset": {"applied_steps": "", "recording_at": ""}}
+        )
+
+    for promoter_id in {sale.promoter_id for sale in recorded}:
+        invalidate_promoter_cache(promoter_id)
+    if publish and len(transactions) <= SALES_PUBLISH_MAX:
+        for transaction in transactions:
+            publish_transaction_delta(transaction)
+    metrics.increment("sales.recorded", len(recorded))
+    metrics.increment("sales.duplicates", len(sales) - len(recorded))
+
+    return {
+        "received": len(sales),
+        "recorded": len(recorded),
+        "duplicates": len(sales) - len(recorded)
+    }
+
+async def write_sale_contacts(contacts: List[dict], now: str):
+    """Upsert buyers' contacts and add them to the audience summary"""
+    if not contacts:
+        return
+    operations = []
+    for contact in contacts:
+        update = {
+            "$setOnInsert": {
+                **{field: value for field, value in contact["identity"].items()
+                   if value is not None and field not in contact["filter"]},
+                "engagement_score": 0.0,
+                "segments": ["new_customer"],
+                "created_at": now
+            },
+            "$inc": {"purchase_history": contact["purchases"], "total_spent": contact["spent"]},
+            "$set": {"last_interaction": now}
+        }
+        if contact["last_event"]:
+            update["$set"]["last_event"] = contact["last_event"]
+        operations.append(UpdateOne(contact["filter"], update, upsert=True))
+    promoter_ids = {contact["promoter_id"] for contact in contacts}
+    await begin_audience_summary_writes(promoter_ids)
+    try:
+        result = await db.crm_contacts.bulk_write(operations, ordered=False)
+    except Exception:
+        await end_audience_summary_writes(promoter_ids)
+        raise
+
+    # New contacts join the summary; existing ones only add to its spend
+    summary_incs = {}
+    for index, contact in enumerate(contacts):
+        inc = summary_incs.setdefault(contact["promoter_id"], {"spent_sum": 0.0, "writes_in_flight": -1})
+        inc["spent_sum"] += contact["spent"]
+        if index in result.upserted_ids:
+            inc["total_contacts"] = inc.get("total_contacts", 0) + 1
+            inc["segments.new_customer"] = inc.get("segments.new_customer", 0) + 1
+    await db.crm_audience_summaries.bulk_write([
+        UpdateOne({"promoter_id": promoter_id}, audience_summary_update(inc), upsert=True)
+        for promoter_id, inc in summary_incs.items()
+    ], ordered=False)
+    await link_sale_contacts(contacts)
+
+async def link_sale_contacts(contacts: List[dict]):
+    """Write the resolved contact id onto transactions whose sale only named the buyer"""
+    contacts = [contact for contact in contacts if contact["transaction_ids"]]
+    if not contacts:
+        return
+    found = await db.crm_contacts.find(
+        {"$or": [contact["filter"] for contact in contacts]},
+        projection={"_id": 0, "id": 1, "promoter_id": 1, "user_id": 1, "email": 1}
+    ).to_list(None)
+    operations = []
+    for contact in contacts:
+        match = next((document for document in found
+                      if all(document.get(field) == value for field, value in contact["filter"].items())), None)
+        if match is None:
+            continue
+        operations.extend(
+            UpdateOne({"id": transaction_id, "contact_id": None}, {"$set": {"contact_id": match["id"]}})
+            for transaction_id in contact["transaction_ids"]
+        )
+    if operations:
+        await db.crm_transactions.bulk_write(operations, ordered=False)
+
+# ======================= PAYOUT ENGINE =======================
+
+def payout_settled(payout: dict):
+    invalidate_promoter_cache(payout["promoter_id"])
+    publish_payout_delta(payout, -payout["amount"])
+
+payout_engine = PayoutEngine(
+    load_payout_gateway(),
+    batch_size=int(os.environ.get('PAYOUT_BATCH_SIZE', '100')),
+    max_attempts=int(os.environ.get('PAYOUT_MAX_ATTEMPTS', '5')),
+    on_settled=payout_settled
+)
+payout_engine_job = PeriodicJob(
+    "payout_engine",
+    float(os.environ.get('PAYOUT_ENGINE_INTERVAL_SECONDS', '60')),
+    payout_engine.run
+)
+metrics.gauge("payout_engine", lambda: dict(payout_engine.stats))
+
+# ======================= CRM API ENDPOINTS =======================
+
+# CRM Dashboard Analytics
+@api_router.get("/crm/dashboard/{promoter_id}", response_model=CRMDashboardData)
+async def get_crm_dashboard(promoter_id: str, response: Response):
+    """Get comprehensive dashboard data for promoter CRM"""
+    try:
+        dashboard, age = await crm_cache.get(
+            ("dashboard", promoter_id),
+            lambda: build_crm_dashboard(promoter_id)
+        )
+        set_cache_age_header(response, age)
+        return dashboard
+
+    except Exception as e:
+        logger.error(f"Error getting CRM dashboard: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get dashboard data")
+
+@api_router.get("/crm/dashboard/{promoter_id}/live")
+async def crm_dashboard_live(promoter_id: str, request: Request):
+    """Push dashboard deltas over Server-Sent Events instead of polling"""
+    # Subscribe before reading the snapshot so no delta falls between the two
+    subscription = live_hub.subscribe(promoter_topic(promoter_id))
+    try:
+        dashboard, _ = await crm_cache.get(
+            ("dashboard", promoter_id),
+            lambda: build_crm_dashboard(promoter_id)
+        )
+    except Exception as e:
+        live_hub.unsubscribe(subscription)
+        logger.error(f"Error getting CRM dashboard: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get dashboard data")
+    
+    return sse_response(request, subscription, dashboard)
+
+async def build_crm_dashboard(promoter_id: str) -> CRMDashboardData:
+    """Compute dashboard metrics for a promoter from the database"""
+    dashboards, errors = await build_crm_dashboards([promoter_id])
+    if promoter_id in errors:
+        raise RuntimeError(errors[promoter_id])
+    return dashboards[promoter_id]
+
+async def build_crm_dashboards(promoter_ids: List[str]):
+    """Compute dashboards for many promoters with one grouped aggregation per collection"""
+    # Date range for current month
+    now = datetime.now(timezone.utc)
+    month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    day_ago = now - timedelta(days=1)
+    # created_at is stored as an ISO string by prepare_for_mongo, so compare as strings
+    month_start_iso = month_start.isoformat()
+    day_ago_iso = day_ago.isoformat()
+    
+    # Events: tickets sold, active count and top 3 by revenue
+    events_pipeline = [
+        {"$match": {"promoter_id": {"$in": promoter_ids}}},
+        {"$sort": {"revenue": -1}},
+        {"$group": {
+            "_id": "$promoter_id",
+            "tickets_sold": {"$sum": "$tickets_sold"},
+            "active_events": {"$sum": {"$cond": [{"$eq": ["$status", "active"]}, 1, 0]}},
+            "top_events": {"$push": {
+                "id": "$id",
+                "name": "$name",
+                "revenue": {"$ifNull": ["$revenue", 0]},
+                "tickets_sold": {"$ifNull": ["$tickets_sold", 0]},
+                "status": "$status"
+            }}
+        }},
+        {"$project": {
+            "tickets_sold": 1,
+            "active_events": 1,
+            "top_events": {"$slice": ["$top_events", 3]}
+        }}
+    ]
+    
+    # Completed transactions: MTD revenue by type and stream revenue for the last 24h
+    def amount_if(*conditions):
+        return {"$sum": {"$cond": [{"$and": list(conditions)}, "$amount", 0]}}
+    
+    is_mtd = {"$gte": ["$created_at", month_start_iso]}
+    transactions_pipeline = [
+        {"$match": {
+            "promoter_id": {"$in": promoter_ids},
+            "status": "completed",
+            "created_at": {"$gte": min(month_start_iso, day_ago_iso)}
+        }},
+        {"$group": {
+            "_id": "$promoter_id",
+            "total_revenue_mtd": amount_if(is_mtd),
+            "ticket_revenue": amount_if(is_mtd, {"$eq": ["$type", "ticket_sale"]}),
+            "merchandise_revenue": amount_if(is_mtd, {"$eq": ["$type", "merchandise"]}),
+            "stream_revenue": amount_if(
+                {"$gte": ["$created_at", day_ago_iso]},
+                {"$in": ["$type", ["stream_view", "tip"]]}
+            )
+        }}
+    ]
+    
+    events_by_promoter, transactions_by_promoter, ledgers = await asyncio.gather(
+        aggregate_by_id(db.crm_events, events_pipeline),
+        aggregate_by_id(db.crm_transactions, transactions_pipeline),
+        load_promoter_ledgers(promoter_ids)
+    )
+    
+    # Pending payouts come from the ledger; sum payouts only for promoters without one yet
+    payouts_by_promoter = {
+        promoter_id: {"pending_amount": ledger.get("pending_payouts", 0)}
+        for promoter_id, ledger in ledgers.items()
+    }
+    missing_ledgers = [promoter_id for promoter_id in promoter_ids if promoter_id not in ledgers]
+    if missing_ledgers:
+        payouts_by_promoter.update(await aggregate_by_id(db.crm_payouts, [
+            {"$match": {"promoter_id": {"$in": missing_ledgers}, "status": {"$in": list(PAYOUT_PENDING_STATUSES)}}},
+            {"$group": {"_id": "$promoter_id", "pending_amount": {"$sum": "$amount"}}}
+        ]))
+    
+    dashboards = {}
+    errors = {}
+    for promoter_id in promoter_ids:
+        try:
+            event_stats = events_by_promoter.get(promoter_id, {})
+            transaction_stats = transactions_by_promoter.get(promoter_id, {})
+            
+            total_revenue_mtd = transaction_stats.get("total_revenue_mtd", 0)
+            tickets_sold = event_stats.get("tickets_sold", 0)
+            stream_revenue = transaction_stats.get("stream_revenue", 0)
+            
+            # Growth calculations (mock for now - would compare to previous period)
+            revenue_growth = 12.5
+            audience_growth = 8.3
+            conversion_rate = 3.2
+            avg_ticket_price = total_revenue_mtd / max(tickets_sold, 1)
+            
+            dashboards[promoter_id] = CRMDashboardData(
+                total_revenue=total_revenue_mtd,
+                total_revenue_mtd=total_revenue_mtd,
+                tickets_sold=tickets_sold,
+                active_events=event_stats.get("active_events", 0),
+                stream_revenue=stream_revenue,
+                pending_payouts=payouts_by_promoter.get(promoter_id, {}).get("pending_amount", 0),
+                revenue_growth=revenue_growth,
+                audience_growth=audience_growth,
+                conversion_rate=conversion_rate,
+                avg_ticket_price=avg_ticket_price,
+                top_events=event_stats.get("top_events", []),
+                revenue_breakdown={
+                    "ticket_sales": transaction_stats.get("ticket_revenue", 0),
+                    "live_streams": stream_revenue,
+                    "merchandise": transaction_stats.get("merchandise_revenue", 0)
+                },
+                period_start=month_start,
+                period_end=now
+            )
+        except Exception as e:
+            logger.error(f"Error building CRM dashboard for {promoter_id}: {e}")
+            errors[promoter_id] = str(e)
+    
+    return dashboards, errors
+
+class CRMDashboardBatchRequest(BaseModel):
+    promoter_ids: List[str]
+
+CRM_DASHBOARD_BATCH_MAX = int(os.environ.get('CRM_DASHBOARD_BATCH_MAX', '500'))
+CRM_DASHBOARD_BATCH_CHUNK = int(os.environ.get('CRM_DASHBOARD_BATCH_CHUNK', '50'))
+crm_dashboard_batch_semaphore = asyncio.Semaphore(int(os.environ.get('CRM_DASHBOARD_BATCH_CONCURRENCY', '4')))
+
+@api_router.post("/crm/dashboard/batch")
+async def get_crm_dashboard_batch(request: CRMDashboardBatchRequest):
+    """Get dashboards for many promoters (agency portfolio view) keyed by promoter ID"""
+    promoter_ids = list(dict.fromkeys(request.promoter_ids))
+    if len(promoter_ids) > CRM_DASHBOARD_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {CRM_DASHBOARD_BATCH_MAX} promoters per batch")
+    
+    async def build_chunk(chunk: List[str]) -> dict:
+        async with crm_dashboard_batch_semaphore:
+            try:
+                chunk_dashboards, chunk_errors = await build_crm_dashboards(chunk)
+            except Exception as e:
+                logger.error(f"Error building CRM dashboard batch: {e}")
+                chunk_dashboards, chunk_errors = None, None
+            if chunk_dashboards is None:
+                # Isolate the failure: build the chunk's promoters one at a time
+                chunk_dashboards, chunk_errors = {}, {}
+                for promoter_id in chunk:
+                    try:
+                        chunk_dashboards[promoter_id] = await build_crm_dashboard(promoter_id)
+                    except Exception as e:
+                        logger.error(f"Error building CRM dashboard for {promoter_id}: {e}")
+                        chunk_errors[promoter_id] = str(e)
+        return {
+            **{("dashboard", promoter_id): dashboard for promoter_id, dashboard in chunk_dashboards.items()},
+            **{("dashboard", promoter_id): RuntimeError(error) for promoter_id, error in chunk_errors.items()}
+        }
+    
+    async def load(keys) -> dict:
+        promoters = [promoter_id for _, promoter_id in keys]
+        chunks = [promoters[i:i + CRM_DASHBOARD_BATCH_CHUNK] for i in range(0, len(promoters), CRM_DASHBOARD_BATCH_CHUNK)]
+        loaded = {}
+        for chunk_results in await asyncio.gather(*(build_chunk(chunk) for chunk in chunks)):
+            loaded.update(chunk_results)
+        return loaded
+    
+    # Fresh dashboards come from the per-promoter cache; the rest are loaded through its guard
+    results = await crm_cache.get_many([("dashboard", promoter_id) for promoter_id in promoter_ids], load)
+    dashboards = {}
+    errors = {}
+    for (_, promoter_id), result in results.items():
+        if isinstance(result, Exception):
+            errors[promoter_id] = str(result) if isinstance(result, RuntimeError) else "Failed to get dashboard data"
+        else:
+            dashboards[promoter_id] = result
+    
+    return {
+        "dashboards": {promoter_id: dashboards[promoter_id] for promoter_id in promoter_ids if promoter_id in dashboards},
+        "errors": errors
+    }
+
+# CRM Events Management
+@api_router.get("/crm/events/{promoter_id}")
+async def get_crm_events(promoter_id: str, status: Optional[str] = None, limit: int = 50):
+    """Get events for promoter CRM"""
+    try:
+        query = {"promoter_id": promoter_id}
+        if status:
+            query["status"] = status
+            
+        events = await db.crm_events.find(query).limit(limit).to_list(None)
+        return [CRMEvent(**event) for event in events]
+        
+    except Exception as e:
+        logger.error(f"Error getting CRM events: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get events")
+
+@api_router.post("/crm/events")
+async def create_crm_event(event: CRMEvent):
+    """Create new event in CRM"""
+    try:
+        event_dict = prepare_for_mongo(event.dict())
+        await db.crm_events.insert_one(event_dict)
+        invalidate_promoter_cache(event.promoter_id)
+        return {"status": "created", "id": event.id}
+        
+    except Exception as e:
+        logger.error(f"Error creating CRM event: {e}")
+        raise HTTPException(status_code=500, detail="Failed to create event")
+
+@api_router.put("/crm/events/{event_id}")
+async def update_crm_event(event_id: str, updates: dict):
+    """Update event in CRM"""
+    try:
+        updates["updated_at"] = datetime.now(timezone.utc)
+        updates = prepare_for_mongo(updates)
+        
+        previous = await db.crm_events.find_one_and_update(
+            {"id": event_id},
+            {"$set": updates},
+            projection={"promoter_id": 1}
+        )
+        
+        if previous is None:
+            raise HTTPException(status_code=404, detail="Event not found")
+        
+        invalidate_promoter_cache(previous.get("promoter_id"))
+        if updates.get("promoter_id"):
+            invalidate_promoter_cache(updates["promoter_id"])
+            
+        return {"status": "updated"}
+        
+    except Exception as e:
+        logger.error(f"Error updating CRM event: {e}")
+        raise HTTPException(status_code=500, detail="Failed to update event")
+
+# CRM Audience Management
+@api_router.get("/crm/contacts/{promoter_id}")
+async def get_crm_contacts(promoter_id: str, segment: Optional[str] = None, limit: int = 100):
+    """Get contacts for promoter CRM"""
+    try:
+        query = {"promoter_id": promoter_id}
+        if segment:
+            query["segments"] = {"$in": [segment]}
+            
+        contacts = await db.crm_contacts.find(query).limit(limit).to_list(None)
+        return [CRMContact(**contact) for contact in contacts]
+        
+    except Exception as e:
+        logger.error(f"Error getting CRM contacts: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get contacts")
+
+@api_router.post("/crm/contacts")
+async def create_crm_contact(contact: CRMContact):
+    """Create new contact in CRM"""
+    try:
+        contact_dict = prepare_for_mongo(contact.dict())
+        await begin_audience_summary_writes([contact.promoter_id])
+        try:
+            await db.crm_contacts.insert_one(contact_dict)
+        except Exception:
+            await end_audience_summary_writes([contact.promoter_id])
+            raise
+        await apply_audience_summary_change(None, contact_dict, [contact.promoter_id])
+        invalidate_promoter_cache(contact.promoter_id)
+        return {"status": "created", "id": contact.id}
+        
+    except Exception as e:
+        logger.error(f"Error creating CRM contact: {e}")
+        raise HTTPException(status_code=500, detail="Failed to create contact")
+
+@api_router.put("/crm/contacts/{contact_id}")
+async def update_crm_contact(contact_id: str, updates: dict):
+    """Update contact in CRM"""
+    try:
+        updates.pop("id", None)
+        updates = prepare_for_mongo(updates)
+        
+        current = await db.crm_contacts.find_one({"id": contact_id}, projection={"promoter_id": 1})
+        if current is None:
+            raise HTTPException(status_code=404, detail="Contact not found")
+        promoter_ids = {current.get("promoter_id"), updates.get("promoter_id")}
+        
+        await begin_audience_summary_writes(promoter_ids)
+        try:
+            # Matching the promoter read above keeps the flags on the summaries this write changes
+            previous = await db.crm_contacts.find_one_and_update(
+                {"id": contact_id, "promoter_id": current.get("promoter_id")},
+                {"$set": updates},
+                return_document=ReturnDocument.BEFORE
+            )
+        except Exception:
+            await end_audience_summary_writes(promoter_ids)
+            raise
+        
+        if previous is None:
+            await end_audience_summary_writes(promoter_ids)
+            raise HTTPException(status_code=409, detail="Contact changed concurrently, retry the update")
+        
+        await apply_audience_summary_change(previous, {**previous, **updates}, promoter_ids)
+        invalidate_promoter_cache(previous.get("promoter_id"))
+        if updates.get("promoter_id"):
+            invalidate_promoter_cache(updates["promoter_id"])
+            
+        return {"status": "updated"}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error updating CRM contact: {e}")
+        raise HTTPException(status_code=500, detail="Failed to update contact")
+
+@api_router.get("/crm/audience-analytics/{promoter_id}")
+async def get_audience_analytics(promoter_id: str, response: Response):
+    """Get audience analytics for promoter"""
+    try:
+        analytics, age = await crm_cache.get(
+            ("audience_analytics", promoter_id),
+            lambda: build_audience_analytics(promoter_id)
+        )
+        set_cache_age_header(response, age)
+        return analytics
+        
+    except Exception as e:
+        logger.error(f"Error getting audience analytics: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get audience analytics")
+
+async def build_audience_analytics(promoter_id: str) -> dict:
+    """Compute audience analytics for a promoter from its maintained summary document"""
+    summary = await db.crm_audience_summaries.find_one({"promoter_id": promoter_id})
+    if summary is None or not summary.get("complete"):
+        summary = await rebuild_audience_summary(promoter_id)
+    
+    total_contacts = summary.get("total_contacts", 0)
+    avg_engagement = summary.get("engagement_sum", 0) / max(total_contacts, 1)
+    avg_customer_value = summary.get("spent_sum", 0) / max(total_contacts, 1)
+    
+    # Segment breakdown
+    segments = {segment: count for segment, count in summary.get("segments", {}).items() if count > 0}
+    
+    return {
+        "total_contacts": total_contacts,
+        "avg_engagement": round(avg_engagement, 1),
+        "avg_customer_value": round(avg_customer_value, 2),
+        "segment_breakdown": segments,
+        "growth_rate": 15.2  # Mock growth rate
+    }
+
+# ======================= AUDIENCE SUMMARIES =======================
+# One document per promoter in crm_audience_summaries holds the contact count,
+# engagement and spend sums and per-segment counts. Contact writes keep it
+# current with $inc and bump its version; a summary that is missing or not
+# yet complete is rebuilt from crm_contacts, and the rebuild is only stored
+# if no contact write bumped the version while it was counting. Writers flag
+# themselves in writes_in_flight before touching crm_contacts, so a rebuild
+# never stores a count that already includes a contact whose $inc is pending.
+
+AUDIENCE_SUMMARY_REBUILD_ATTEMPTS = 5
+AUDIENCE_SUMMARY_RETRY_SECONDS = 0.05
+# A writer flagged this long ago is presumed dead and no longer holds off rebuilds
+AUDIENCE_WRITE_TIMEOUT_SECONDS = float(os.environ.get('AUDIENCE_WRITE_TIMEOUT_SECONDS', '60'))
+
+def segment_key(segment: str) -> str:
+    """Segment names become field names, so strip characters Mongo treats as paths"""
+    return segment.replace(".", "_").replace("$", "_")
+
+def audience_contribution(contact: Optional[dict]) -> dict:
+    """Summary counters a single contact contributes"""
+    if not contact:
+        return {}
+    contribution = {
+        "total_contacts": 1,
+        "engagement_sum": contact.get("engagement_score") or 0,
+        "spent_sum": contact.get("total_spent") or 0,
+    }
+    for segment in contact.get("segments") or []:
+        field = f"segments.{segment_key(segment)}"
+        contribution[field] = contribution.get(field, 0) + 1
+    return contribution
+
+async def begin_audience_summary_writes(promoter_ids: Iterable[str]):
+    """Flag contact writes as in flight on the promoters' summaries before they happen"""
+    now = datetime.now(timezone.utc)
+    operations = [
+        UpdateOne({"promoter_id": promoter_id},
+                  {"$inc": {"writes_in_flight": 1, "version": 1}, "$set": {"write_started_at": now}}, upsert=True)
+        for promoter_id in set(promoter_ids) if promoter_id
+    ]
+    if operations:
+        await db.crm_audience_summaries.bulk_write(operations, ordered=False)
+
+async def end_audience_summary_writes(promoter_ids: Iterable[str]):
+    """Clear in-flight flags for writes that failed before changing any contact"""
+    await apply_audience_summary_change(None, None, promoter_ids)
+
+def audience_writes_in_flight(summary: dict) -> bool:
+    if not summary.get("writes_in_flight"):
+        return False
+    started = summary.get("write_started_at")
+    if started is not None and started.tzinfo is None:
+        started = started.replace(tzinfo=timezone.utc)
+    timeout = timedelta(seconds=AUDIENCE_WRITE_TIMEOUT_SECONDS)
+    return started is not None and started > datetime.now(timezone.utc) - timeout
+
+async def apply_audience_summary_change(before: Optional[dict], after: Optional[dict],
+                                        in_flight: Iterable[str] = ()):
+    """Move a contact's contribution between summaries with $inc, clearing the in_flight promoters' flags"""
+    before_promoter = before.get("promoter_id") if before else None
+    after_promoter = after.get("promoter_id") if after else None
+    
+    increments = {promoter_id: {"writes_in_flight": -1} for promoter_id in set(in_flight) if promoter_id}
+    for promoter_id, contribution, sign in (
+        (before_promoter, audience_contribution(before), -1),
+        (after_promoter, audience_contribution(after), 1),
+    ):
+        if promoter_id is None:
+            continue
+        promoter_inc = increments.setdefault(promoter_id, {})
+        for field, value in contribution.items():
+            promoter_inc[field] = promoter_inc.get(field, 0) + sign * value
+    
+    for promoter_id, inc in increments.items():
+        inc = {field: value for field, value in inc.items() if value}
+        if inc:
+            await db.crm_audience_summaries.update_one(
+                {"promoter_id": promoter_id}, audience_summary_update(inc), upsert=True
+            )
+
+def audience_summary_update(inc: dict) -> dict:
+    """Upsert update for a summary change; the version bump tells a running rebuild to recount"""
+    return {"$inc": {**inc, "version": 1}, "$set": {"updated_at": datetime.now(timezone.utc)}}
+
+async def rebuild_audience_summary(promoter_id: str) -> dict:
+    """Recompute a promoter's audience summary server-side and store it"""
+    for attempt in range(AUDIENCE_SUMMARY_REBUILD_ATTEMPTS):
+        current = await db.crm_audience_summaries.find_one_and_update(
+            {"promoter_id": promoter_id},
+            {"$setOnInsert": {"version": 0}},
+            upsert=True,
+            projection={"version": 1, "writes_in_flight": 1, "write_started_at": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        version = current.get("version")
+        summary = await count_audience_summary(promoter_id)
+        summary.update({"version": version or 0, "complete": True})
+        if audience_writes_in_flight(current):
+            await asyncio.sleep(AUDIENCE_SUMMARY_RETRY_SECONDS * (attempt + 1))
+            continue
+        # Kept so a presumed-dead writer that finishes late still balances its flag
+        for field in ("writes_in_flight", "write_started_at"):
+            if field in current:
+                summary[field] = current[field]
+        result = await db.crm_audience_summaries.replace_one({"promoter_id": promoter_id, "version": version}, summary)
+        if result.matched_count:
+            return summary
+    logger.warning(f"Audience summary for {promoter_id} kept changing during rebuild; serving an unsaved count")
+    return summary
+
+async def count_audience_summary(promoter_id: str) -> dict:
+    pipeline = [
+        {"$match": {"promoter_id": promoter_id}},
+        {"$facet": {
+            "totals": [
+                {"$group": {
+                    "_id": None,
+                    "total_contacts": {"$sum": 1},
+                    "engagement_sum": {"$sum": "$engagement_score"},
+                    "spent_sum": {"$sum": "$total_spent"}
+                }}
+            ],
+            "segments": [
+                {"$unwind": "$segments"},
+                {"$group": {"_id": "$segments", "count": {"$sum": 1}}}
+            ]
+        }}
+    ]
+    results = await db.crm_contacts.aggregate(pipeline).to_list(None)
+    facets = results[0] if results else {"totals": [], "segments": []}
+    totals = facets["totals"][0] if facets["totals"] else {}
+    
+    segments = {}
+    for row in facets["segments"]:
+        key = segment_key(row["_id"])
+        segments[key] = segments.get(key, 0) + row["count"]
+    
+    summary = {
+        "promoter_id": promoter_id,
+        "total_contacts": totals.get("total_contacts", 0),
+        "engagement_sum": totals.get("engagement_sum", 0),
+        "spent_sum": totals.get("spent_sum", 0),
+        "segments": segments,
+        "updated_at": datetime.now(timezone.utc)
+    }
+    return summary
+
+# ======================= COHORT & RFM ANALYTICS =======================
+
+COHORT_CACHE_MAX_ENTRIES = 1000
+RFM_QUANTILES = [0.2, 0.4, 0.6, 0.8]
+cohort_cache = OrderedDict()  # (promoter_id, months) -> (version, result)
+
+def to_epoch_seconds(value) -> float:
+    """created_at may be an ISO string (prepare_for_mongo) or a BSON datetime"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+@api_router.get("/crm/cohorts/{promoter_id}")
+async def get_crm_cohorts(promoter_id: str, months: int = 12):
+    """Cohort retention by first-purchase month and RFM scoring for a promoter's audience"""
+    try:
+        months = max(1, min(months, 36))
+        match = {"promoter_id": promoter_id, "status": "completed", "contact_id": {"$ne": None}}
+        
+        version = await cohort_version(match)
+        cache_key = (promoter_id, months)
+        cached = cohort_cache.get(cache_key)
+        if cached is not None and cached[0] == version:
+            cohort_cache.move_to_end(cache_key)
+            return cached[1]
+        
+        # Stream only the three columns needed into flat lists
+        contact_ids, timestamps, amounts = [], [], []
+        cursor = db.crm_transactions.find(
+            match, projection={"_id": 0, "contact_id": 1, "created_at": 1, "amount": 1}
+        ).batch_size(5000)
+        async for transaction in cursor:
+            contact_ids.append(transaction["contact_id"])
+            timestamps.append(to_epoch_seconds(transaction["created_at"]))
+            amounts.append(transaction.get("amount") or 0.0)
+        
+        now = datetime.now(timezone.utc)
+        result = await asyncio.to_thread(
+            compute_cohorts_and_rfm, contact_ids, timestamps, amounts, now.timestamp(), months
+        )
+        result.update({
+            "promoter_id": promoter_id,
+            "version": version,
+            "generated_at": now
+        })
+        
+        cohort_cache[cache_key] = (version, result)
+        cohort_cache.move_to_end(cache_key)
+        while len(cohort_cache) > COHORT_CACHE_MAX_ENTRIES:
+            cohort_cache.popitem(last=False)
+        
+        return result
+        
+    except Exception as e:
+        logger.error(f"Error getting CRM cohorts: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get cohort analytics")
+
+async def cohort_version(match: dict) -> Optional[str]:
+    """Versions a cached result; imports with old dates, refunds and contact links all change it"""
+    stats = await db.crm_transactions.aggregate([
+        {"$match": match},
+        {"$group": {"_id": None, "count": {"$sum": 1}, "amount": {"$sum": "$amount"}, "latest": {"$max": "$created_at"}}}
+    ]).to_list(None)
+    if not stats:
+        return None
+    return f"{stats[0]['latest']}|{stats[0]['count']}|{round(stats[0]['amount'] or 0, 2)}"
+
+def compute_cohorts_and_rfm(contact_ids: List[str], timestamps: List[float], amounts: List[float],
+                            now_ts: float, months: int) -> dict:
+    """Vectorized cohort retention matrix and RFM quintile scores"""
+    if not contact_ids:
+        return {"contacts": 0, "transactions": 0, "cohorts": [], "rfm": None}
+    
+    contacts, codes = np.unique(np.asarray(contact_ids, dtype=object).astype(str), return_inverse=True)
+    ts = np.asarray(timestamps, dtype=np.int64).astype("datetime64[s]")
+    amount = np.asarray(amounts, dtype=np.float64)
+    n_contacts = len(contacts)
+    
+    # Month index of each purchase and of each contact's first purchase
+    month = ts.astype("datetime64[M]").astype(np.int64)
+    first_month = np.full(n_contacts, np.iinfo(np.int64).max)
+    np.minimum.at(first_month, codes, month)
+    offset = month - first_month[codes]
+    
+    # Distinct (contact, month offset) pairs, then count per (cohort, offset)
+    in_window = offset < months
+    pairs = np.unique(codes[in_window] * months + offset[in_window])
+    pair_contacts = pairs // months
+    pair_offsets = pairs % months
+    cohort_months, cohort_index = np.unique(first_month[pair_contacts], return_inverse=True)
+    active = np.zeros((len(cohort_months), months), dtype=np.int64)
+    np.add.at(active, (cohort_index, pair_offsets), 1)
+    sizes = active[:, 0]
+    retention = active / np.maximum(sizes, 1)[:, None]
+    
+    cohort_labels = np.asarray(cohort_months).astype("datetime64[M]").astype(str)
+    cohorts = [
+        {
+            "cohort": label,
+            "size": int(size),
+            "active": row_active.tolist(),
+            "retention": np.round(row_retention, 4).tolist()
+        }
+        for label, size, row_active, row_retention in zip(cohort_labels, sizes, active, retention)
+    ]
+    
+    # RFM: recency in days since last purchase, frequency, monetary value
+    last_purchase = np.zeros(n_contacts, dtype=np.int64)
+    np.maximum.at(last_purchase, codes, ts.astype(np.int64))
+    recency = (now_ts - last_purchase) / 86400.0
+    frequency = np.bincount(codes, minlength=n_contacts).astype(np.float64)
+    monetary = np.bincount(codes, weights=amount, minlength=n_contacts)
+    
+    def quintile_scores(values):
+        # Score by percentile of the average rank, so tied values share the middle of
+        # their run instead of all landing in the top quintile
+        thresholds = np.quantile(values, RFM_QUANTILES)
+        _, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+        average_rank = np.cumsum(counts) - (counts - 1) / 2.0
+        percentile = average_rank[inverse] / len(values)
+        return thresholds, np.clip(np.ceil(percentile * 5).astype(np.int64), 1, 5)
+    
+    recency_thresholds, recency_scores = quintile_scores(recency)
+    recency_scores = 6 - recency_scores  # more recent is better
+    frequency_thresholds, frequency_scores = quintile_scores(frequency)
+    monetary_thresholds, monetary_scores = quintile_scores(monetary)
+    
+    def score_counts(scores):
+        counts = np.bincount(scores, minlength=6)[1:]
+        return {str(score): int(count) for score, count in enumerate(counts, start=1)}
+    
+    total_scores = recency_scores + frequency_scores + monetary_scores
+    top = np.argsort(-total_scores, kind="stable")[:10]
+    
+    return {
+        "contacts": int(n_contacts),
+        "transactions": int(len(codes)),
+        "cohorts": cohorts,
+        "rfm": {
+            "thresholds": {
+                "recency_days": np.round(recency_thresholds, 2).tolist(),
+                "frequency": np.round(frequency_thresholds, 2).tolist(),
+                "monetary": np.round(monetary_thresholds, 2).tolist()
+            },
+            "score_counts": {
+                "recency": score_counts(recency_scores),
+                "frequency": score_counts(frequency_scores),
+                "monetary": score_counts(monetary_scores)
+            },
+            "top_contacts": [
+                {
+                    "contact_id": str(contacts[i]),
+                    "recency": int(recency_scores[i]),
+                    "frequency": int(frequency_scores[i]),
+                    "monetary": int(monetary_scores[i]),
+                    "total_spent": round(float(monetary[i]), 2),
+                    "purchases": int(frequency[i])
+                }
+                for i in top
+            ]
+        }
+    }
+
+# CRM Marketing Campaigns
+@api_router.get("/crm/campaigns/{promoter_id}")
+async def get_crm_campaigns(promoter_id: str, status: Optional[str] = None):
+    """Get marketing campaigns for promoter"""
+    try:
+        query = {"promoter_id": promoter_id}
+        if status:
+            query["status"] = status
+            
+        campaigns = await db.crm_campaigns.find(query).to_list(None)
+        return [CRMCampaign(**campaign) for campaign in campaigns]
+        
+    except Exception as e:
+        logger.error(f"Error getting CRM campaigns: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get campaigns")
+
+@api_router.post("/crm/campaigns")
+async def create_crm_campaign(campaign: CRMCampaign):
+    """Create new marketing campaign"""
+    try:
+        campaign_dict = prepare_for_mongo(campaign.dict())
+        await db.crm_campaigns.insert_one(campaign_dict)
+        return {"status": "created", "id": campaign.id}
+        
+    except Exception as e:
+        logger.error(f"Error creating CRM campaign: {e}")
+        raise HTTPException(status_code=500, detail="Failed to create campaign")
+
+@api_router.post("/crm/campaigns/{campaign_id}/launch")
+async def launch_crm_campaign(campaign_id: str):
+    """Launch marketing campaign"""
+    try:
+        # Update campaign status
+        result = await db.crm_campaigns.update_one(
+            {"id": campaign_id},
+            {"$set": {"status": "active", "scheduled_at": datetime.now(timezone.utc)}}
+        )
+        
+        if result.matched_count == 0:
+            raise HTTPException(status_code=404, detail="Campaign not found")
+        
+        # In production, this would trigger email/SMS sending
         return {"status": "launched", "message": "Campaign launched successfully"}
         
     except Exception as e:
@@ -1553,11 +4625,24 @@ async def get_crm_payouts(promoter_id: str, status: Optional[str] = None):
         raise HTTPException(status_code=500, detail="Failed to get payouts")
 
 @api_router.post("/crm/payouts/request")
-async def request_payout(promoter_id: str, amount: float):
+async def request_payout(promoter_id: str, amount: float, response: Response,
+                         idempotency_key: Optional[str] = Header(None)):
     """Request payout for promoter"""
+    return await idempotency_store.run(
+        response, "payout_request", idempotency_key, {"promoter_id": promoter_id, "amount": amount},
+        lambda: create_payout_request(promoter_id, amount)
+    )
+
+async def create_payout_request(promoter_id: str, amount: float):
     try:
-        # Validate available balance
-        # In production, calculate from transactions minus fees
+        amount = round(amount, 2)
+        if amount <= 0:
+            raise HTTPException(status_code=400, detail="Payout amount must be positive")
+        
+        # Validate and reserve available balance in one conditional update on the ledger
+        ledger = await reserve_payout_balance(promoter_id, amount)
+        if ledger is None:
+            raise HTTPException(status_code=400, detail="Insufficient available balance")
         
         payout = CRMPayout(
             promoter_id=promoter_id,
@@ -1566,14 +4651,53 @@ async def request_payout(promoter_id: str, amount: float):
         )
         
         payout_dict = prepare_for_mongo(payout.dict())
-        await db.crm_payouts.insert_one(payout_dict)
+        try:
+            await db.crm_payouts.insert_one(payout_dict)
+        except Exception:
+            await release_payout_balance(promoter_id, amount, unconfirmed=True)
+            raise
+        await confirm_payout_reservation(promoter_id)
+        invalidate_promoter_cache(promoter_id)
+        publish_payout_delta(payout_dict, amount)
         
-        return {"status": "requested", "id": payout.id, "estimated_processing": "2-3 business days"}
+        return {
+            "status": "requested",
+            "id": payout.id,
+            "available_balance": ledger["available_balance"],
+            "estimated_processing": "2-3 business days"
+        }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error requesting payout: {e}")
         raise HTTPException(status_code=500, detail="Failed to request payout")
 
+@api_router.get("/crm/ledger/{promoter_id}")
+async def get_promoter_ledger(promoter_id: str):
+    """Get a promoter's running balance"""
+    try:
+        ledger = await db.crm_ledgers.find_one({"promoter_id": promoter_id}, projection={"_id": 0})
+        if ledger is None:
+            ledger = await rebuild_promoter_ledger(promoter_id)
+        return ledger
+        
+    except Exception as e:
+        logger.error(f"Error getting promoter ledger: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get ledger")
+
+@api_router.post("/crm/ledger/{promoter_id}/rebuild")
+async def rebuild_promoter_ledger_endpoint(promoter_id: str):
+    """Recompute a promoter's ledger from transaction and payout history"""
+    try:
+        ledger = await rebuild_promoter_ledger(promoter_id)
+        invalidate_promoter_cache(promoter_id)
+        return ledger
+        
+    except Exception as e:
+        logger.error(f"Error rebuilding promoter ledger: {e}")
+        raise HTTPException(status_code=500, detail="Failed to rebuild ledger")
+
 @api_router.get("/crm/transactions/{promoter_id}")
 async def get_crm_transactions(promoter_id: str, limit: int = 50, transaction_type: Optional[str] = None):
     """Get transaction history for promoter"""
@@ -1589,6 +4713,61 @@ async def get_crm_transactions(promoter_id: str, limit: int = 50, transaction_ty
         logger.error(f"Error getting CRM transactions: {e}")
         raise HTTPException(status_code=500, detail="Failed to get transactions")
 
+@api_router.post("/crm/transactions/{transaction_id}/refund")
+async def refund_transaction(transaction_id: str, request: Request):
+    """Refund a completed transaction and debit it from the promoter's ledger (admin only)"""
+    if not is_admin_request(request):
+        raise HTTPException(status_code=401, detail="Admin key required")
+    try:
+        transaction = await refund_crm_transaction(transaction_id)
+        if transaction is None:
+            raise HTTPException(status_code=409, detail="Transaction not found or not completed")
+        invalidate_promoter_cache(transaction["promoter_id"])
+        publish_transaction_delta(transaction)
+        return {"id": transaction_id, "status": "refunded"}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error refunding CRM transaction: {e}")
+        raise HTTPException(status_code=500, detail="Failed to refund transaction")
+
+@api_router.post("/crm/sales/import")
+async def import_crm_sales(import_request: SalesImportRequest, request: Request):
+    """Record completed sales in bulk, e.g. a historical import; sales already recorded are skipped (admin only)"""
+    if not is_admin_request(request):
+        raise HTTPException(status_code=401, detail="Admin key required")
+    try:
+        if len(import_request.sales) > SALES_IMPORT_MAX_ROWS:
+            raise HTTPException(status_code=400, detail=f"At most {SALES_IMPORT_MAX_ROWS} sales per import")
+
+        totals = {"received": 0, "recorded": 0, "duplicates": 0}
+        for start in range(0, len(import_request.sales), SALES_IMPORT_CHUNK_SIZE):
+            result = await record_sales(import_request.sales[start:start + SALES_IMPORT_CHUNK_SIZE], publish=False)
+            for field in totals:
+                totals[field] += result[field]
+        return totals
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error importing CRM sales: {e}")
+        raise HTTPException(status_code=500, detail="Failed to import sales")
+
+@api_router.get("/crm/rollups/{promoter_id}")
+async def get_crm_rollups(promoter_id: str, days: int = 30):
+    """Get daily sales rollups for promoter, most recent first"""
+    try:
+        since = (datetime.now(timezone.utc) - timedelta(days=days)).date().isoformat()
+        rollups = await db.crm_daily_rollups.find(
+            {"promoter_id": promoter_id, "date": {"$gte": since}}, projection={"_id": 0}
+        ).sort("date", -1).to_list(None)
+        return rollups
+
+    except Exception as e:
+        logger.error(f"Error getting CRM rollups: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get rollups")
+
 # ======================= CRM AS A SERVICE API =======================
 # Pay-as-you-go API for external platforms using TicketAI CRM
 
@@ -1727,6 +4906,7 @@ async def seed_crm_data():
         await db.crm_contacts.delete_many({"promoter_id": "test-promoter-1"})
         await db.crm_campaigns.delete_many({"promoter_id": "test-promoter-1"})
         await db.crm_transactions.delete_many({"promoter_id": "test-promoter-1"})
+        await db.crm_audience_summaries.delete_many({"promoter_id": "test-promoter-1"})
         
         # Insert mock data
         events_prepared = [prepare_for_mongo(event) for event in MOCK_CRM_EVENTS]
@@ -1741,6 +4921,11 @@ async def seed_crm_data():
         transactions_prepared = [prepare_for_mongo(transaction) for transaction in MOCK_CRM_TRANSACTIONS]
         await db.crm_transactions.insert_many(transactions_prepared)
         
+        await rebuild_promoter_ledger("test-promoter-1")
+        invalidate_promoter_cache("test-promoter-1")
+        for transaction in transactions_prepared:
+            publish_transaction_delta(transaction)
+        
         return {
             "status": "success",
             "message": "CRM test data seeded successfully",
@@ -1936,6 +5121,120 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def start_background_workers():
+    stream_analytics_buffer.start()
+    viewer_count_job.start()
+    viewer_sketch_job.start()
+    watch_time_job.start()
+    playback_token_buffer.start()
+    entitlement_warm_job.start()
+    await entitlement_warm_job.run_once()
+    revocation_refresh_job.start()
+    await revocation_refresh_job.run_once()
+    try:
+        await stream_scheduler.reload()
+    except Exception as e:
+        logger.error(f"Error loading stream schedule: {e}")
+    stream_scheduler.start()
+    stream_schedule_reload_job.start()
+    preissue_job.start()
+    stripe_webhook_queue.start()
+    stripe_reconcile_job.start()
+    outbox_worker.start()
+    if payout_engine.gateway is not None:
+        payout_engine_job.start()
+    else:
+        logger.warning("PAYOUT_GATEWAY is not set; payout engine not started, payouts stay pending")
+
+@app.on_event("shutdown")
+async def stop_background_workers():
+    await stream_analytics_buffer.stop()
+    await viewer_count_job.stop()
+    await viewer_sketch_job.stop()
+    await watch_time_job.stop()
+    await entitlement_warm_job.stop()
+    await playback_token_buffer.stop()
+    await revocation_refresh_job.stop()
+    await preissue_job.stop()
+    await stripe_reconcile_job.stop()
+    await outbox_worker.stop()
+    await payout_engine_job.stop()
+    await stripe_webhook_queue.stop()
+    await close_stripe_checkout_clients()
+    await stripe_gateway.close()
+    await stream_schedule_reload_job.stop()
+    await stream_scheduler.stop()
+    try:
+        await viewer_count_sync.flush()
+    except Exception as e:
+        logger.error(f"Error flushing viewer presence: {e}")
+
+# (collection, keys, options) for the indexes queries and idempotency keys rely on
+INDEXES = [
+    ("crm_audience_summaries", "promoter_id", {"unique": True}),
+    ("crm_contacts", [("promoter_id", 1), ("segments", 1)], {}),
+    ("crm_transactions", [("promoter_id", 1), ("status", 1), ("created_at", -1)], {}),
+    ("stream_viewer_presence", [("stream_event_id", 1), ("viewer_key", 1)], {"unique": True}),
+    ("stream_viewer_presence", "last_seen", {"expireAfterSeconds": int(viewer_counters.presence_timeout) + 60}),
+    ("stream_viewer_sketches", [("stream_event_id", 1), ("minute", 1), ("worker_id", 1)], {"unique": True}),
+    ("stream_metrics_minutely", [("stream_event_id", 1), ("minute", 1)], {"unique": True}),
+    ("stream_watch_digests", [("stream_event_id", 1), ("worker_id", 1)], {"unique": True}),
+    ("stream_tickets", [("stream_event_id", 1), ("user_id", 1)], {}),
+    ("revoked_stream_tickets", "ticket_id", {"unique": True}),
+    ("stream_events", [("status", 1), ("start_time", 1)], {}),
+    ("stripe_webhook_events", "event_id", {"unique": True}),
+    ("stripe_webhook_events", [("status", 1), ("next_attempt_at", 1)], {}),
+    ("stripe_webhook_events", "processed_at", {"expireAfterSeconds": 7 * 24 * 3600}),
+    ("stripe_webhook_dead_letters", "event_id", {"unique": True}),
+    ("payment_transactions", "session_id", {}),
+    ("stream_tickets", "stripe_session_id", {"sparse": True}),
+    ("idempotency_keys", "expires_at", {"expireAfterSeconds": 0}),
+    ("outbox_events", "id", {"unique": True}),
+    ("outbox_events", [("status", 1), ("next_attempt_at", 1)], {}),
+    ("outbox_events", [("aggregate_id", 1), ("created_at", 1)], {}),
+    ("outbox_events", "processed_at", {"expireAfterSeconds": 7 * 24 * 3600}),
+    ("crm_contacts", [("promoter_id", 1), ("user_id", 1)], {"sparse": True}),
+    ("crm_contacts", [("promoter_id", 1), ("email", 1)], {}),
+    ("crm_daily_rollups", [("promoter_id", 1), ("date", 1)], {"unique": True}),
+    ("notifications", "source_id", {"unique": True}),
+    ("crm_ledgers", "promoter_id", {"unique": True}),
+    ("crm_payouts", [("status", 1), ("created_at", 1)], {}),
+]
+
+async def ensure_unique_transaction_ids():
+    """Put the unique crm_transactions.id index in place, replacing an older non-unique id_1"""
+    existing = (await db.crm_transactions.index_information()).get("id_1")
+    if existing is not None and not existing.get("unique"):
+        logger.warning("Replacing non-unique crm_transactions id_1 index with a unique one")
+        await db.crm_transactions.drop_index("id_1")
+    await db.crm_transactions.create_index("id", unique=True)
+
+@app.on_event("startup")
+async def ensure_indexes():
+    for collection, keys, options in INDEXES:
+        try:
+            await db[collection].create_index(keys, **options)
+        except Exception as e:
+            logger.error(f"Error creating index {keys} on {collection}: {e}")
+    
+    # Sales and CRM transactions upsert on id; without a unique index replays insert duplicates
+    try:
+        await ensure_unique_transaction_ids()
+    except Exception as e:
+        logger.error(f"Error creating unique crm_transactions.id index: {e}")
+        raise RuntimeError("crm_transactions needs a unique id index before sales can be recorded") from e
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
+
+if __name__ == "__main__":
+    # python server.py rebuild-ledgers [promoter_id ...]
+    import sys
+    if len(sys.argv) >= 2 and sys.argv[1] == "rebuild-ledgers":
+        rebuilt = asyncio.run(rebuild_promoter_ledgers(sys.argv[2:] or None))
+        logger.info(f"Rebuilt {rebuilt} promoter ledgers")
+    else:
+        logger.error("usage: python server.py rebuild-ledgers [promoter_id ...]")
+        sys.exit(2)
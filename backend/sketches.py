@@ -0,0 +1,179 @@
+import bisect
+import hashlib
+import math
+from typing import Optional
+
+import numpy as np
+
+class HyperLogLog:
+    """HyperLogLog cardinality sketch with 2**precision one-byte registers"""
+
+    def __init__(self, precision: int = 13, registers: Optional[bytes] = None):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.m)
+        if len(self.registers) != self.m:
+            raise ValueError("Register length does not match precision")
+
+    def add(self, value: str) -> bool:
+        """Add a value; returns True if the sketch changed (the value is likely new)"""
+        hashed = int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+        index = hashed >> (64 - self.precision)
+        remainder = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remainder.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge sketches with different precision")
+        merged = np.maximum(
+            np.frombuffer(self.registers, dtype=np.uint8),
+            np.frombuffer(other.registers, dtype=np.uint8)
+        )
+        self.registers = bytearray(merged.tobytes())
+        return self
+
+    def estimate(self) -> int:
+        registers = np.frombuffer(self.registers, dtype=np.uint8)
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        raw = alpha * self.m * self.m / float(np.sum(np.exp2(-registers.astype(np.float64))))
+        zeros = int(np.count_nonzero(registers == 0))
+        if raw <= 2.5 * self.m and zeros:
+            # Small-range correction (linear counting)
+            return int(round(self.m * math.log(self.m / zeros)))
+        return int(round(raw))
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, precision: int = 13) -> "HyperLogLog":
+        return cls(precision=precision, registers=data)
+
+class TDigest:
+    """Merging t-digest for streaming quantile estimates"""
+
+    def __init__(self, compression: float = 100.0):
+        self.compression = compression
+        self.means = []
+        self.weights = []
+        self.total_weight = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self._buffer = []
+
+    def add(self, value: float, weight: float = 1.0):
+        self._buffer.append((value, weight))
+        self.total_weight += weight
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if len(self._buffer) >= 5 * self.compression:
+            self.compress()
+
+    def merge(self, other: "TDigest") -> "TDigest":
+        other.compress()
+        for mean, weight in zip(other.means, other.weights):
+            self._buffer.append((mean, weight))
+        self.total_weight += other.total_weight
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.compress()
+        return self
+
+    def _k(self, q: float) -> float:
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def _k_inverse(self, k: float) -> float:
+        return (math.sin(min(k * 2 * math.pi / self.compression, math.pi / 2)) + 1) / 2
+
+    def compress(self):
+        if not self._buffer:
+            return
+        points = sorted(list(zip(self.means, self.weights)) + self._buffer)
+        self._buffer = []
+        total = sum(weight for _, weight in points)
+        means, weights = [points[0][0]], [points[0][1]]
+        weight_so_far = 0.0
+        limit = total * self._k_inverse(self._k(0.0) + 1)
+        for mean, weight in points[1:]:
+            if weight_so_far + weights[-1] + weight <= limit:
+                # Fold into the current centroid (weighted mean)
+                weights[-1] += weight
+                means[-1] += (mean - means[-1]) * weight / weights[-1]
+            else:
+                weight_so_far += weights[-1]
+                limit = total * self._k_inverse(self._k(weight_so_far / total) + 1)
+                means.append(mean)
+                weights.append(weight)
+        self.means, self.weights = means, weights
+
+    def quantile(self, q: float) -> Optional[float]:
+        self.compress()
+        if not self.means:
+            return None
+        if len(self.means) == 1:
+            return self.means[0]
+        target = q * self.total_weight
+        # Centroid centres sit at the middle of their cumulative weight span
+        centres = []
+        cumulative = 0.0
+        for weight in self.weights:
+            centres.append(cumulative + weight / 2)
+            cumulative += weight
+        if target <= centres[0]:
+            return self.min + (self.means[0] - self.min) * (target / centres[0] if centres[0] else 0)
+        if target >= centres[-1]:
+            tail = self.total_weight - centres[-1]
+            return self.means[-1] + (self.max - self.means[-1]) * ((target - centres[-1]) / tail if tail else 0)
+        i = bisect.bisect_right(centres, target)
+        left, right = centres[i - 1], centres[i]
+        fraction = (target - left) / (right - left) if right > left else 0
+        return self.means[i - 1] + (self.means[i] - self.means[i - 1]) * fraction
+
+    def to_dict(self) -> dict:
+        self.compress()
+        return {
+            "compression": self.compression,
+            "means": self.means,
+            "weights": self.weights,
+            "min": self.min if self.means else None,
+            "max": self.max if self.means else None
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "TDigest":
+        digest = cls(data.get("compression", 100.0))
+        digest.means = list(data.get("means", []))
+        digest.weights = list(data.get("weights", []))
+        digest.total_weight = float(sum(digest.weights))
+        if digest.means:
+            digest.min = data.get("min", min(digest.means))
+            digest.max = data.get("max", max(digest.means))
+        return digest
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings using double hashing of one blake2b digest"""
+
+    def __init__(self, capacity: int, error_rate: float = 0.0001):
+        capacity = max(capacity, 1)
+        self.size = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.hash_count = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import List
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+class StripeWebhookQueue:
+    """Durable queue of verified Stripe webhook events in stripe_webhook_events"""
+
+    def __init__(self, handlers: dict, workers: int = 2, batch_size: int = 100, lease_seconds: float = 60.0,
+                 max_attempts: int = 8, backoff_base: float = 2.0, backoff_max: float = 600.0,
+                 poll_interval: float = 5.0):
+        self.handlers = handlers  # event type -> function returning (collection name, write) pairs
+        self.workers = workers
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.poll_interval = poll_interval
+        self._tasks = []
+        self._wakeup = None
+        self._stopped = False
+        self.stats = {"enqueued": 0, "duplicates": 0, "processed": 0, "retried": 0, "dead_lettered": 0}
+
+    async def enqueue(self, webhook_response, body: bytes):
+        now = datetime.now(timezone.utc)
+        try:
+            await db.stripe_webhook_events.insert_one({
+                "event_id": webhook_response.event_id,
+                "event_type": webhook_response.event_type,
+                "session_id": webhook_response.session_id,
+                "payment_status": webhook_response.payment_status,
+                "metadata": webhook_response.metadata,
+                "payload": body.decode("utf-8", errors="replace"),
+                "status": "pending",
+                "attempts": 0,
+                "next_attempt_at": now,
+                "received_at": now
+            })
+        except DuplicateKeyError:
+            self.stats["duplicates"] += 1
+            return
+        self.stats["enqueued"] += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(self.backoff_base * (2 ** (attempts - 1)), self.backoff_max)
+        return delay * random.uniform(0.5, 1.0)
+
+    async def claim(self) -> List[dict]:
+        """Lease up to batch_size due events (pending, or processing with an expired lease)"""
+        now = datetime.now(timezone.utc)
+        due = {"$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            {"status": "processing", "lease_until": {"$lt": now}}
+        ]}
+        candidates = await db.stripe_webhook_events.find(
+            due, projection={"_id": 0, "event_id": 1}
+        ).sort("received_at", 1).limit(self.batch_size).to_list(None)
+        if not candidates:
+            return []
+        
+        lease_id = str(uuid.uuid4())
+        await db.stripe_webhook_events.update_many(
+            {"$and": [{"event_id": {"$in": [c["event_id"] for c in candidates]}}, due]},
+            {"$set": {
+                "status": "processing",
+                "lease_id": lease_id,
+                "lease_until": now + timedelta(seconds=self.lease_seconds)
+            }}
+        )
+        return await db.stripe_webhook_events.find(
+            {"lease_id": lease_id, "status": "processing"}, projection={"_id": 0}
+        ).sort("received_at", 1).to_list(None)
+
+    async def apply(self, events: List[dict]) -> dict:
+        """Apply a batch; returns {event_id: error} for the events whose writes failed"""
+        failed = {}
+        operations = {}  # collection name -> list of (event_id, operation)
+        for event in events:
+            handler = self.handlers.get(event["event_type"])
+            if handler is None:
+                continue
+            try:
+                for collection_name, operation in handler(event):
+                    operations.setdefault(collection_name, []).append((event["event_id"], operation))
+            except Exception as e:
+                logger.error(f"Error building writes for webhook event {event['event_id']}: {e}")
+                failed[event["event_id"]] = str(e)
+        
+        for collection_name, pending in operations.items():
+            pending = [(event_id, operation) for event_id, operation in pending if event_id not in failed]
+            if not pending:
+                continue
+            try:
+                await db[collection_name].bulk_write([operation for _, operation in pending], ordered=False)
+            except BulkWriteError as e:
+                for error in e.details.get("writeErrors", []):
+                    failed[pending[error["index"]][0]] = error.get("errmsg", "write error")
+            except Exception as e:
+                logger.error(f"Error applying webhook writes to {collection_name}: {e}")
+                failed.update((event_id, str(e)) for event_id, _ in pending)
+        return failed
+
+    async def _settle(self, events: List[dict], failed: dict):
+        now = datetime.now(timezone.utc)
+        done = [event["event_id"] for event in events if event["event_id"] not in failed]
+        if done:
+            await db.stripe_webhook_events.update_many(
+                {"event_id": {"$in": done}},
+                {"$set": {"status": "processed", "processed_at": now}, "$unset": {"lease_id": "", "lease_until": ""}}
+            )
+            self.stats["processed"] += len(done)
+        
+        retries, dead = [], []
+        for event in events:
+            if event["event_id"] not in failed:
+                continue
+            attempts = event.get("attempts", 0) + 1
+            if attempts >= self.max_attempts:
+                dead.append(event)
+                continue
+            retries.append(UpdateOne(
+                {"event_id": event["event_id"]},
+                {"$set": {
+                    "status": "pending",
+                    "attempts": attempts,
+                    "last_error": failed[event["event_id"]],
+                    "next_attempt_at": now + timedelta(seconds=self._backoff(attempts))
+                }, "$unset": {"lease_id": "", "lease_until": ""}}
+            ))
+        if retries:
+            await db.stripe_webhook_events.bulk_write(retries, ordered=False)
+            self.stats["retried"] += len(retries)
+        if dead:
+            await db.stripe_webhook_dead_letters.bulk_write([
+                UpdateOne(
+                    {"event_id": event["event_id"]},
+                    {"$setOnInsert": {
+                        **event,
+                        "attempts": event.get("attempts", 0) + 1,
+                        "last_error": failed[event["event_id"]],
+                        "dead_lettered_at": now
+                    }},
+                    upsert=True
+                ) for event in dead
+            ], ordered=False)
+            await db.stripe_webhook_events.update_many(
+                {"event_id": {"$in": [event["event_id"] for event in dead]}},
+                {"$set": {"status": "dead", "processed_at": now}, "$unset": {"lease_id": "", "lease_until": ""}}
+            )
+            self.stats["dead_lettered"] += len(dead)
+            logger.error(f"Moved {len(dead)} Stripe webhook events to the dead-letter collection")
+
+    async def process_batch(self) -> int:
+        events = await self.claim()
+        if not events:
+            return 0
+        for event in events:
+            event.pop("lease_id", None)
+            event.pop("lease_until", None)
+        failed = await self.apply(events)
+        await self._settle(events, failed)
+        return len(events)
+
+    async def _worker(self):
+        while not self._stopped:
+            try:
+                processed = await self.process_batch()
+            except Exception as e:
+                logger.error(f"Stripe webhook worker failed: {e}")
+                processed = 0
+            if processed:
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._tasks:
+            return
+        self._stopped = False
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        if not self._tasks:
+            return
+        self._stopped = True
+        self._wakeup.set()
+        # Leased events whose batch doesn't finish are picked up again when the lease expires
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
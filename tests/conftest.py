@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'ticketai_test')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+import idempotency  # noqa: E402
+import ledger  # noqa: E402
+import outbox  # noqa: E402
+import payouts  # noqa: E402
+import server  # noqa: E402
+import webhook_queue  # noqa: E402
+
+# Every module that imports db from database
+DATABASE_MODULES = (server, ledger, idempotency, outbox, payouts, webhook_queue)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """An in-memory database swapped in wherever db is imported"""
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    database = mongomock_motor.AsyncMongoMockClient()["ticketai_test"]
+    for module in DATABASE_MODULES:
+        monkeypatch.setattr(module, "db", database)
+    return database
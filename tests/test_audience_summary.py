@@ -0,0 +1,84 @@
+import asyncio
+
+import server
+
+
+def contact(promoter_id="p1", spent=10.0, segments=("regular",)):
+    return {"promoter_id": promoter_id, "engagement_score": 50.0, "total_spent": spent, "segments": list(segments)}
+
+
+def test_contribution_counts_contact_and_segments():
+    assert server.audience_contribution(contact(segments=("vip", "a.b"))) == {
+        "total_contacts": 1, "engagement_sum": 50.0, "spent_sum": 10.0,
+        "segments.vip": 1, "segments.a_b": 1
+    }
+
+
+def test_change_on_missing_summary_is_not_lost_or_double_counted(db):
+    async def scenario():
+        await db.crm_contacts.insert_one(contact())
+        # A write lands before the summary exists ...
+        await server.apply_audience_summary_change(None, contact())
+        await db.crm_contacts.insert_one(contact())
+        # ... and the first read rebuilds it from crm_contacts
+        summary = await server.build_audience_analytics("p1")
+        # Later writes increment the rebuilt summary
+        await db.crm_contacts.insert_one(contact())
+        await server.apply_audience_summary_change(None, contact())
+        stored = await db.crm_audience_summaries.find_one({"promoter_id": "p1"})
+        return summary, stored
+
+    summary, stored = asyncio.run(scenario())
+    assert summary["total_contacts"] == 2
+    assert stored["total_contacts"] == 3 and stored["complete"]
+
+
+def test_rebuild_retries_when_a_write_races_the_count(db, monkeypatch):
+    count = server.count_audience_summary
+    raced = []
+
+    async def racing_count(promoter_id):
+        summary = await count(promoter_id)
+        if not raced:
+            raced.append(1)
+            await db.crm_contacts.insert_one(contact())
+            await server.apply_audience_summary_change(None, contact())
+        return summary
+
+    monkeypatch.setattr(server, "count_audience_summary", racing_count)
+
+    async def scenario():
+        await db.crm_contacts.insert_one(contact())
+        await server.rebuild_audience_summary("p1")
+        return await db.crm_audience_summaries.find_one({"promoter_id": "p1"})
+
+    stored = asyncio.run(scenario())
+    assert stored["total_contacts"] == 2 and stored["complete"]
+
+
+def test_rebuild_between_a_contact_insert_and_its_summary_change_does_not_double_count(db, monkeypatch):
+    apply_change = server.apply_audience_summary_change
+    rebuilt_mid_write = []
+
+    async def rebuild_then_apply(before, after, in_flight=()):
+        if after is not None and not rebuilt_mid_write:
+            # The contact is stored but the summary hasn't counted it yet
+            rebuilt_mid_write.append(await server.rebuild_audience_summary("p1"))
+        await apply_change(before, after, in_flight)
+
+    monkeypatch.setattr(server, "apply_audience_summary_change", rebuild_then_apply)
+    monkeypatch.setattr(server, "AUDIENCE_SUMMARY_RETRY_SECONDS", 0)
+
+    async def scenario():
+        await server.create_crm_contact(server.CRMContact(promoter_id="p1", name="Ann", email="ann@example.com"))
+        created = await db.crm_audience_summaries.find_one({"promoter_id": "p1"})
+        assert created["total_contacts"] == 1 and created["writes_in_flight"] == 0
+        contact_id = (await db.crm_contacts.find_one({"promoter_id": "p1"}))["id"]
+        await server.update_crm_contact(contact_id, {"promoter_id": "p2"})
+        return [await db.crm_audience_summaries.find_one({"promoter_id": promoter_id}) for promoter_id in ("p1", "p2")]
+
+    p1, p2 = asyncio.run(scenario())
+    # The contact counted mid-write was never stored over the summary
+    assert rebuilt_mid_write[0]["total_contacts"] == 1
+    assert p1["total_contacts"] == 0 and p1["writes_in_flight"] == 0
+    assert p2["total_contacts"] == 1 and p2["writes_in_flight"] == 0
@@ -0,0 +1,79 @@
+import asyncio
+from datetime import datetime, timezone
+
+import server
+from server import compute_cohorts_and_rfm
+
+NOW = datetime(2025, 6, 15, tzinfo=timezone.utc).timestamp()
+
+
+def ts(year, month, day=1):
+    return datetime(year, month, day, tzinfo=timezone.utc).timestamp()
+
+
+def test_empty_input():
+    assert compute_cohorts_and_rfm([], [], [], NOW, 12) == {"contacts": 0, "transactions": 0, "cohorts": [], "rfm": None}
+
+
+def test_cohort_retention_counts_distinct_active_contacts_per_month():
+    result = compute_cohorts_and_rfm(
+        ["a", "a", "a", "b", "c"],
+        [ts(2025, 1, 3), ts(2025, 1, 20), ts(2025, 3), ts(2025, 1), ts(2025, 2)],
+        [10, 10, 10, 20, 30],
+        NOW, 3
+    )
+    january, february = result["cohorts"]
+    assert january["cohort"] == "2025-01" and january["size"] == 2
+    assert january["active"] == [2, 0, 1]
+    assert january["retention"] == [1.0, 0.0, 0.5]
+    assert february["cohort"] == "2025-02" and february["active"] == [1, 0, 0]
+    assert result["contacts"] == 3 and result["transactions"] == 5
+
+
+def test_tied_values_are_not_all_scored_top_quintile():
+    # 98 contacts with one purchase, two repeat buyers
+    contact_ids = [f"c{i}" for i in range(100)] + ["c0", "c1"]
+    timestamps = [ts(2025, 5)] * 102
+    amounts = [10.0] * 102
+    rfm = compute_cohorts_and_rfm(contact_ids, timestamps, amounts, NOW, 12)["rfm"]
+
+    assert rfm["score_counts"]["frequency"] == {"1": 0, "2": 0, "3": 98, "4": 0, "5": 2}
+    assert rfm["score_counts"]["monetary"] == {"1": 0, "2": 0, "3": 98, "4": 0, "5": 2}
+    assert rfm["score_counts"]["recency"]["3"] == 100
+    assert {contact["contact_id"] for contact in rfm["top_contacts"][:2]} == {"c0", "c1"}
+
+
+def test_distinct_values_spread_across_quintiles():
+    contact_ids = [f"c{i}" for i in range(10)]
+    timestamps = [ts(2025, 5, i + 1) for i in range(10)]
+    amounts = [float(i + 1) for i in range(10)]
+    rfm = compute_cohorts_and_rfm(contact_ids, timestamps, amounts, NOW, 12)["rfm"]
+
+    assert rfm["score_counts"]["monetary"] == {str(score): 2 for score in range(1, 6)}
+    # Most recent purchase gets the best recency score
+    top_two = rfm["top_contacts"][:2]
+    assert {contact["contact_id"] for contact in top_two} == {"c8", "c9"}
+    assert all(contact["recency"] == 5 and contact["monetary"] == 5 for contact in top_two)
+
+
+def test_cached_cohorts_are_refreshed_by_old_dated_imports_and_refunds(db, monkeypatch):
+    monkeypatch.setattr(server, "cohort_cache", server.OrderedDict())
+
+    def transaction(transaction_id, created_at):
+        return {"id": transaction_id, "promoter_id": "p1", "status": "completed", "contact_id": "c1",
+                "amount": 10.0, "type": "tip", "created_at": created_at}
+
+    async def scenario():
+        await db.crm_transactions.insert_one(transaction("t1", "2025-05-01T00:00:00+00:00"))
+        first = await server.get_crm_cohorts("p1")
+        # A historical import lands with an older created_at
+        await db.crm_transactions.insert_one(transaction("t2", "2025-01-01T00:00:00+00:00"))
+        imported = await server.get_crm_cohorts("p1")
+        await db.crm_transactions.update_one({"id": "t2"}, {"$set": {"status": "refunded"}})
+        refunded = await server.get_crm_cohorts("p1")
+        return first, imported, refunded
+
+    first, imported, refunded = asyncio.run(scenario())
+    assert first["transactions"] == 1
+    assert imported["transactions"] == 2
+    assert refunded["transactions"] == 1
@@ -0,0 +1,22 @@
+import asyncio
+
+import server
+
+
+def test_failing_chunk_only_fails_the_bad_promoter(monkeypatch):
+    async def build_crm_dashboards(promoter_ids):
+        if "bad" in promoter_ids:
+            if len(promoter_ids) > 1:
+                raise RuntimeError("aggregation failed")
+            return {}, {"bad": "no data for bad"}
+        return {promoter_id: {"promoter": promoter_id} for promoter_id in promoter_ids}, {}
+
+    monkeypatch.setattr(server, "build_crm_dashboards", build_crm_dashboards)
+    monkeypatch.setattr(server, "crm_cache", server.StaleWhileRevalidateCache(fresh_ttl=60, stale_ttl=60))
+
+    request = server.CRMDashboardBatchRequest(promoter_ids=["p1", "bad", "p2"])
+    result = asyncio.run(server.get_crm_dashboard_batch(request))
+
+    assert set(result["dashboards"]) == {"p1", "p2"}
+    assert result["errors"] == {"bad": "no data for bad"}
+    assert server.crm_cache.peek(("dashboard", "p1")) == {"promoter": "p1"}
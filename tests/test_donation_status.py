@@ -0,0 +1,79 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import server
+
+
+class FakeStripe:
+    """Stands in for the Stripe gateway and counts status lookups"""
+
+    def __init__(self, payment_status="unpaid", status="open"):
+        self.calls = 0
+        self.payment_status = payment_status
+        self.status = status
+
+    async def checkout(self, stripe_checkout, method, session_id):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return server.CheckoutStatusResponse(status=self.status, payment_status=self.payment_status,
+                                             amount_total=500, currency="usd", metadata={})
+
+
+@pytest.fixture
+def stripe_calls(db, monkeypatch):
+    fake = FakeStripe()
+    monkeypatch.setattr(server, "stripe_gateway", fake)
+    monkeypatch.setattr(server, "get_stripe_checkout", lambda host_url: None)
+    monkeypatch.setattr(server, "donation_status_cache", server.StaleWhileRevalidateCache(fresh_ttl=60, stale_ttl=60))
+    monkeypatch.setattr(server, "donation_status_flight", server.SingleFlight())
+    return fake
+
+
+def transaction(created_ago_seconds):
+    created_at = datetime.now(timezone.utc) - timedelta(seconds=created_ago_seconds)
+    return {"session_id": "cs_1", "amount": 5.0, "currency": "usd", "payment_status": "pending",
+            "status": "initiated", "created_at": created_at.isoformat()}
+
+
+def poll(times=1):
+    request = SimpleNamespace(base_url="http://testserver/")
+
+    async def run():
+        return await asyncio.gather(*(server.get_donation_status("cs_1", request) for _ in range(times)))
+
+    return asyncio.run(run())
+
+
+def test_concurrent_polls_share_one_stripe_call_and_terminal_results_are_cached(db, stripe_calls):
+    asyncio.run(db.payment_transactions.insert_one(transaction(created_ago_seconds=60)))
+    stripe_calls.payment_status, stripe_calls.status = "paid", "complete"
+
+    statuses = poll(times=10)
+
+    assert stripe_calls.calls == 1
+    assert {status.payment_status for status in statuses} == {"paid"}
+    assert asyncio.run(db.payment_transactions.find_one({"session_id": "cs_1"}))["payment_status"] == "paid"
+    assert poll(times=5)[0].payment_status == "paid"
+    assert stripe_calls.calls == 1
+
+
+def test_stripe_is_only_asked_once_a_pending_session_is_due(db, stripe_calls):
+    asyncio.run(db.payment_transactions.insert_one(transaction(created_ago_seconds=1)))
+
+    # Freshly created: the webhook will most likely settle it
+    assert poll(times=3)[0].payment_status == "unpaid"
+    assert stripe_calls.calls == 0
+
+    asyncio.run(db.payment_transactions.update_one(
+        {"session_id": "cs_1"}, {"$set": {"created_at": transaction(created_ago_seconds=60)["created_at"]}}
+    ))
+    poll(times=3)
+    assert stripe_calls.calls == 1
+
+    # The check is stamped, so the next polls wait for the interval again
+    assert asyncio.run(db.payment_transactions.find_one({"session_id": "cs_1"}))["stripe_checked_at"]
+    poll(times=3)
+    assert stripe_calls.calls == 1
@@ -0,0 +1,75 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def cache(db, monkeypatch):
+    entitlement_cache = server.EntitlementCache()
+    monkeypatch.setattr(server, "entitlement_cache", entitlement_cache)
+    asyncio.run(db.stream_tickets.insert_many([
+        {"id": "t-paid", "stream_event_id": "s1", "user_id": "alice", "stripe_session_id": "cs_1", "payment_status": "paid"},
+        {"id": "t-pending", "stream_event_id": "s1", "user_id": "bob", "stripe_session_id": "cs_2", "payment_status": "pending"},
+    ]))
+    return entitlement_cache
+
+
+def test_only_paid_tickets_grant_access(cache):
+    assert asyncio.run(cache.get("s1", "alice"))["ticket_id"] == "t-paid"
+    assert asyncio.run(cache.get("s1", "bob")) is None
+
+    asyncio.run(cache.warm("s1"))
+    assert [user_id for user_id, _ in cache.for_stream("s1")] == ["alice"]
+
+
+def test_marking_a_ticket_paid_grants_access_on_this_worker(cache, db):
+    assert asyncio.run(cache.get("s1", "bob")) is None
+
+    ticket = asyncio.run(db.stream_tickets.find_one({"id": "t-pending"}, projection={"_id": 0}))
+    asyncio.run(server.mark_stream_ticket_paid(ticket))
+
+    assert asyncio.run(cache.get("s1", "bob", "cs_2"))["ticket_id"] == "t-pending"
+
+
+def test_reconciled_expiry_drops_the_ticket(cache, db):
+    cache.put({"id": "t-pending", "stream_event_id": "s1", "user_id": "bob", "payment_status": "pending"})
+    session = SimpleNamespace(id="cs_2", status="expired", payment_status="unpaid", metadata={}, payment_intent=None)
+
+    fixed = asyncio.run(server.StripeReconciler().reconcile_page([session]))
+
+    assert fixed["tickets"] == 1
+    assert asyncio.run(db.stream_tickets.find_one({"id": "t-pending"}))["payment_status"] == "expired"
+    assert ("s1", "bob") not in cache._entries
+
+
+def test_an_entitlement_only_matches_its_own_checkout_session(cache):
+    assert asyncio.run(cache.get("s1", "alice", "cs_1"))["ticket_id"] == "t-paid"
+    assert asyncio.run(cache.get("s1", "alice", "cs_2")) is None
+    assert asyncio.run(cache.get("s1", "alice", "")) is None
+
+
+def test_a_lapsed_paid_ticket_grants_nothing(cache):
+    cache.put({"id": "t-old", "stream_event_id": "s2", "user_id": "alice", "stripe_session_id": "cs_3",
+               "payment_status": "paid", "access_expires": "2020-01-01T00:00:00+00:00"})
+    assert asyncio.run(cache.get("s2", "alice", "cs_3")) is None
+
+
+def test_revoking_drops_the_cached_entitlement_so_the_next_lookup_rereads(cache, db):
+    assert asyncio.run(cache.get("s1", "alice"))["ticket_id"] == "t-paid"
+    assert asyncio.run(cache.get("s1", "alice"))["ticket_id"] == "t-paid"
+    assert (cache.stats["hits"], cache.stats["misses"]) == (1, 1)
+
+    asyncio.run(db.stream_tickets.update_one({"id": "t-paid"}, {"$set": {"payment_status": "refunded"}}))
+    cache.revoke("t-paid")
+
+    assert ("s1", "alice") not in cache._entries
+    assert asyncio.run(cache.get("s1", "alice")) is None
+    assert cache.stats["misses"] == 2
+    # Remembered as a miss until a paid ticket is put back
+    assert asyncio.run(cache.get("s1", "alice")) is None and cache.stats["negative_hits"] == 1
+    cache.put({"id": "t-new", "stream_event_id": "s1", "user_id": "alice", "stripe_session_id": "cs_4",
+               "payment_status": "paid"})
+    assert asyncio.run(cache.get("s1", "alice", "cs_4"))["ticket_id"] == "t-new"
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException, Response
+
+import idempotency
+
+
+class CountingHandler:
+    """Endpoint body stand-in that counts executions and can be held open"""
+
+    def __init__(self):
+        self.calls = 0
+        self.release = None
+
+    async def __call__(self):
+        self.calls += 1
+        if self.release is not None:
+            await self.release.wait()
+        return {"id": f"payout-{self.calls}"}
+
+
+def test_a_retry_replays_the_stored_response(db):
+    handler = CountingHandler()
+
+    async def scenario():
+        store = idempotency.IdempotencyStore()
+        first = await store.run(Response(), "payout", "key-1", {"amount": 10}, handler)
+        replayed = Response()
+        again = await store.run(replayed, "payout", "key-1", {"amount": 10}, handler)
+        # Another worker has nothing in memory and replays from Mongo
+        elsewhere = await idempotency.IdempotencyStore().run(Response(), "payout", "key-1", {"amount": 10}, handler)
+        return first, again, elsewhere, replayed
+
+    first, again, elsewhere, replayed = asyncio.run(scenario())
+    assert handler.calls == 1
+    assert first == again == elsewhere == {"id": "payout-1"}
+    assert replayed.headers["Idempotent-Replayed"] == "true"
+
+
+def test_reusing_a_key_with_a_different_body_is_rejected(db):
+    handler = CountingHandler()
+
+    async def scenario():
+        store = idempotency.IdempotencyStore()
+        await store.run(Response(), "payout", "key-1", {"amount": 10}, handler)
+        with pytest.raises(HTTPException) as reused:
+            await store.run(Response(), "payout", "key-1", {"amount": 99}, handler)
+        return reused.value
+
+    assert asyncio.run(scenario()).status_code == 422
+    assert handler.calls == 1
+
+
+def test_concurrent_callers_wait_for_the_in_flight_request(db):
+    handler = CountingHandler()
+
+    async def scenario():
+        handler.release = asyncio.Event()
+        store = idempotency.IdempotencyStore()
+        other_worker = idempotency.IdempotencyStore()
+        first = asyncio.create_task(store.run(Response(), "payout", "key-1", {"amount": 10}, handler))
+        await asyncio.sleep(0.01)
+        same_worker = asyncio.create_task(store.run(Response(), "payout", "key-1", {"amount": 10}, handler))
+        polling = asyncio.create_task(other_worker.run(Response(), "payout", "key-1", {"amount": 10}, handler))
+        await asyncio.sleep(0.05)
+        assert not same_worker.done() and not polling.done()
+        handler.release.set()
+        return await asyncio.gather(first, same_worker, polling)
+
+    assert asyncio.run(scenario()) == [{"id": "payout-1"}] * 3
+    assert handler.calls == 1
+
+
+def test_a_failed_request_releases_its_key(db):
+    attempts = []
+
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("gateway down")
+        return {"id": "payout-1"}
+
+    async def scenario():
+        store = idempotency.IdempotencyStore()
+        with pytest.raises(RuntimeError):
+            await store.run(Response(), "payout", "key-1", {"amount": 10}, flaky)
+        return await store.run(Response(), "payout", "key-1", {"amount": 10}, flaky)
+
+    assert asyncio.run(scenario()) == {"id": "payout-1"}
+    assert len(attempts) == 2
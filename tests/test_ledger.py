@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+import ledger
+import server
+
+
+@pytest.fixture
+def ledger_db(db):
+    asyncio.run(db.crm_transactions.create_index("id", unique=True))
+    asyncio.run(db.crm_ledgers.create_index("promoter_id", unique=True))
+    return db
+
+
+def sale(sale_id, amount):
+    return server.SaleRecord(id=sale_id, promoter_id="p1", type="tip", amount=amount)
+
+
+def stored_ledger(db):
+    return asyncio.run(db.crm_ledgers.find_one({"promoter_id": "p1"}, projection={"_id": 0}))
+
+
+def test_rebuild_rounds_fees_per_transaction_like_credits(ledger_db):
+    asyncio.run(server.rebuild_promoter_ledger("p1"))
+    asyncio.run(server.record_sales([sale(f"s{i}", 1.05) for i in range(3)]))
+    incremental = stored_ledger(ledger_db)
+
+    asyncio.run(server.rebuild_promoter_ledger("p1"))
+    rebuilt = stored_ledger(ledger_db)
+
+    assert incremental["fees"] == pytest.approx(0.33)
+    for field in ("earned", "fees", "available_balance"):
+        assert rebuilt[field] == pytest.approx(incremental[field])
+
+
+def test_rebuild_skips_a_ledger_with_a_reservation_in_flight(ledger_db):
+    asyncio.run(server.record_sales([sale("s1", 100.0)]))
+    asyncio.run(server.rebuild_promoter_ledger("p1"))
+
+    assert asyncio.run(server.reserve_payout_balance("p1", 50.0)) is not None
+    # The payout record isn't written yet; a rebuild now would hand the 50 back
+    assert asyncio.run(server.rebuild_promoter_ledgers(["p1"])) == 0
+    assert stored_ledger(ledger_db)["available_balance"] == pytest.approx(40.0)
+
+    asyncio.run(ledger_db.crm_payouts.insert_one({"promoter_id": "p1", "amount": 50.0, "status": "pending"}))
+    asyncio.run(server.confirm_payout_reservation("p1"))
+    assert asyncio.run(server.rebuild_promoter_ledgers(["p1"])) == 1
+    assert stored_ledger(ledger_db)["available_balance"] == pytest.approx(40.0)
+    assert stored_ledger(ledger_db)["pending_payouts"] == pytest.approx(50.0)
+
+
+def test_rebuild_does_not_overwrite_a_concurrent_change(ledger_db, monkeypatch):
+    asyncio.run(server.record_sales([sale("s1", 100.0)]))
+    asyncio.run(server.rebuild_promoter_ledger("p1"))
+    aggregate_by_id = ledger.aggregate_by_id
+    raced = []
+
+    async def aggregate_then_race(collection, pipeline):
+        results = await aggregate_by_id(collection, pipeline)
+        await asyncio.sleep(0)
+        if not raced:
+            # A sale lands after the rebuild has read its history
+            raced.append(True)
+            await server.record_sales([sale("s2", 10.0)])
+        return results
+
+    monkeypatch.setattr(ledger, "aggregate_by_id", aggregate_then_race)
+    assert asyncio.run(server.rebuild_promoter_ledgers(["p1"])) == 1
+    assert stored_ledger(ledger_db)["earned"] == pytest.approx(110.0)
+
+
+def test_refund_debits_the_ledger_and_rebuild_agrees(ledger_db):
+    asyncio.run(server.rebuild_promoter_ledger("p1"))
+    asyncio.run(server.record_sales([sale("s1", 100.0), sale("s2", 20.0)]))
+
+    assert asyncio.run(server.refund_crm_transaction("s2"))["status"] == "refunded"
+    assert asyncio.run(server.refund_crm_transaction("s2")) is None
+    assert stored_ledger(ledger_db)["available_balance"] == pytest.approx(90.0)
+
+    asyncio.run(server.rebuild_promoter_ledger("p1"))
+    assert stored_ledger(ledger_db)["available_balance"] == pytest.approx(90.0)
+
+
+def test_rebuild_waits_for_a_sale_whose_ledger_credit_is_not_flagged_yet(ledger_db, monkeypatch):
+    asyncio.run(server.record_sales([sale("s1", 100.0)]))
+    asyncio.run(server.rebuild_promoter_ledger("p1"))
+    mark_sale_steps_applied = server.mark_sale_steps_applied
+    rebuilt_mid_sale = []
+
+    async def rebuild_then_mark(step, transaction_ids):
+        if step == "ledger":
+            # The credit has landed but the transaction doesn't say so yet
+            rebuilt_mid_sale.append(await server.rebuild_promoter_ledgers(["p1"]))
+        await mark_sale_steps_applied(step, transaction_ids)
+
+    monkeypatch.setattr(server, "mark_sale_steps_applied", rebuild_then_mark)
+    asyncio.run(server.record_sales([sale("s2", 10.0)]))
+
+    assert rebuilt_mid_sale == [0]
+    assert stored_ledger(ledger_db)["earned"] == pytest.approx(110.0)
+    monkeypatch.setattr(server, "mark_sale_steps_applied", mark_sale_steps_applied)
+    assert asyncio.run(server.rebuild_promoter_ledgers(["p1"])) == 1
+    assert stored_ledger(ledger_db)["earned"] == pytest.approx(110.0)
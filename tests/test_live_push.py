@@ -0,0 +1,51 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException
+
+import server
+from server import TopicHub
+
+
+def test_publish_fans_out_one_serialized_message():
+    hub = TopicHub(queue_size=10)
+    first, second = hub.subscribe("t"), hub.subscribe("t")
+    assert hub.publish("t", {"a": 1}) == 2
+    assert first.queue.get_nowait() == second.queue.get_nowait() == json.dumps({"a": 1})
+
+
+def test_slow_subscriber_is_dropped_instead_of_blocking():
+    hub = TopicHub(queue_size=1)
+    slow = hub.subscribe("t")
+    hub.publish("t", "one")
+    assert hub.publish("t", "two") == 0
+    assert slow.closed and hub.subscriber_count("t") == 0
+    assert hub.dropped_subscribers == 1
+
+
+def test_delta_published_while_snapshot_builds_reaches_the_client(monkeypatch):
+    async def build_stream_metrics(stream_id):
+        server.publish_stream_delta(stream_id, "viewer_joined", "u1")
+        return {"stream_id": stream_id}
+
+    monkeypatch.setattr(server, "build_stream_metrics", build_stream_metrics)
+
+    async def scenario():
+        await server.stream_metrics_live("s1", request=None)
+        [subscription] = server.live_hub._subscribers[server.stream_topic("s1")]
+        message = json.loads(subscription.queue.get_nowait())
+        server.live_hub.unsubscribe(subscription)
+        return message
+
+    assert asyncio.run(scenario())["event_type"] == "viewer_joined"
+
+
+def test_missing_stream_releases_its_subscription(monkeypatch):
+    async def build_stream_metrics(stream_id):
+        return None
+
+    monkeypatch.setattr(server, "build_stream_metrics", build_stream_metrics)
+    with pytest.raises(HTTPException):
+        asyncio.run(server.stream_metrics_live("missing", request=None))
+    assert server.live_hub.subscriber_count(server.stream_topic("missing")) == 0
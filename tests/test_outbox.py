@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+from pymongo.errors import OperationFailure
+
+import outbox
+import server
+
+
+@pytest.fixture
+def worker(db):
+    return outbox.OutboxWorker(server.OUTBOX_HANDLERS, batch_size=10, backoff_base=0)
+
+
+def test_each_effect_is_recorded_as_soon_as_it_succeeds(db, worker, monkeypatch):
+    seen_during_second = []
+
+    async def first():
+        pass
+
+    async def second():
+        message = await db.outbox_events.find_one({"topic": "test.topic"})
+        seen_during_second.append(list(message["effects_done"]))
+        raise RuntimeError("downstream unavailable")
+
+    async def handler(payload):
+        return [("first", first), ("second", second)]
+
+    monkeypatch.setitem(server.OUTBOX_HANDLERS, "test.topic", handler)
+    asyncio.run(db.outbox_events.insert_one(server.outbox_message("test", "a-1", "test.topic", {})))
+
+    assert asyncio.run(worker.process_batch()) == 1
+
+    assert seen_during_second == [["first"]]
+    message = asyncio.run(db.outbox_events.find_one({"topic": "test.topic"}))
+    assert message["status"] == "pending" and message["effects_done"] == ["first"]
+
+
+def test_only_known_errors_mean_transactions_are_unavailable():
+    unavailable = outbox.Outbox._transactions_unavailable
+    assert unavailable(OperationFailure("Transaction numbers are only allowed on a replica set member", code=20))
+    assert unavailable(NotImplementedError("sessions"))
+    assert not unavailable(OperationFailure("not primary", code=10107))
+    assert not unavailable(TypeError("bad document"))
+    assert not unavailable(AttributeError("bug"))
+
+
+def test_unpaid_completed_checkout_does_not_emit_payment_completed():
+    event = {"session_id": "cs_1", "payment_status": "unpaid", "metadata": {"type": "stream_ticket"}}
+    collections = [collection for collection, _ in server.checkout_completed_operations(event)]
+    assert collections == ["payment_transactions"]
+
+    for payment_status in server.SETTLED_PAYMENT_STATUSES:
+        operations = server.checkout_completed_operations({**event, "payment_status": payment_status})
+        assert [collection for collection, _ in operations] == ["outbox_events", "payment_transactions"]
@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+import payouts
+
+
+class RecordingGateway:
+    """Pays everything; optionally runs a hook while the batch is 'in flight'"""
+
+    def __init__(self, during_submit=None):
+        self.during_submit = during_submit
+        self.keys = []
+
+    async def submit_batch(self, payout_method, batch):
+        self.keys += [payout["idempotency_key"] for payout in batch]
+        if self.during_submit is not None:
+            await self.during_submit()
+        return [payouts.PayoutResult(payout_id=payout["id"], success=True, reference=f"ref-{payout['id']}")
+                for payout in batch]
+
+
+@pytest.fixture
+def payouts_db(db):
+    asyncio.run(db.crm_ledgers.insert_one(
+        {"promoter_id": "p1", "available_balance": 0.0, "pending_payouts": 30.0, "paid_out": 0.0}
+    ))
+    asyncio.run(db.crm_payouts.insert_many([
+        {"id": "po-1", "promoter_id": "p1", "amount": 10.0, "status": "pending", "created_at": "2026-01-01T00:00:00+00:00"},
+        {"id": "po-2", "promoter_id": "p1", "amount": 20.0, "status": "pending", "created_at": "2026-01-01T00:00:01+00:00"},
+    ]))
+    return db
+
+
+def ledger(db):
+    return asyncio.run(db.crm_ledgers.find_one({"promoter_id": "p1"}))
+
+
+def test_payout_whose_lease_was_lost_does_not_move_the_ledger(payouts_db):
+    async def lease_taken_over():
+        await payouts_db.crm_payouts.update_one({"id": "po-2"}, {"$set": {"lease_id": "other-worker"}})
+
+    engine = payouts.PayoutEngine(RecordingGateway(lease_taken_over))
+    assert asyncio.run(engine.process_batch()) == 2
+
+    assert ledger(payouts_db)["paid_out"] == pytest.approx(10.0)
+    assert ledger(payouts_db)["pending_payouts"] == pytest.approx(20.0)
+    lost = asyncio.run(payouts_db.crm_payouts.find_one({"id": "po-2"}))
+    assert lost["status"] == "processing" and lost["lease_id"] == "other-worker"
+    assert engine.stats["paid"] == 1
+
+
+def test_payout_id_is_the_idempotency_key_across_retries(payouts_db):
+    class FlakyGateway(RecordingGateway):
+        async def submit_batch(self, payout_method, batch):
+            if not self.keys:
+                self.keys += [payout["idempotency_key"] for payout in batch]
+                raise ConnectionError("timed out")
+            return await super().submit_batch(payout_method, batch)
+
+    gateway = FlakyGateway()
+    engine = payouts.PayoutEngine(gateway, retry_seconds=0)
+    asyncio.run(engine.process_batch())
+    asyncio.run(engine.process_batch())
+
+    assert gateway.keys == ["payout:po-1", "payout:po-2"] * 2
+    assert ledger(payouts_db)["paid_out"] == pytest.approx(30.0)
+
+
+def test_no_gateway_is_configured_by_default(monkeypatch):
+    monkeypatch.delenv("PAYOUT_GATEWAY", raising=False)
+    assert payouts.load_payout_gateway() is None
+    monkeypatch.setenv("PAYOUT_GATEWAY", "local")
+    assert isinstance(payouts.load_payout_gateway(), payouts.LocalPayoutGateway)
@@ -0,0 +1,160 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import jwt
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+
+
+@pytest.fixture
+def revoked(monkeypatch):
+    revoked_tickets = server.RevokedTicketSet()
+    monkeypatch.setattr(server, "revoked_tickets", revoked_tickets)
+    return revoked_tickets
+
+
+@pytest.fixture
+def client(db, revoked, monkeypatch):
+    monkeypatch.setenv("ADMIN_API_KEY", "admin-secret")
+    monkeypatch.setattr(server, "entitlement_cache", server.EntitlementCache())
+    monkeypatch.setattr(server, "preissued_tokens", server.PreissuedTokenStore(lead_minutes=10, fetch_jitter_seconds=0))
+    monkeypatch.setattr(server, "playback_token_buffer", server.WriteBehindBuffer("playback_tokens", max_batch=1000))
+    asyncio.run(db.stream_tickets.insert_many([
+        {"id": "t-1", "stream_event_id": "s1", "user_id": "alice", "stripe_session_id": "cs_alice",
+         "payment_status": "paid"},
+        {"id": "t-2", "stream_event_id": "s1", "user_id": "bob", "stripe_session_id": "cs_bob",
+         "payment_status": "paid"},
+    ]))
+    return TestClient(server.app)
+
+
+def test_admission_gate_admits_the_burst_then_spaces_and_rejects(monkeypatch):
+    sleeps = []
+
+    async def fake_sleep(seconds):
+        sleeps.append(seconds)
+
+    monkeypatch.setattr(server.asyncio, "sleep", fake_sleep)
+    gate = server.AdmissionGate(rate=10, burst=2, max_wait=0.25)
+
+    async def run():
+        for _ in range(5):
+            await gate.acquire()
+        with pytest.raises(server.AdmissionRejected) as rejected:
+            await gate.acquire()
+        return rejected.value
+
+    rejected = asyncio.run(run())
+    assert (gate.admitted, gate.delayed, gate.rejected) == (5, 2, 1)
+    assert sleeps == pytest.approx([0.1, 0.2], abs=0.01)
+    assert rejected.retry_after == 1
+
+
+def test_old_kid_still_verifies_after_rotation(revoked):
+    old = server.PlaybackTokenSigner({"k1": "one"}, active_kid="k1")
+    token, _ = old.issue("alice", "s1", "t-1")
+    rotated = server.PlaybackTokenSigner({"k1": "one", "k2": "two"}, active_kid="k2")
+
+    assert rotated.verify(token, "s1")["sub"] == "alice"
+    assert jwt.get_unverified_header(rotated.issue("alice", "s1", "t-1")[0])["kid"] == "k2"
+
+
+def test_token_signed_with_a_retired_kid_is_rejected(revoked):
+    token, _ = server.PlaybackTokenSigner({"k1": "one"}, active_kid="k1").issue("alice", "s1", "t-1")
+    with pytest.raises(server.PlaybackTokenError, match="Unknown signing key"):
+        server.PlaybackTokenSigner({"k2": "two"}, active_kid="k2").verify(token)
+
+
+def test_token_is_scoped_to_its_stream_and_expires(revoked):
+    signer = server.PlaybackTokenSigner({"k1": "one"}, leeway=0)
+    token, _ = signer.issue("alice", "s1", "t-1")
+    with pytest.raises(server.PlaybackTokenError) as wrong_stream:
+        signer.verify(token, "s2")
+    assert wrong_stream.value.status_code == 403
+
+    expired = jwt.encode(
+        {"sub": "alice", "stream_id": "s1", "ticket_id": "t-1", "scope": "stream:s1",
+         "iat": int((datetime.now(timezone.utc) - timedelta(minutes=20)).timestamp()),
+         "exp": int((datetime.now(timezone.utc) - timedelta(minutes=10)).timestamp())},
+        "one", algorithm="HS256", headers={"kid": "k1"}
+    )
+    with pytest.raises(server.PlaybackTokenError, match="Token expired"):
+        signer.verify(expired, "s1")
+
+
+def test_playback_token_requires_the_buyers_checkout_session(client):
+    url = "/api/streams/s1/playback-token"
+    assert client.post(url, json={"stream_event_id": "s1", "user_id": "alice"}).status_code == 401
+    stolen = client.post(url, json={"stream_event_id": "s1", "user_id": "alice", "session_id": "cs_bob"})
+    assert stolen.status_code == 403
+
+    response = client.post(url, json={"stream_event_id": "s1", "user_id": "alice", "session_id": "cs_alice"})
+    assert response.status_code == 200
+    assert server.verify_playback_token(response.json()["token"], "s1")["ticket_id"] == "t-1"
+
+
+def test_preissued_token_requires_the_session_and_outlives_the_lead_time(client):
+    asyncio.run(server.preissued_tokens.issue_for_stream("s1"))
+    url = "/api/streams/s1/playback-token"
+
+    assert client.get(url, params={"user_id": "alice"}).status_code == 401
+    assert client.get(url, params={"user_id": "alice", "session_id": "cs_bob"}).status_code == 404
+
+    response = client.get(url, params={"user_id": "alice", "session_id": "cs_alice"})
+    assert response.status_code == 200
+    ttl = server.playback_token_signer.ttl_seconds
+    assert ttl < response.json()["expires_in"] <= 10 * 60 + ttl
+
+
+def test_preissued_token_is_not_resigned_at_go_live(client, monkeypatch):
+    asyncio.run(server.preissued_tokens.issue_for_stream("s1"))
+    entry = server.preissued_tokens._tokens["s1"]["alice"]
+    # The lead time has passed: the stream is starting
+    entry["expires_at"] -= timedelta(minutes=10)
+    signed = []
+
+    async def sign(*args, **kwargs):
+        signed.append(args)
+
+    monkeypatch.setattr(server.preissued_tokens, "_sign", sign)
+    assert asyncio.run(server.preissued_tokens.get("s1", "alice", "cs_alice")) is entry
+    assert signed == []
+
+
+def test_preissued_token_is_resigned_once_half_its_ttl_has_passed(client):
+    asyncio.run(server.preissued_tokens.issue_for_stream("s1"))
+    entry = server.preissued_tokens._tokens["s1"]["alice"]
+    entry["expires_at"] = datetime.now(timezone.utc) + timedelta(seconds=server.playback_token_signer.ttl_seconds / 4)
+    refreshed = asyncio.run(server.preissued_tokens.get("s1", "alice", "cs_alice"))
+    assert refreshed["expires_at"] > datetime.now(timezone.utc) + timedelta(seconds=server.playback_token_signer.ttl_seconds / 2)
+
+
+def test_revoke_requires_credentials(client):
+    assert client.post("/api/streams/tickets/t-1/revoke").status_code == 401
+    wrong_key = client.post("/api/streams/tickets/t-1/revoke", headers={"X-Admin-Key": "guess"})
+    assert wrong_key.status_code == 401
+
+
+def test_admin_key_is_ignored_when_unset(client, monkeypatch):
+    monkeypatch.delenv("ADMIN_API_KEY")
+    assert client.post("/api/streams/tickets/t-1/revoke", headers={"X-Admin-Key": ""}).status_code == 401
+
+
+def test_admin_can_revoke_any_ticket(client, revoked):
+    response = client.post("/api/streams/tickets/t-1/revoke", headers={"X-Admin-Key": "admin-secret"})
+    assert response.status_code == 200
+    assert revoked.might_contain("t-1")
+
+
+def test_viewer_can_only_revoke_their_own_ticket(client, revoked):
+    token, _ = server.playback_token_signer.issue("alice", "s1", "t-1")
+    headers = {"Authorization": f"Bearer {token}"}
+
+    assert client.post("/api/streams/tickets/t-2/revoke", headers=headers).status_code == 403
+    assert not revoked.might_contain("t-2")
+
+    assert client.post("/api/streams/tickets/t-1/revoke", headers=headers).status_code == 200
+    assert revoked.might_contain("t-1")
+    assert client.get("/api/streams/verify-token", params={"stream_id": "s1", "token": token}).status_code == 403
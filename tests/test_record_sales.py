@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def sales_db(db):
+    async def setup():
+        await db.crm_transactions.create_index("id", unique=True)
+        await db.stream_events.insert_one({"id": "e1", "tickets_sold": 0, "revenue": 0.0})
+        await db.crm_ledgers.insert_one({"promoter_id": "p1", "earned": 0.0, "fees": 0.0, "available_balance": 0.0})
+    asyncio.run(setup())
+    return db
+
+
+def sale(sale_id="sale-1", amount=10.0):
+    return server.SaleRecord(id=sale_id, promoter_id="p1", event_id="e1", type="stream_view",
+                             amount=amount, user_id="alice", event_name="Show")
+
+
+def event(db):
+    return asyncio.run(db.stream_events.find_one({"id": "e1"}))
+
+
+def test_recording_a_sale_again_is_a_duplicate(sales_db):
+    assert asyncio.run(server.record_sales([sale()]))["recorded"] == 1
+    assert asyncio.run(server.record_sales([sale()])) == {"received": 1, "recorded": 0, "duplicates": 1}
+
+    assert event(sales_db)["tickets_sold"] == 1
+    transaction = asyncio.run(sales_db.crm_transactions.find_one({"id": "sale-1"}))
+    assert transaction["status"] == "completed" and "applied_steps" not in transaction
+
+
+def test_interrupted_batch_resumes_only_the_missing_steps(sales_db, monkeypatch):
+    write_sale_contacts = server.write_sale_contacts
+
+    async def crash(contacts, now):
+        raise RuntimeError("connection reset")
+
+    monkeypatch.setattr(server, "write_sale_contacts", crash)
+    with pytest.raises(RuntimeError):
+        asyncio.run(server.record_sales([sale()]))
+    transaction = asyncio.run(sales_db.crm_transactions.find_one({"id": "sale-1"}))
+    assert transaction["status"] == "recording"
+    assert sorted(transaction["applied_steps"]) == ["events", "ledger", "rollups"]
+
+    # A replay while the first call might still be running leaves it alone
+    monkeypatch.setattr(server, "write_sale_contacts", write_sale_contacts)
+    assert asyncio.run(server.record_sales([sale()]))["recorded"] == 0
+
+    monkeypatch.setattr(server, "SALES_RECORDING_STALE_SECONDS", -1)
+    assert asyncio.run(server.record_sales([sale()]))["recorded"] == 1
+
+    assert event(sales_db)["tickets_sold"] == 1
+    assert asyncio.run(sales_db.crm_ledgers.find_one({"promoter_id": "p1"}))["earned"] == 10.0
+    assert asyncio.run(sales_db.crm_contacts.count_documents({"promoter_id": "p1", "user_id": "alice"})) == 1
+    assert asyncio.run(sales_db.crm_transactions.find_one({"id": "sale-1"}))["status"] == "completed"
+
+
+def test_pending_transaction_is_completed_but_refunded_one_is_kept(sales_db):
+    asyncio.run(sales_db.crm_transactions.insert_many([
+        {"id": "sale-1", "promoter_id": "p1", "amount": 10.0, "status": "pending"},
+        {"id": "sale-2", "promoter_id": "p1", "amount": 10.0, "status": "refunded"},
+    ]))
+
+    result = asyncio.run(server.record_sales([sale("sale-1"), sale("sale-2")]))
+
+    assert result["recorded"] == 1
+    statuses = {t["id"]: t["status"] for t in asyncio.run(sales_db.crm_transactions.find().to_list(None))}
+    assert statuses == {"sale-1": "completed", "sale-2": "refunded"}
+
+
+def test_non_unique_transaction_id_index_is_replaced(db):
+    asyncio.run(db.crm_transactions.create_index("id"))
+
+    asyncio.run(server.ensure_unique_transaction_ids())
+
+    assert asyncio.run(db.crm_transactions.index_information())["id_1"].get("unique")
+
+
+def test_sales_import_requires_the_admin_key(sales_db, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setenv("ADMIN_API_KEY", "admin-secret")
+    client = TestClient(server.app)
+    body = {"sales": [{"id": "sale-1", "promoter_id": "p1", "event_id": "e1", "type": "stream_view",
+                       "amount": 10.0, "user_id": "alice"}]}
+
+    assert client.post("/api/crm/sales/import", json=body).status_code == 401
+    assert client.post("/api/crm/sales/import", json=body, headers={"X-Admin-Key": "guess"}).status_code == 401
+    assert asyncio.run(sales_db.crm_transactions.count_documents({})) == 0
+
+    response = client.post("/api/crm/sales/import", json=body, headers={"X-Admin-Key": "admin-secret"})
+    assert response.status_code == 200 and response.json()["recorded"] == 1
+
+
+def test_recorded_sales_are_linked_to_the_buyers_contact(sales_db):
+    asyncio.run(sales_db.crm_contacts.insert_one({"id": "c-bob", "promoter_id": "p1", "user_id": "bob"}))
+    bob = server.SaleRecord(id="sale-2", promoter_id="p1", event_id="e1", type="stream_view", amount=5.0, user_id="bob")
+    named = server.SaleRecord(id="sale-3", promoter_id="p1", type="tip", amount=1.0, contact_id="c-bob")
+
+    asyncio.run(server.record_sales([sale(), bob, named]))
+
+    alice = asyncio.run(sales_db.crm_contacts.find_one({"promoter_id": "p1", "user_id": "alice"}))
+    contact_ids = {t["id"]: t["contact_id"] for t in asyncio.run(sales_db.crm_transactions.find().to_list(None))}
+    assert contact_ids == {"sale-1": alice["id"], "sale-2": "c-bob", "sale-3": "c-bob"}
@@ -0,0 +1,161 @@
+import asyncio
+
+from server import SingleFlight, StaleWhileRevalidateCache
+
+
+def test_fresh_entry_is_served_without_reloading():
+    cache = StaleWhileRevalidateCache(fresh_ttl=60, stale_ttl=120)
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        return len(calls)
+
+    async def scenario():
+        first, _ = await cache.get("k", loader)
+        second, _ = await cache.get("k", loader)
+        return first, second
+
+    assert asyncio.run(scenario()) == (1, 1)
+    assert len(calls) == 1
+
+
+def test_stale_entry_is_served_while_refreshing_in_background():
+    cache = StaleWhileRevalidateCache(fresh_ttl=0, stale_ttl=60)
+    values = iter(["old", "new"])
+
+    async def loader():
+        return next(values)
+
+    async def scenario():
+        await cache.get("k", loader)
+        stale, _ = await cache.get("k", loader)
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        return stale, cache._entries["k"][0]
+
+    assert asyncio.run(scenario()) == ("old", "new")
+
+
+def test_concurrent_misses_share_one_load():
+    cache = StaleWhileRevalidateCache(fresh_ttl=60, stale_ttl=60)
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "value"
+
+    async def scenario():
+        return await asyncio.gather(*(cache.get("k", loader) for _ in range(5)))
+
+    results = asyncio.run(scenario())
+    assert [value for value, _ in results] == ["value"] * 5
+    assert len(calls) == 1
+
+
+def test_invalidation_during_load_keeps_stale_result_out_of_cache():
+    cache = StaleWhileRevalidateCache(fresh_ttl=60, stale_ttl=60)
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def slow_loader():
+            await release.wait()
+            return "read before the write"
+
+        load = asyncio.ensure_future(cache.get("k", slow_loader))
+        await asyncio.sleep(0)
+        cache.invalidate("k")
+        release.set()
+        value, _ = await load
+        return value
+
+    assert asyncio.run(scenario()) == "read before the write"
+    assert cache.peek("k") is None
+
+
+def test_entries_are_evicted_oldest_first():
+    cache = StaleWhileRevalidateCache(fresh_ttl=60, stale_ttl=60, max_entries=2)
+
+    async def scenario():
+        for key in ("a", "b", "c"):
+            await cache.get(key, lambda key=key: asyncio.sleep(0, result=key))
+
+    asyncio.run(scenario())
+    assert cache.peek("a") is None
+    assert cache.peek("b") == "b" and cache.peek("c") == "c"
+
+
+def test_single_flight_survives_a_cancelled_caller():
+    flight = SingleFlight()
+
+    async def scenario():
+        async def work():
+            await asyncio.sleep(0.01)
+            return 42
+
+        first = asyncio.ensure_future(flight.do("k", work))
+        second = asyncio.ensure_future(flight.do("k", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(scenario()) == 42
+
+
+def test_invalidation_before_background_refresh_runs_is_honoured():
+    cache = StaleWhileRevalidateCache(fresh_ttl=0, stale_ttl=60)
+    values = iter(["old", "refreshed from a pre-write read"])
+
+    async def loader():
+        return next(values)
+
+    async def scenario():
+        await cache.get("k", loader)
+        await cache.get("k", loader)  # stale: schedules the refresh
+        cache.invalidate("k")
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+    assert "k" not in cache._entries
+
+
+def test_get_many_loads_missing_keys_in_one_call():
+    cache = StaleWhileRevalidateCache(fresh_ttl=60, stale_ttl=60)
+    batches = []
+
+    async def loader(keys):
+        batches.append(keys)
+        return {key: key.upper() if key != "bad" else RuntimeError("boom") for key in keys}
+
+    async def scenario():
+        await cache.get("a", lambda: asyncio.sleep(0, result="cached"))
+        return await cache.get_many(["a", "b", "bad"], loader)
+
+    results = asyncio.run(scenario())
+    assert batches == [["b", "bad"]]
+    assert results["a"] == "cached" and results["b"] == "B"
+    assert isinstance(results["bad"], RuntimeError)
+    assert cache.peek("b") == "B" and cache.peek("bad") is None
+
+
+def test_get_many_does_not_overwrite_a_later_invalidation():
+    cache = StaleWhileRevalidateCache(fresh_ttl=60, stale_ttl=60)
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def loader(keys):
+            await release.wait()
+            return {key: "read before the write" for key in keys}
+
+        batch = asyncio.ensure_future(cache.get_many(["k"], loader))
+        await asyncio.sleep(0)
+        cache.invalidate("k")
+        release.set()
+        return await batch
+
+    assert asyncio.run(scenario())["k"] == "read before the write"
+    assert cache.peek("k") is None
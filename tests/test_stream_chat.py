@@ -0,0 +1,42 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+import server
+
+
+@pytest.fixture
+def client(db):
+    return TestClient(server.app)
+
+
+def token_for(user_id, stream_id="s1"):
+    token, _ = server.playback_token_signer.issue(user_id, stream_id, "t-1")
+    return token
+
+
+def test_message_is_attributed_to_the_token_subject(client):
+    with client.websocket_connect(f"/api/streams/s1/chat/ws?token={token_for('alice')}&display_name=Bob") as ws:
+        ws.send_text("hello")
+        message = json.loads(ws.receive_text())
+    assert message["user_id"] == "alice" and message["text"] == "hello"
+
+
+def test_token_can_be_sent_as_the_first_frame(client):
+    with client.websocket_connect("/api/streams/s3/chat/ws") as ws:
+        ws.send_text(json.dumps({"token": token_for("carol", stream_id="s3")}))
+        ws.send_text("hi")
+        assert json.loads(ws.receive_text())["user_id"] == "carol"
+
+
+@pytest.mark.parametrize("query", ["", "?token=garbage", "?token={other_stream}"])
+def test_connection_without_a_valid_token_for_the_stream_is_closed(client, query):
+    query = query.format(other_stream=token_for("mallory", stream_id="s2"))
+    with client.websocket_connect(f"/api/streams/s1/chat/ws{query}") as ws:
+        if not query:
+            ws.send_text("not a token")
+        with pytest.raises(WebSocketDisconnect) as closed:
+            ws.receive_text()
+    assert closed.value.code == server.CHAT_UNAUTHORIZED_CLOSE_CODE
@@ -0,0 +1,52 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+
+class RecordingHub:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, message):
+        self.published.append((topic, message))
+
+
+@pytest.fixture
+def hub(monkeypatch):
+    recording_hub = RecordingHub()
+    monkeypatch.setattr(server, "live_hub", recording_hub)
+    return recording_hub
+
+
+def test_mock_schedule_is_relative_to_now():
+    now = datetime.now(timezone.utc)
+    live, upcoming = server.mock_streams()
+    assert live["start_time"] <= now <= upcoming["start_time"]
+
+
+def test_only_the_worker_that_applies_a_transition_publishes_it(db, hub, monkeypatch):
+    ended_at = (datetime.now(timezone.utc) - timedelta(seconds=1)).isoformat()
+    asyncio.run(db.stream_events.insert_one({
+        "id": "s-end", "status": "live", "start_time": ended_at, "end_time": ended_at
+    }))
+    forgotten = []
+    monkeypatch.setattr(server.entitlement_cache, "forget_stream", forgotten.append)
+    workers = [server.StreamStatusScheduler(server.StreamFeed()) for _ in range(2)]
+
+    async def run():
+        for worker in workers:
+            await worker.reload()
+        for worker in workers:
+            await worker._apply_due()
+
+    asyncio.run(run())
+
+    assert hub.published == [(server.stream_topic("s-end"), {"type": "status", "status": "ended"})]
+    assert [worker.transitions for worker in workers] == [1, 0]
+    # Both workers drop their local state for the ended stream
+    assert forgotten == ["s-end", "s-end"]
+    assert all(worker.stream("s-end") is None for worker in workers)
+    assert asyncio.run(db.stream_events.find_one({"id": "s-end"}))["status"] == "ended"
@@ -0,0 +1,51 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+START = datetime(2025, 6, 1, 20, 0, tzinfo=timezone.utc)
+
+
+def bucket(minutes, **counters):
+    return {"stream_event_id": "s1", "minute": START + timedelta(minutes=minutes), **counters}
+
+
+@pytest.fixture
+def buckets(db):
+    asyncio.run(db.stream_metrics_minutely.insert_many([
+        bucket(-1, joins=100),  # before 'from'
+        bucket(0, joins=3, peak_viewers=40, chat_messages=4),
+        bucket(1, joins=2, peak_viewers=55, chat_messages=2, tip_amount=5.0),
+        bucket(3, leaves=1, peak_viewers=20),
+        bucket(6, joins=100),  # after 'to'
+    ]))
+    return db
+
+
+def timeseries(start, end, step):
+    return asyncio.run(server.get_stream_metrics_timeseries("s1", start=start, end=end, step=step))
+
+
+def test_buckets_fold_into_aligned_steps_and_gaps_are_zero(buckets):
+    result = timeseries(START + timedelta(seconds=30), START + timedelta(minutes=5, seconds=10), step=2)
+
+    assert result["from"] == START and result["to"] == START + timedelta(minutes=6)
+    assert [point["time"] for point in result["points"]] == [START + timedelta(minutes=m) for m in (0, 2, 4)]
+    first, second, empty = result["points"]
+    assert (first["joins"], first["peak_viewers"], first["tip_amount"], first["chat_rate_per_minute"]) == (5, 55, 5.0, 3.0)
+    assert (second["leaves"], second["peak_viewers"]) == (1, 20)
+    assert empty == {"time": START + timedelta(minutes=4), "peak_viewers": 0, "joins": 0, "leaves": 0,
+                     "chat_messages": 0, "tips_sent": 0, "tip_amount": 0, "chat_rate_per_minute": 0.0}
+
+
+def test_bounds_are_validated(db):
+    with pytest.raises(HTTPException) as backwards:
+        timeseries(START, START - timedelta(minutes=5), step=1)
+    assert backwards.value.status_code == 400
+
+    with pytest.raises(HTTPException) as too_long:
+        timeseries(START, START + timedelta(minutes=server.STREAM_TIMESERIES_MAX_POINTS + 1), step=1)
+    assert too_long.value.status_code == 400
@@ -0,0 +1,86 @@
+import asyncio
+import time
+
+import pytest
+
+import server
+
+
+class BlockingCheckout:
+    """StripeCheckout stand-in whose coroutine blocks like the real helper"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    async def get_checkout_status(self, session_id):
+        time.sleep(self.seconds)
+        return {"session_id": session_id}
+
+
+def test_blocking_helper_call_runs_off_the_event_loop():
+    gateway = server.StripeGateway("sk_test", timeout=5)
+
+    async def run():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        result = await gateway.checkout(BlockingCheckout(0.2), "get_checkout_status", "cs_1")
+        task.cancel()
+        await gateway.close()
+        return result, ticks
+
+    result, ticks = asyncio.run(run())
+    assert result == {"session_id": "cs_1"}
+    assert ticks >= 5
+
+
+def test_blocking_helper_call_times_out():
+    gateway = server.StripeGateway("sk_test", timeout=0.05)
+
+    async def run():
+        started = time.perf_counter()
+        with pytest.raises(server.PaymentGatewayTimeout):
+            await gateway.checkout(BlockingCheckout(0.5), "get_checkout_status", "cs_1")
+        elapsed = time.perf_counter() - started
+        await gateway.close()
+        return elapsed
+
+    assert asyncio.run(run()) < 0.3
+
+
+class LoopRecordingCheckout:
+    """StripeCheckout stand-in that records the event loop each call runs on"""
+
+    def __init__(self):
+        self.loops = []
+        self.closed_on = None
+
+    async def get_checkout_status(self, session_id):
+        self.loops.append(asyncio.get_running_loop())
+        return {"session_id": session_id}
+
+    async def aclose(self):
+        self.closed_on = asyncio.get_running_loop()
+
+
+def test_helper_calls_on_a_pool_thread_share_one_live_loop(monkeypatch):
+    gateway = server.StripeGateway("sk_test", timeout=5, max_concurrency=1)
+    monkeypatch.setattr(server, "stripe_gateway", gateway)
+    checkout = LoopRecordingCheckout()
+
+    async def run():
+        for session_id in ("cs_1", "cs_2"):
+            await gateway.checkout(checkout, "get_checkout_status", session_id)
+        assert not checkout.loops[0].is_closed()
+        await server.close_stripe_checkout(checkout)
+        await gateway.close()
+
+    asyncio.run(run())
+    assert checkout.loops[0] is checkout.loops[1] is checkout.closed_on
+    assert checkout.loops[0].is_closed()
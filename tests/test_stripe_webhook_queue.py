@@ -0,0 +1,86 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+from pymongo import UpdateOne
+
+import server
+import webhook_queue
+
+
+@pytest.fixture
+def applied(db, monkeypatch):
+    asyncio.run(db.stripe_webhook_events.create_index("event_id", unique=True))
+    calls = []
+
+    def handler(event):
+        calls.append(event["event_id"])
+        return [("webhook_effects", UpdateOne({"event_id": event["event_id"]}, {"$inc": {"applied": 1}}, upsert=True))]
+
+    monkeypatch.setitem(server.STRIPE_WEBHOOK_HANDLERS, "test.event", handler)
+    return calls
+
+
+def webhook(event_id="evt_1"):
+    return SimpleNamespace(event_id=event_id, event_type="test.event", session_id="cs_1",
+                           payment_status="paid", metadata={})
+
+
+def test_a_redelivered_event_is_applied_once(db, applied):
+    queue = webhook_queue.StripeWebhookQueue(server.STRIPE_WEBHOOK_HANDLERS, backoff_base=0)
+
+    async def scenario():
+        await queue.enqueue(webhook(), b"{}")
+        await queue.enqueue(webhook(), b"{}")
+        processed = [await queue.process_batch(), await queue.process_batch()]
+        await queue.enqueue(webhook(), b"{}")
+        processed.append(await queue.process_batch())
+        return processed, await db.webhook_effects.find_one({"event_id": "evt_1"})
+
+    processed, effect = asyncio.run(scenario())
+    assert processed == [1, 0, 0]
+    assert applied == ["evt_1"] and effect["applied"] == 1
+    assert queue.stats["duplicates"] == 2
+
+
+def test_an_expired_lease_is_reclaimed_by_another_worker(db, applied):
+    crashed = webhook_queue.StripeWebhookQueue(server.STRIPE_WEBHOOK_HANDLERS, lease_seconds=60)
+    other = webhook_queue.StripeWebhookQueue(server.STRIPE_WEBHOOK_HANDLERS, lease_seconds=60)
+
+    async def scenario():
+        await crashed.enqueue(webhook(), b"{}")
+        assert [event["event_id"] for event in await crashed.claim()] == ["evt_1"]
+        # The first worker dies holding the lease; nobody else may take it yet
+        assert await other.process_batch() == 0
+        await db.stripe_webhook_events.update_one(
+            {"event_id": "evt_1"}, {"$set": {"lease_until": datetime.now(timezone.utc) - timedelta(seconds=1)}}
+        )
+        assert await other.process_batch() == 1
+        return await db.stripe_webhook_events.find_one({"event_id": "evt_1"})
+
+    event = asyncio.run(scenario())
+    assert event["status"] == "processed" and "lease_id" not in event
+    assert applied == ["evt_1"]
+
+
+def test_an_event_that_keeps_failing_is_dead_lettered(db, monkeypatch):
+    asyncio.run(db.stripe_webhook_events.create_index("event_id", unique=True))
+
+    def failing(event):
+        raise ValueError("unexpected payload")
+
+    monkeypatch.setitem(server.STRIPE_WEBHOOK_HANDLERS, "test.event", failing)
+    queue = webhook_queue.StripeWebhookQueue(server.STRIPE_WEBHOOK_HANDLERS, max_attempts=3, backoff_base=0)
+
+    async def scenario():
+        await queue.enqueue(webhook(), b"{}")
+        processed = [await queue.process_batch() for _ in range(4)]
+        return (processed, await db.stripe_webhook_events.find_one({"event_id": "evt_1"}),
+                await db.stripe_webhook_dead_letters.find_one({"event_id": "evt_1"}))
+
+    processed, event, dead_letter = asyncio.run(scenario())
+    assert processed == [1, 1, 1, 0]
+    assert event["status"] == "dead"
+    assert dead_letter["attempts"] == 3 and dead_letter["last_error"] == "unexpected payload"
+    assert queue.stats == {"enqueued": 1, "duplicates": 0, "processed": 0, "retried": 2, "dead_lettered": 1}
@@ -0,0 +1,61 @@
+import asyncio
+
+import server
+from server import LiveViewerCounters, LocalViewerPresenceStore, MongoViewerPresenceStore, ViewerCountSync
+
+
+def test_repeated_joins_and_leaves_do_not_skew_the_local_count():
+    counters = LiveViewerCounters(stripes=4)
+    assert counters.observe("s1", "u1", "viewer_joined") == 1
+    assert counters.observe("s1", "u1", "viewer_heartbeat") == 0
+    assert counters.observe("s1", "u1", "viewer_left") == -1
+    assert counters.observe("s1", "u1", "viewer_left") == 0
+    assert counters.count("s1") == 0
+
+
+def test_drain_changes_reports_the_final_state_once():
+    counters = LiveViewerCounters(stripes=4)
+    counters.observe("s1", "u1", "viewer_joined")
+    counters.observe("s1", "u2", "viewer_joined")
+    counters.observe("s1", "u2", "viewer_left")
+    seen, left = counters.drain_changes()
+    assert set(seen) == {("s1", "u1")} and left == {("s1", "u2")}
+    assert counters.drain_changes() == ({}, set())
+
+
+def sync_workers(store, events):
+    """Two workers sharing one presence store; events are (worker, viewer, event_type)"""
+    workers = [ViewerCountSync(LiveViewerCounters(stripes=4), store) for _ in range(2)]
+
+    async def scenario():
+        for worker, viewer_key, event_type in events:
+            workers[worker].counters.observe("s1", viewer_key, event_type)
+        for worker in workers:
+            await worker.sync()
+        for worker in workers:
+            await worker.sync()
+        return [worker.current("s1") for worker in workers]
+
+    return asyncio.run(scenario())
+
+
+def test_viewer_heartbeating_to_several_workers_is_counted_once(db):
+    events = [(0, "u1", "viewer_joined"), (1, "u1", "viewer_heartbeat"), (1, "u2", "viewer_joined")]
+    assert sync_workers(LocalViewerPresenceStore(), events) == [2, 2]
+    assert sync_workers(MongoViewerPresenceStore(), events) == [2, 2]
+
+
+def test_leave_on_any_worker_removes_the_viewer(db):
+    events = [(0, "u1", "viewer_joined"), (1, "u1", "viewer_left")]
+    # Worker 0 still holds its local entry until the heartbeat times out
+    assert sync_workers(MongoViewerPresenceStore(), events) == [1, 0]
+    assert asyncio.run(MongoViewerPresenceStore().totals()) == {}
+
+
+def test_anonymous_viewers_get_a_stable_fallback_key():
+    class Request:
+        client = type("Client", (), {"host": "10.0.0.1"})()
+        headers = {"user-agent": "player/1.0"}
+
+    assert server.anonymous_viewer_key(Request()) == server.anonymous_viewer_key(Request())
+    assert server.anonymous_viewer_key(Request()).startswith("anon:")
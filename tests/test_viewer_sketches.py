@@ -0,0 +1,68 @@
+import asyncio
+from datetime import datetime, timezone
+
+import server
+from server import HyperLogLog, StreamViewerSketches
+
+AT = datetime(2025, 1, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def test_estimate_is_within_a_few_percent():
+    sketch = HyperLogLog()
+    for i in range(50000):
+        sketch.add(f"viewer-{i}")
+    assert abs(sketch.estimate() - 50000) / 50000 < 0.03
+
+
+def test_small_counts_are_exact_enough_and_repeats_do_not_count():
+    sketch = HyperLogLog()
+    for i in range(100):
+        sketch.add(f"viewer-{i}")
+        sketch.add(f"viewer-{i}")
+    assert 98 <= sketch.estimate() <= 102
+
+
+def test_merge_is_idempotent_and_order_independent():
+    left, right = HyperLogLog(), HyperLogLog()
+    for i in range(3000):
+        left.add(f"a-{i}")
+        right.add(f"b-{i}")
+    once = HyperLogLog.from_bytes(left.to_bytes()).merge(right)
+    twice = HyperLogLog.from_bytes(right.to_bytes()).merge(left).merge(left)
+    assert once.to_bytes() == twice.to_bytes()
+    assert abs(once.estimate() - 6000) / 6000 < 0.03
+
+
+def test_quiet_worker_picks_up_other_workers_viewers_on_persist(db, monkeypatch):
+    busy, quiet = StreamViewerSketches(), StreamViewerSketches()
+
+    async def scenario():
+        monkeypatch.setattr(server, "WORKER_ID", "busy")
+        busy.add("s1", "u1", AT)
+        await busy.persist()
+        monkeypatch.setattr(server, "WORKER_ID", "quiet")
+        assert await quiet.load_total("s1") == 1
+        monkeypatch.setattr(server, "WORKER_ID", "busy")
+        busy.add("s1", "u2", AT)
+        await busy.persist()
+        # The quiet worker adds nothing itself but still refreshes on its timer
+        monkeypatch.setattr(server, "WORKER_ID", "quiet")
+        await quiet.persist()
+        return quiet.unique_viewers("s1")
+
+    assert asyncio.run(scenario()) == 2
+
+
+def test_ended_stream_state_is_dropped_after_persist(db):
+    sketches = StreamViewerSketches()
+
+    async def scenario():
+        sketches.add("s1", "u1", AT)
+        sketches.end_stream("s1")
+        await sketches.persist()
+        stored = await db.stream_viewer_sketches.count_documents({"stream_event_id": "s1"})
+        return stored
+
+    assert asyncio.run(scenario()) == 2
+    assert sketches.unique_viewers("s1") is None
+    assert not sketches._totals and not sketches._minutes and not sketches._merged_totals
@@ -0,0 +1,81 @@
+import asyncio
+import random
+from datetime import datetime, timedelta, timezone
+
+import server
+from server import TDigest, WatchSessions
+
+AT = datetime(2025, 1, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def exact_quantile(values, q):
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def test_quantiles_track_exact_values():
+    rng = random.Random(7)
+    values = [rng.expovariate(1 / 600) for _ in range(20000)]
+    digest = TDigest()
+    for value in values:
+        digest.add(value)
+    for q in (0.5, 0.9, 0.99):
+        assert abs(digest.quantile(q) - exact_quantile(values, q)) / exact_quantile(values, q) < 0.03
+    assert len(digest.means) <= 2 * digest.compression
+
+
+def test_merged_digests_match_one_digest_of_everything():
+    rng = random.Random(11)
+    parts = [[rng.uniform(0, 3600) for _ in range(5000)] for _ in range(3)]
+    merged = TDigest()
+    for part in parts:
+        digest = TDigest()
+        for value in part:
+            digest.add(value)
+        merged.merge(TDigest.from_dict(digest.to_dict()))
+    everything = [value for part in parts for value in part]
+    assert merged.total_weight == len(everything)
+    assert abs(merged.quantile(0.5) - exact_quantile(everything, 0.5)) < 60
+
+
+def test_empty_and_single_value_digests():
+    assert TDigest().quantile(0.5) is None
+    digest = TDigest()
+    digest.add(42.0)
+    assert digest.quantile(0.95) == 42.0
+
+
+def test_quiet_worker_picks_up_other_workers_sessions_on_persist(db, monkeypatch):
+    busy, quiet = WatchSessions(), WatchSessions()
+
+    async def scenario():
+        monkeypatch.setattr(server, "WORKER_ID", "busy")
+        busy.start("s1", "u1", AT)
+        busy.end("s1", "u1", AT + timedelta(seconds=60))
+        await busy.persist()
+        monkeypatch.setattr(server, "WORKER_ID", "quiet")
+        assert (await quiet.load_watch_time("s1"))["sessions"] == 1
+        monkeypatch.setattr(server, "WORKER_ID", "busy")
+        busy.start("s1", "u2", AT)
+        busy.end("s1", "u2", AT + timedelta(seconds=120))
+        await busy.persist()
+        monkeypatch.setattr(server, "WORKER_ID", "quiet")
+        await quiet.persist()
+        return quiet.watch_time("s1")
+
+    assert asyncio.run(scenario())["sessions"] == 2
+
+
+def test_ending_a_stream_closes_open_sessions_then_drops_state(db):
+    sessions = WatchSessions()
+
+    async def scenario():
+        sessions.start("s1", "u1", AT)
+        sessions.end_stream("s1", AT + timedelta(seconds=300))
+        await sessions.persist()
+        return await db.stream_watch_digests.find_one({"stream_event_id": "s1"})
+
+    stored = asyncio.run(scenario())
+    assert TDigest.from_dict(stored["digest"]).quantile(0.5) == 300
+    assert sessions.watch_time("s1") is None
+    assert not sessions._open and not sessions._digests and not sessions._merged
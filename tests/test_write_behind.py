@@ -0,0 +1,93 @@
+import asyncio
+import uuid
+
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+import server
+from server import WriteBehindBuffer
+
+real_sleep = asyncio.sleep
+
+
+class FlakyCollection:
+    """Stores documents by _id like insert_many(ordered=False); can fail after writing"""
+
+    def __init__(self, fail_after_write=0):
+        self.documents = {}
+        self.fail_after_write = fail_after_write
+
+    async def insert_many(self, documents, ordered=True):
+        errors = []
+        for index, document in enumerate(documents):
+            document.setdefault("_id", uuid.uuid4().hex)
+            if document["_id"] in self.documents:
+                errors.append({"index": index, "code": 11000, "errmsg": "duplicate key"})
+            else:
+                self.documents[document["_id"]] = document
+        if self.fail_after_write:
+            self.fail_after_write -= 1
+            raise AutoReconnect("connection reset after write")
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": len(documents) - len(errors)})
+
+
+def test_retry_after_unclear_failure_counts_stored_documents_once(monkeypatch):
+    collection = FlakyCollection(fail_after_write=1)
+    monkeypatch.setattr(server, "db", {"events": collection})
+    monkeypatch.setattr(server.asyncio, "sleep", lambda delay: real_sleep(0))
+    flushed = []
+
+    async def on_flush(batch):
+        flushed.extend(batch)
+
+    buffer = WriteBehindBuffer("events", on_flush=on_flush)
+    asyncio.run(buffer._flush([{"n": i} for i in range(5)]))
+
+    assert len(collection.documents) == 5
+    assert sorted(document["n"] for document in flushed) == list(range(5))
+    assert buffer.stats["flushed"] == 5 and buffer.stats["failed"] == 0
+
+
+def test_only_documents_that_keep_failing_are_dropped(monkeypatch):
+    class RejectingCollection(FlakyCollection):
+        async def insert_many(self, documents, ordered=True):
+            errors = []
+            for index, document in enumerate(documents):
+                if document["n"] == 3:
+                    errors.append({"index": index, "code": 121, "errmsg": "validation failed"})
+                else:
+                    self.documents[id(document)] = document
+            if errors:
+                raise BulkWriteError({"writeErrors": errors})
+
+    collection = RejectingCollection()
+    monkeypatch.setattr(server, "db", {"events": collection})
+    monkeypatch.setattr(server.asyncio, "sleep", lambda delay: real_sleep(0))
+    flushed = []
+
+    async def on_flush(batch):
+        flushed.extend(batch)
+
+    buffer = WriteBehindBuffer("events", on_flush=on_flush)
+    asyncio.run(buffer._flush([{"n": i} for i in range(5)]))
+
+    assert sorted(document["n"] for document in flushed) == [0, 1, 2, 4]
+    assert buffer.stats["failed"] == 1 and buffer.stats["flushed"] == 4
+
+
+def test_minute_buckets_coalesce_a_batch(db):
+    batch = [
+        {"stream_event_id": "s1", "event_type": "viewer_joined", "created_at": "2025-01-01T10:00:05+00:00"},
+        {"stream_event_id": "s1", "event_type": "viewer_joined", "created_at": "2025-01-01T10:00:50+00:00"},
+        {"stream_event_id": "s1", "event_type": "tip_sent", "created_at": "2025-01-01T10:01:00+00:00",
+         "payload": {"amount": "2.5"}},
+        {"stream_event_id": "s1", "event_type": "unknown", "created_at": "2025-01-01T10:01:00+00:00"},
+    ]
+
+    async def scenario():
+        await server.apply_stream_metric_buckets(batch)
+        return await db.stream_metrics_minutely.find({}, {"_id": 0}).sort("minute", 1).to_list(None)
+
+    first, second = asyncio.run(scenario())
+    assert first["joins"] == 2
+    assert second["tips_sent"] == 1 and second["tip_amount"] == 2.5